@@ -1,7 +1,10 @@
+import asyncio
 import logging
+import os
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import List, Tuple
 
-import boto3
-from cachetools import cached, TTLCache
 from dotenv import load_dotenv
 # from pydantic import BaseModel
 from starlette.websockets import WebSocketDisconnect
@@ -12,15 +15,61 @@ import json
 
 from fastapi import FastAPI, WebSocket, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
 
-from auth import decode_token
+from auth import decode_token, key_store
+from framing import MessageFramer
+from identity import IdentityResolver
+from metrics import registry, rejections_total, stage_seconds
+from payload_log import log_payload
 
-from traceback_analyser import analyze, AnalyzeException
+from traceback_analyser import (analyze, analyze_batch, analysis_sessions, AnalysisSession, AnalyzeException,
+                                BatchItem, quotas, answer_cache, filter_pool, llm_pool, llm_scheduler, single_flight,
+                                state_backend, warm_up)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nothing here may block on AWS or OpenAI, the app must start even if they are slow or down
+    jwks_refresh_task = asyncio.create_task(key_store.run_refresh())
+    usage_flush_task = asyncio.create_task(quotas.ledger.run_flush())
+    session_expiry_task = asyncio.create_task(analysis_sessions.run_expiry())
+    warm_up_task = asyncio.create_task(_warm_up())
+    yield
+    warm_up_task.cancel()
+    session_expiry_task.cancel()
+    jwks_refresh_task.cancel()
+    usage_flush_task.cancel()
+    analysis_sessions.close()
+    # A flush cancelled half way puts back the usage it has not written, the last flush writes it
+    with suppress(asyncio.CancelledError):
+        await usage_flush_task
+    await quotas.ledger.flush()
+    await llm_pool.close()
+    await state_backend.close()
+    filter_pool.close()
+
+
+async def _warm_up():
+    """
+    Load in the background what would otherwise be loaded by the first request.
+    """
+    start = time.monotonic()
+    try:
+        await asyncio.to_thread(warm_up)
+        await asyncio.to_thread(lambda: identity_resolver.cognito_client)
+    except Exception as e:
+        logger.warning(f"Warm up failed, will be retried on first use: {e}")
+    else:
+        logger.info(f"Warm up done in {time.monotonic() - start:.2f} s")
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add middleware
 app.add_middleware(
@@ -34,46 +83,86 @@ app.add_middleware(
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    """
+    The first message is JSON with the token and the framing settings (see MessageFramer), then come the language
+    and the traceback. The analysis runs in a session that goes on if the connection drops: with 'resumable': true
+    in the first message the session id is sent first, {"status": "session", "session_id": ...}, and a client that
+    reconnects sends session_id and offset, the number of characters of the answer it has, in the first message
+    instead of the language and traceback to get the rest of the answer. The client can reconnect to any worker if
+    STATE_BACKEND_URL is set, see SessionStore, otherwise only to the worker running the session.
+    """
     await websocket.accept()
     logger.info("Websocket accepted")
 
-    # Receive the first message and extract the token
+    # Receive the first message and extract the token, and the framing settings (see MessageFramer)
     data = await websocket.receive_text()
     message = json.loads(data)
     token = message.get('token')
+    framer = MessageFramer.negotiate(websocket.send_text, message)
 
     user_info = await _validate_websocket_token(token, websocket)
 
+    messages = None
     try:
-        language = await websocket.receive_text()
-        data = await websocket.receive_text()
-        logger.info(f"Got {language} stacktrace to analyse: {data}")
-        logger.debug(f"Stacktrace data: {data}")
         try:
-            async for message in analyze(user_info, language, data, 0.5, 2, 0.0):
-                await websocket.send_json(message.dict())
+            session, offset = await _open_session(websocket, message, user_info)
+            messages = session.follow(offset)
+            async for message in messages:
+                await framer.send(message.status, message.stage, message.message)
         except AnalyzeException as e:
+            await framer.flush()
             await websocket.send_json({'status': 'error', "status_code": e.status_code, "message": f"{e}"})
 
+        await framer.flush()
         await websocket.send_json({'status': 'completed'})
         await websocket.close()
     except WebSocketDisconnect as e:
         logger.info(f"Socket disconnected, info: {e}")
+        framer.cancel()
         await websocket.close()
+    finally:
+        if messages is not None:
+            await messages.aclose()
+
+
+async def _open_session(websocket: WebSocket, message: dict, user_info: dict) -> Tuple[AnalysisSession, int]:
+    """
+    Resume the session given in the first message, or receive a traceback and start a session analysing it.
+    :return: the session and the offset in the answer to follow it from
+    """
+    session_id = message.get('session_id')
+    if session_id:
+        offset = message.get('offset', 0)
+        if not isinstance(offset, int):
+            raise AnalyzeException("Sorry, invalid offset", 400)
+        logger.info(f"Resuming session {session_id} from offset {offset}")
+        return await analysis_sessions.get(session_id, user_info['email']), offset
+
+    language = await websocket.receive_text()
+    data = await websocket.receive_text()
+    logger.info(f"Got {language} stacktrace of {len(data)} characters to analyse")
+    log_payload(logger, f"{language} stacktrace", data)
+    session = analysis_sessions.start(user_info['email'], analyze(user_info, language, data, 0.5, 2, 0.0))
+    if message.get('resumable') is True:
+        await websocket.send_json({'status': 'session', 'session_id': session.session_id})
+    return session, 0
 
 
 async def _validate_websocket_token(token, websocket):
     if not token:
+        rejections_total.inc('invalid_token')
         await websocket.send_json({'status': 'error', "status_code": 403, "message": "No token"})
         await websocket.close(code=1008)
         raise HTTPException(status_code=403, detail="Invalid request")
     # Verify the token (This is a simplification, make sure to handle exceptions in real code)
     # payload = jwt.decode(token, os.getenv('JWT_SECRET'), algorithms=['RS256'])
     try:
-        payload = decode_token(token)
+        with stage_seconds.time('token_decode'):
+            payload = await decode_token(token)
         logger.debug(payload)
     except HTTPException as e:
         logger.info(f"Websocket got invalid token, reason: {e}")
+        rejections_total.inc('invalid_token')
         await websocket.send_json({'status': 'error', "status_code": e.status_code, "message": "Invalid token"})
         await websocket.close()
         raise
@@ -83,18 +172,28 @@ async def _validate_websocket_token(token, websocket):
         await websocket.close()
         raise
     try:
-        user_info = _token_to_user_info(token)
-    except cognito_client.exceptions.NotAuthorizedException as e:
+        user_info = await identity_resolver.resolve(token, payload)
+    except HTTPException as e:
         logger.info(f"Failed to get_user from cognito: {e}")
+        rejections_total.inc('invalid_token')
         await websocket.send_json({'status': 'error', "status_code": e.status_code, "message": "Invalid token"})
         await websocket.close()
         raise
-    logger.info(f"user info for token: {user_info}")
+    logger.debug(f"user info for token: {user_info}")
     return user_info
 
 
 region_name = 'eu-north-1'
-cognito_client = boto3.client('cognito-idp', region_name=region_name)
+
+
+def _create_cognito_client():
+    import boto3
+    return boto3.client('cognito-idp', region_name=region_name)
+
+
+# Access tokens from Cognito carry no email claim, only ID tokens do, so trusting JWT claims is opt in
+identity_resolver = IdentityResolver(cognito_client_factory=_create_cognito_client,
+                                     trust_jwt_email=os.getenv('TRUST_JWT_EMAIL') == 'true', state=state_backend)
 
 
 @app.get("/get_user_info")
@@ -102,36 +201,70 @@ async def get_user_info(request: Request):
     logger.info("Getting user info")
     access_token = await _get_auth_token(request, True)
 
+    return await identity_resolver.resolve(access_token)
+
+
+@app.get("/stats")
+async def stats():
+    return {"answer_cache": answer_cache.stats(), "llm_scheduler": llm_scheduler.stats(),
+            "analysis_sessions": analysis_sessions.stats(), "single_flight": single_flight.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Metrics of this worker in the Prometheus text format. Not routed by nginx, scrape it on the host.
+    """
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+
+
+MAX_BATCH_ITEMS = 100
+# Characters of the tracebacks, the JSON body can be several times larger, see client_max_body_size in linuxconf/nginx
+MAX_BATCH_CHARS = 10 * 1024 * 1024
+
+
+@app.post("/analyze/batch")
+async def analyze_batch_endpoint(request: Request, batch: BatchRequest):
+    """
+    Analyze many tracebacks, streams a JSON result per line (NDJSON) as the analyses complete, see analyze_batch.
+    """
+    access_token = await _get_auth_token(request)
+    payload = await _verify_access_token(access_token)
+    user_info = await identity_resolver.resolve(access_token, payload)
+    if len(batch.items) > MAX_BATCH_ITEMS:
+        rejections_total.inc('batch_too_large')
+        raise HTTPException(status_code=413, detail=f"Too many tracebacks, max {MAX_BATCH_ITEMS}")
+    if sum(len(item.trace) for item in batch.items) > MAX_BATCH_CHARS:
+        rejections_total.inc('batch_too_large')
+        raise HTTPException(status_code=413, detail=f"Tracebacks too large, max {MAX_BATCH_CHARS} characters")
     try:
-        return _token_to_user_info(access_token)
-    except cognito_client.exceptions.NotAuthorizedException as e:
-        logger.info(f"Failed to get_user from cognito: {e}")
-        raise HTTPException(status_code=403, detail="NotAuthorizedException - Invalid Access Token")
+        await quotas.check(user_info)
+    except AnalyzeException as e:
+        raise HTTPException(status_code=e.status_code, detail=f"{e}")
+    logger.info(f"Got batch of {len(batch.items)} stacktraces to analyse")
 
+    async def results():
+        async for result in analyze_batch(user_info, batch.items, 0.5, 2, 0.0):
+            yield json.dumps(result) + '\n'
 
-@cached(cache=TTLCache(maxsize=128, ttl=300))
-def _token_to_user_info(access_token: str) -> dict:
-    logger.info("Getting user info for token from cognito")
-    response = cognito_client.get_user(AccessToken=access_token)
-    logger.info(response['UserAttributes'])
-    # covert list of Name:Value objects to dict
-    return {item['Name']: item['Value'] for item in response['UserAttributes']}
+    return StreamingResponse(results(), media_type='application/x-ndjson')
 
 
 @app.get("/logout")
 async def logout(request: Request):
     logger.info(f"logging out..")
     access_token = await _get_auth_token(request, verify=True)
-    logger.info(f"logging out {access_token}")
+    logger.debug(f"logging out {access_token}")
 
     try:
-        response = cognito_client.global_sign_out(
-            AccessToken=access_token
-        )
+        response = await identity_resolver.sign_out(access_token)
         logger.info(f"AWS logout response: {response}")
-        # covert list of Name:Value objects to dict
         return {"message": "logged out OK"}
-    except cognito_client.exceptions.NotAuthorizedException:
+    except HTTPException:
         return {"error": "NotAuthorizedException - Invalid Access Token"}
 
 
@@ -151,14 +284,18 @@ async def _get_auth_token(request, verify=False):
 async def _verify_access_token(access_token):
     # Verify the token (This is a simplification, make sure to handle exceptions in real code)
     try:
-        payload = decode_token(access_token)
-        logger.info(payload)
+        with stage_seconds.time('token_decode'):
+            payload = await decode_token(access_token)
+        logger.debug(payload)
     except HTTPException as e:
         logger.info(f"Invalid token. Reason: {e}")
+        rejections_total.inc('invalid_token')
         raise
     except Exception as e:
         logger.info(f"Failed to decode token reason: {e}")
+        rejections_total.inc('invalid_token')
         raise HTTPException(status_code=401, detail="Bad Authorization token")
+    return payload
 
 # class EmailSchema(BaseModel):
 #     name: str
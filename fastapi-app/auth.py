@@ -1,29 +1,126 @@
+import asyncio
 import logging
+import threading
+import time
 
 import requests
 from fastapi import HTTPException
-from jose import jwt
+from jose import jwk, jwt
 
 region = 'eu-north-1'
 userPoolId = 'eu-north-1_5614uLBuF'
+jwks_url = f"https://cognito-idp.{region}.amazonaws.com/{userPoolId}/.well-known/jwks.json"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def decode_token(token):
-    key = get_public_key(token)
+class JwksKeyStore:
+    """
+    In memory store of the public keys in a JSON Web Key Set, indexed by key id (kid).
+
+    The key set is fetched once and then refreshed in the background (see run_refresh), a token signed
+    with an unknown kid triggers a refetch in case the keys have been rotated.
+    Concurrent refetches are coalesced into one request, and kids that are still unknown after a refetch
+    are remembered for a while so bogus tokens can't make us hammer the jwks endpoint.
+    Keys are parsed into jose key objects once, so jwt.decode doesn't have to parse the JWK for every token.
+    """
+    REFRESH_INTERVAL = 3600
+    UNKNOWN_KID_TTL = 300
+    MIN_REFETCH_INTERVAL = 10
+    FETCH_TIMEOUT = 5
+
+    def __init__(self, url: str, algorithm: str = 'RS256'):
+        self._url = url
+        self._algorithm = algorithm
+        self._keys = {}
+        self._unknown_kids = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._fetched_at = None
+
+    def get_key(self, kid: str):
+        """
+        Get the parsed public key for kid, fetching the key set if the kid is not known yet.
+        Blocks on network access when fetching, use aget_key from async code.
+        :return: jose key or None if there is no key with that kid
+        """
+        key = self._keys.get(kid)
+        if key is None and self._should_refetch(kid):
+            self.refresh(self._generation)
+            key = self._keys.get(kid)
+            if key is None:
+                logger.info(f"Unknown JWT key id: {kid}")
+                self._unknown_kids[kid] = time.monotonic() + self.UNKNOWN_KID_TTL
+        return key
+
+    async def aget_key(self, kid: str):
+        key = self._keys.get(kid)
+        if key is None and self._should_refetch(kid):
+            key = await asyncio.to_thread(self.get_key, kid)
+        return key
+
+    def refresh(self, generation: int = None):
+        """
+        Fetch the key set and replace the keys in the store.
+        :param generation: The generation the caller saw before deciding to refresh, if another refresh
+            has completed since then this call returns without fetching.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            jwks = self.fetch_jwks()
+            keys = {}
+            for key_data in jwks['keys']:
+                keys[key_data['kid']] = jwk.construct(key_data, key_data.get('alg', self._algorithm))
+            self._keys = keys
+            self._unknown_kids = {kid: expires for kid, expires in self._unknown_kids.items() if kid not in keys}
+            self._fetched_at = time.monotonic()
+            self._generation += 1
+            logger.info(f"Loaded {len(keys)} JWT keys from {self._url}")
+
+    def fetch_jwks(self) -> dict:
+        return requests.get(self._url, timeout=self.FETCH_TIMEOUT).json()
+
+    async def run_refresh(self, interval: float = None):
+        """
+        Refresh the key set periodically, meant to be run as a background task.
+        """
+        interval = interval or self.REFRESH_INTERVAL
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.warning(f"Failed to refresh JWT keys: {e}")
+                await asyncio.sleep(self.MIN_REFETCH_INTERVAL)
+            else:
+                await asyncio.sleep(interval)
+
+    def _should_refetch(self, kid: str) -> bool:
+        expires = self._unknown_kids.get(kid)
+        if expires is not None:
+            if expires > time.monotonic():
+                return False
+            self._unknown_kids.pop(kid, None)
+        # Limit how often unknown kids can trigger a refetch
+        return self._fetched_at is None or time.monotonic() - self._fetched_at > self.MIN_REFETCH_INTERVAL
+
+
+key_store = JwksKeyStore(jwks_url)
+
+
+async def decode_token(token):
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.JWTError as e:
+        logger.info(f"JWT token error: {e}")
+        raise HTTPException(status_code=403, detail="Invalid token")
+    key = await key_store.aget_key(header.get('kid'))
+    if key is None:
+        raise HTTPException(status_code=403, detail="Invalid token")
     try:
         payload = jwt.decode(token, key, algorithms=['RS256'])
     except jwt.JWTError as e:
         logger.info(f"JWT token error: {e}")
         raise HTTPException(status_code=403, detail="Invalid token")
     return payload
-
-
-def get_public_key(token):
-    header = jwt.get_unverified_header(token)
-    jwks_url = f"https://cognito-idp.{region}.amazonaws.com/{userPoolId}/.well-known/jwks.json"
-    jwks = requests.get(jwks_url).json()
-    rsa_key = [k for k in jwks['keys'] if k['kid'] == header['kid']][0]
-    return rsa_key
@@ -0,0 +1,42 @@
+"""
+Benchmark of extract_stacktrace on journald style pastes of growing size, time per line should stay flat.
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_extract_tb
+"""
+import argparse
+import time
+
+from traceback_analyser.extract_tb import EXAMPLE_TB, extract_stacktrace
+
+
+def make_paste(lines: int) -> str:
+    example_lines = EXAMPLE_TB.strip().splitlines()
+    paste = []
+    while len(paste) < lines:
+        for i, line in enumerate(example_lines):
+            # vary the numbers in the prefix like timestamps and pids do in a real log
+            paste.append(line.replace('16:28:46', f"16:{len(paste) % 60:02}:{i % 60:02}"))
+            if i % 25 == 0:
+                paste.append('')  # blank lines must not break the prefix detection
+    return '\n'.join(paste[:lines])
+
+
+def run(max_lines: int, repeat: int):
+    lines = 1000
+    while lines <= max_lines:
+        paste = make_paste(lines)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            extract_stacktrace(paste)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{lines:>8} lines {len(paste) / 1e6:7.2f} MB {elapsed * 1000:9.1f} ms "
+              f"{elapsed / lines * 1e6:6.2f} us/line")
+        lines *= 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-lines', type=int, default=256000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.max_lines, args.repeat)
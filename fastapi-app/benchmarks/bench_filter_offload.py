@@ -0,0 +1,91 @@
+"""
+Benchmark of the latency of the answers streamed to other users while a large traceback is filtered.
+Simulates streams on the event loop, each expecting a token every --interval seconds, and measures how late the
+tokens are while 1 MB tracebacks are filtered: inline on the event loop, and by the FilterPool used by the app.
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_filter_offload
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+from typing import List
+
+from benchmarks.corpus import java_framework, python_chained, to_size
+from traceback_analyser import prepare_trace
+from traceback_analyser.filter_pool import FilterPool
+
+# Same settings as the websocket endpoint
+SIMILARITY_THRESHOLD = 0.5
+MAX_SIMILAR_LINES = 2
+
+
+async def stream(interval: float, stop: asyncio.Event, lateness: List[float]):
+    expected = time.perf_counter() + interval
+    while not stop.is_set():
+        await asyncio.sleep(max(expected - time.perf_counter(), 0))
+        now = time.perf_counter()
+        lateness.append(now - expected)
+        expected = max(expected + interval, now)
+
+
+async def run_scenario(name: str, filter_traces, streams: int, interval: float):
+    stop = asyncio.Event()
+    lateness = []
+    tasks = [asyncio.create_task(stream(interval, stop, lateness)) for _ in range(streams)]
+    # Let the streams settle before measuring
+    await asyncio.sleep(interval * 5)
+    lateness.clear()
+    start = time.perf_counter()
+    await filter_traces()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await asyncio.gather(*tasks)
+    lateness.sort()
+    print(f"{name:<8} filtering {elapsed * 1000:7.0f} ms  token lateness p50 {lateness[len(lateness) // 2] * 1000:6.1f} ms"
+          f"  p99 {lateness[int(len(lateness) * 0.99)] * 1000:6.1f} ms  max {lateness[-1] * 1000:6.1f} ms")
+
+
+async def main(args):
+    rng = random.Random(42)
+    traces = [('python', to_size(rng, python_chained, args.size)), ('java', to_size(rng, java_framework, args.size))]
+    traces = traces * args.repeat
+    pool = FilterPool(prepare_trace, workers=args.workers)
+    pool.start()
+    # Wait for the processes to load the token encodings, as the app does at startup
+    await pool.prepare('python', 'x' * (pool.inline_max_chars + 1), SIMILARITY_THRESHOLD, MAX_SIMILAR_LINES)
+
+    async def idle():
+        await asyncio.sleep(2)
+
+    async def inline():
+        for language, trace in traces:
+            prepare_trace(language, trace, SIMILARITY_THRESHOLD, MAX_SIMILAR_LINES)
+            await asyncio.sleep(0)
+
+    async def offloaded():
+        await asyncio.gather(*(pool.prepare(language, trace, SIMILARITY_THRESHOLD, MAX_SIMILAR_LINES)
+                               for language, trace in traces))
+
+    print(f"{args.streams} streams of a token every {args.interval * 1000:.0f} ms, "
+          f"{len(traces)} tracebacks of {args.size // 1024} KB, {args.workers} filter processes")
+    try:
+        await run_scenario('idle', idle, args.streams, args.interval)
+        await run_scenario('inline', inline, args.streams, args.interval)
+        await run_scenario('pool', offloaded, args.streams, args.interval)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.02, help="Seconds between the tokens of a stream")
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    parser.add_argument('--repeat', type=int, default=2, help="Tracebacks of each language to filter")
+    parser.add_argument('--workers', type=int, default=FilterPool.WORKERS)
+    args = parser.parse_args()
+    # The filters log the tracebacks they filter
+    logging.getLogger('traceback_analyser').setLevel(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,144 @@
+"""
+Benchmark of the traceback filters of the languages, as the app runs them (see traceback_analyser.traceback_filter),
+on the synthetic corpus of benchmarks/corpus.py.
+Reports per case the throughput in input lines/s, the peak memory allocated while filtering and the reduction of
+input characters and tokens. The results are compared with the baseline file and the run fails (exit status 1) if a
+case is slower, needs more memory or reduces less than the baseline allows. The reduction of characters does not
+depend on the tokenizer and is always checked, the reduction of tokens only if the baseline counted them with the
+same encoding. Speed and memory depend on the machine: update the baseline with --update-baseline on the machine
+that runs the checks, and after a deliberate change of the filters. Without a baseline the run fails.
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_filters
+    python -m benchmarks.bench_filters --update-baseline
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.corpus import Case, generate_corpus
+from traceback_analyser import traceback_filter
+
+BASELINE = Path(__file__).parent / 'baseline_filters.json'
+# Same settings as the websocket endpoint
+SIMILARITY_THRESHOLD = 0.5
+MAX_SIMILAR_LINES = 2
+MODEL_NAME = 'gpt-3.5-turbo'
+
+
+def run_pipeline(case: Case) -> str:
+    return traceback_filter(case.language).filter(case.text, similarity_threshold=SIMILARITY_THRESHOLD,
+                                                  max_similar_lines=MAX_SIMILAR_LINES)
+
+
+def token_counter():
+    """
+    :return: (name of the encoding, count function), the count is estimated from the length if the encoding of
+    the model can't be loaded (e.g. offline without a tiktoken cache)
+    """
+    try:
+        from traceback_analyser.tokens import get_token_counter
+        counter = get_token_counter(MODEL_NAME)
+        return counter.encoding.name, counter.count
+    except Exception as e:
+        print(f"Token encoding not available, estimating tokens as bytes / 4: {e}", file=sys.stderr)
+        return 'bytes/4', lambda text: len(text.encode()) // 4
+
+
+def measure(case: Case, repeat: int, count_tokens) -> dict:
+    output = run_pipeline(case)
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_pipeline(case)
+        elapsed.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run_pipeline(case)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    input_tokens = count_tokens(case.text)
+    return {
+        'lines': case.text.count('\n') + 1,
+        'lines_per_s': round((case.text.count('\n') + 1) / min(elapsed)),
+        'peak_kb': round(peak / 1024),
+        'input_tokens': input_tokens,
+        'output_tokens': count_tokens(output),
+        'reduction': round(1 - count_tokens(output) / input_tokens, 4),
+        'char_reduction': round(1 - len(output) / len(case.text), 4),
+    }
+
+
+def compare(name: str, result: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: descriptions of the regressions of the result against the baseline of the case
+    """
+    regressions = []
+    if result['lines_per_s'] < baseline['lines_per_s'] * (1 - tolerance):
+        regressions.append(f"{name}: {result['lines_per_s']} lines/s, baseline {baseline['lines_per_s']}")
+    if result['peak_kb'] > baseline['peak_kb'] * (1 + tolerance):
+        regressions.append(f"{name}: peak {result['peak_kb']} KB, baseline {baseline['peak_kb']}")
+    # The filters are deterministic, any loss of reduction is a change of behaviour
+    if result['char_reduction'] < baseline['char_reduction'] - 0.001:
+        regressions.append(f"{name}: character reduction {result['char_reduction']:.1%}, "
+                           f"baseline {baseline['char_reduction']:.1%}")
+    if 'reduction' in baseline and result['reduction'] < baseline['reduction'] - 0.001:
+        regressions.append(f"{name}: token reduction {result['reduction']:.1%}, baseline {baseline['reduction']:.1%}")
+    return regressions
+
+
+def main(baseline_path: Path, update_baseline: bool, tolerance: float, repeat: int, cases: str = None) -> int:
+    encoding, count_tokens = token_counter()
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else None
+    if baseline is None and not update_baseline:
+        print(f"No baseline {baseline_path}, create it with --update-baseline", file=sys.stderr)
+        return 1
+    if baseline is not None and baseline.get('encoding') != encoding:
+        print(f"Baseline tokens counted with {baseline.get('encoding')}, not {encoding}, not comparing the token "
+              f"reduction", file=sys.stderr)
+    results = {}
+    regressions = []
+    print(f"{'case':<34} {'lines':>7} {'lines/s':>9} {'peak KB':>8} {'char red':>9} {'tokens in':>10} {'out':>7} "
+          f"{'tok red':>9}")
+    for case in generate_corpus():
+        if cases and cases not in case.name:
+            continue
+        result = measure(case, repeat, count_tokens)
+        results[case.name] = result
+        print(f"{case.name:<34} {result['lines']:>7} {result['lines_per_s']:>9} {result['peak_kb']:>8} "
+              f"{result['char_reduction']:>9.1%} {result['input_tokens']:>10} {result['output_tokens']:>7} "
+              f"{result['reduction']:>9.1%}")
+        if not update_baseline:
+            if case.name not in baseline['cases']:
+                regressions.append(f"{case.name}: not in the baseline")
+                continue
+            case_baseline = dict(baseline['cases'][case.name])
+            if baseline.get('encoding') != encoding:
+                del case_baseline['reduction']
+            regressions.extend(compare(case.name, result, case_baseline, tolerance))
+
+    if update_baseline:
+        if cases and baseline is not None:
+            # Keep the baseline of the cases not run
+            results = {**baseline['cases'], **results}
+        baseline_path.write_text(json.dumps({'encoding': encoding, 'cases': results}, indent=2) + '\n')
+        print(f"Baseline written to {baseline_path}")
+    if regressions:
+        print("Regressions:\n  " + '\n  '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.3, help="Allowed loss of speed and growth of memory")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cases', help="Only run the cases with this in their name")
+    args = parser.parse_args()
+    # The filters log the tracebacks they filter
+    logging.getLogger('traceback_analyser').setLevel(logging.WARNING)
+    sys.exit(main(args.baseline, args.update_baseline, args.tolerance, args.repeat, args.cases))
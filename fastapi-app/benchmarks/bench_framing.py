@@ -0,0 +1,70 @@
+"""
+Websocket frames and CPU per stream when sending every token as its own JSON frame (as before MessageFramer)
+and with MessageFramer, over local websocket connections.
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_framing --streams 200 --tokens 200 --token-interval 0.01 --flush-ms 30
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+from framing import MessageFramer
+from traceback_analyser import Message
+
+
+async def stream_tokens(websocket, mode: str, tokens: int, token_interval: float, flush_ms: int):
+    if mode == 'per-token':
+        for i in range(tokens):
+            message = Message(status="STREAMING_RESPONSE", stage="ANAYLSIS_RUNNING", message=f" token{i}")
+            await websocket.send(json.dumps(message.dict()))
+            await asyncio.sleep(token_interval)
+    else:
+        framer = MessageFramer(websocket.send, flush_ms=flush_ms, compact=mode == 'compact')
+        for i in range(tokens):
+            message = Message(status="STREAMING_RESPONSE", stage="ANAYLSIS_RUNNING", message=f" token{i}")
+            await framer.send(message.status, message.stage, message.message)
+            await asyncio.sleep(token_interval)
+        await framer.flush()
+    await websocket.send(json.dumps({'status': 'completed'}))
+
+
+async def run(mode: str, streams: int, tokens: int, token_interval: float, flush_ms: int):
+    async def handler(websocket):
+        await stream_tokens(websocket, mode, tokens, token_interval, flush_ms)
+
+    frames = 0
+    received = 0
+
+    async def client(port: int):
+        nonlocal frames, received
+        async with websockets.connect(f"ws://127.0.0.1:{port}") as websocket:
+            async for data in websocket:
+                message = json.loads(data)
+                if isinstance(message, dict) and message['status'] == 'completed':
+                    break
+                frames += 1
+                received += len(data)
+
+    async with websockets.serve(handler, '127.0.0.1', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        cpu = time.process_time()
+        start = time.perf_counter()
+        await asyncio.gather(*[client(port) for _ in range(streams)])
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+    print(f"{mode:<10} frames: {frames:7d} ({frames / elapsed:8.0f}/s)  bytes: {received / 1e6:6.2f} MB  "
+          f"cpu: {cpu:5.2f} s ({cpu / streams * 1000:5.1f} ms/stream)  wall: {elapsed:5.2f} s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--token-interval', type=float, default=0.01)
+    parser.add_argument('--flush-ms', type=int, default=30)
+    args = parser.parse_args()
+    for mode in ('per-token', 'framed', 'compact'):
+        asyncio.run(run(mode, args.streams, args.tokens, args.token_interval, args.flush_ms))
@@ -0,0 +1,42 @@
+"""
+Benchmark of IdentityResolver against the stub Cognito backend.
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_identity --users 500 --requests 5000 --latency 0.05
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from identity import IdentityResolver
+from stubs import StubCognitoClient
+
+
+async def run(users: int, requests: int, latency: float, max_workers: int):
+    cognito = StubCognitoClient(latency=latency)
+    resolver = IdentityResolver(cognito, max_workers=max_workers)
+    tokens = [f"token-{i}" for i in range(users)]
+
+    async def lookup(token):
+        start = time.perf_counter()
+        await resolver.resolve(token)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    durations = await asyncio.gather(*[lookup(random.choice(tokens)) for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    durations.sort()
+    print(f"users: {users} lookups: {requests} cognito latency: {latency * 1000:.0f} ms workers: {max_workers}")
+    print(f"total: {elapsed:.2f} s, {requests / elapsed:.0f} lookups/s, cognito calls: {cognito.get_user_calls}")
+    print(f"p50: {durations[len(durations) // 2] * 1000:.2f} ms p99: {durations[int(len(durations) * 0.99)] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=IdentityResolver.MAX_WORKERS)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.requests, args.latency, args.workers))
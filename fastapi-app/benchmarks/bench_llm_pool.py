@@ -0,0 +1,106 @@
+"""
+Time to first token of the analyser against the local fake OpenAI server, with the shared LLM pool and with a
+ChatOpenAI and HTTP session created per request (as before the pool).
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_llm_pool --requests 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+APP_DIR = Path(__file__).parent.parent
+
+
+async def per_request_chat(analyser, traceback: str):
+    """
+    How the analyser called the API before the pool: a new ChatOpenAI, and so a new HTTP session, per request.
+    """
+    from langchain.callbacks import AsyncIteratorCallbackHandler
+    from langchain.chat_models import ChatOpenAI
+    from langchain.schema import HumanMessage, SystemMessage
+
+    callback = AsyncIteratorCallbackHandler()
+    chat = ChatOpenAI(streaming=True, callbacks=[callback], temperature=0.0, model_name=analyser.MODEL_NAME,
+                      request_timeout=analyser.REQUEST_TIMEOUT, max_tokens=analyser.OUTPUT_MAX_TOKENS)
+    message_types = {'system': SystemMessage, 'user': HumanMessage}
+    messages = [message_types[role](content=content) for role, content in analyser.prompt_messages(traceback)]
+    task = asyncio.create_task(chat.agenerate(messages=[messages]))
+    async for token in callback.aiter():
+        yield token
+    await task
+
+
+async def run_mode(mode: str, requests_count: int, concurrency: int):
+    from traceback_analyser.analyser import AnalyserJava, load_llm_stack
+    from traceback_analyser.llm_pool import llm_pool
+
+    load_llm_stack()
+    semaphore = asyncio.Semaphore(concurrency)
+    traceback = "java.lang.NullPointerException\n\tat com.acme.Foo.bar(Foo.java:42)"
+
+    async def request():
+        async with semaphore:
+            analyser = AnalyserJava()
+            start = time.perf_counter()
+            first_token = None
+            if mode == 'pooled':
+                tokens = analyser.send_to_openai_chat(traceback, input_token_count=100)
+            else:
+                tokens = per_request_chat(analyser, traceback)
+            async for _ in tokens:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+            return first_token, time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[request() for _ in range(requests_count)])
+    elapsed = time.perf_counter() - start
+    await llm_pool.close()
+    first_tokens = sorted(result[0] for result in results)
+    totals = sorted(result[1] for result in results)
+    print(f"{mode:<12} {requests_count / elapsed:7.1f} req/s  "
+          f"ttft p50 {first_tokens[len(first_tokens) // 2] * 1000:6.1f} ms "
+          f"p99 {first_tokens[int(len(first_tokens) * 0.99)] * 1000:6.1f} ms  "
+          f"total p50 {totals[len(totals) // 2] * 1000:6.1f} ms")
+
+
+def main(requests_count: int, concurrency: int, first_token_delay: float):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_openai_server', '--port', str(port),
+                               '--first-token-delay', str(first_token_delay)], cwd=APP_DIR)
+    base = f"http://127.0.0.1:{port}"
+    os.environ['OPENAI_API_BASE'] = f"{base}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{base}/stats")
+                break
+            except requests.ConnectionError:
+                time.sleep(0.05)
+        for mode in ('per-request', 'pooled'):
+            before = requests.get(f"{base}/stats").json()
+            asyncio.run(run_mode(mode, requests_count, concurrency))
+            after = requests.get(f"{base}/stats").json()
+            print(f"{'':<12} connections opened: {after['connections'] - before['connections']}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    args = parser.parse_args()
+    main(args.requests, args.concurrency, args.first_token_delay)
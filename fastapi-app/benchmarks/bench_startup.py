@@ -0,0 +1,105 @@
+"""
+Cold start benchmark: import time per module, and time from starting uvicorn until the first websocket is accepted.
+Run from the fastapi-app directory:
+    python -m benchmarks.bench_startup --runs 3 --max-import 1.5 --max-first-websocket 3
+Exits with status 1 if a limit is exceeded, so it can be used to catch startup regressions.
+"""
+import argparse
+import asyncio
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import websockets
+
+APP_DIR = Path(__file__).parent.parent
+_re_import_time = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module: str) -> List[Tuple[str, float, int]]:
+    """
+    :return: (module name, cumulative seconds, depth) of every module imported by importing module in a
+        new interpreter
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=APP_DIR,
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        match = _re_import_time.match(line)
+        if match:
+            times.append((match.group(4), int(match.group(2)) / 1e6, (len(match.group(3)) - 1) // 2))
+    return times
+
+
+def report_import_times(module: str, top: int) -> float:
+    times = import_times(module)
+    total = next(seconds for name, seconds, depth in times if name == module and depth == 0)
+    local_modules = {path.stem for path in APP_DIR.glob('*.py')} | {'traceback_analyser'}
+    print(f"import {module}: {total:.3f} s")
+    print("app modules:")
+    for name, seconds, depth in times:
+        if name.split('.')[0] in local_modules and name != module:
+            print(f"  {name:<40} {seconds:.3f} s")
+    print(f"top {top} packages:")
+    packages = {}
+    for name, seconds, depth in times:
+        package = name.split('.')[0]
+        if package not in local_modules:
+            packages[package] = max(packages.get(package, 0), seconds)
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:<40} {seconds:.3f} s")
+    return total
+
+
+async def time_to_first_websocket(timeout: float) -> float:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port)], cwd=APP_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                async with websockets.connect(f"ws://127.0.0.1:{port}/ws"):
+                    return time.perf_counter() - start
+            except OSError:
+                await asyncio.sleep(0.01)
+        raise TimeoutError(f"No websocket accepted in {timeout} s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def run(runs: int, top: int, timeout: float) -> Tuple[float, float]:
+    import_time = report_import_times('app', top)
+    durations = [await time_to_first_websocket(timeout) for _ in range(runs)]
+    first_websocket = statistics.median(durations)
+    print(f"time to first accepted websocket: median {first_websocket:.3f} s, "
+          f"min {min(durations):.3f} s, max {max(durations):.3f} s ({runs} runs)")
+    return import_time, first_websocket
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--max-import', type=float, help="Fail if importing app takes longer (seconds)")
+    parser.add_argument('--max-first-websocket', type=float,
+                        help="Fail if the first websocket is accepted later (seconds)")
+    args = parser.parse_args()
+    import_time, first_websocket = asyncio.run(run(args.runs, args.top, args.timeout))
+    failed = False
+    if args.max_import is not None and import_time > args.max_import:
+        print(f"FAIL: import time {import_time:.3f} s > {args.max_import} s")
+        failed = True
+    if args.max_first_websocket is not None and first_websocket > args.max_first_websocket:
+        print(f"FAIL: time to first websocket {first_websocket:.3f} s > {args.max_first_websocket} s")
+        failed = True
+    sys.exit(1 if failed else 0)
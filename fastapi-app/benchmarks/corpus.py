@@ -0,0 +1,286 @@
+"""
+Synthetic tracebacks for the filter benchmarks. Generation is seeded, so every run gets the same corpus.
+"""
+import random
+from typing import Callable, List, NamedTuple
+
+_JAVA_FRAMEWORK_FRAMES = [
+    "org.springframework.web.servlet.FrameworkServlet.service(FrameworkServlet.java:{n})",
+    "org.springframework.web.servlet.DispatcherServlet.doDispatch(DispatcherServlet.java:{n})",
+    "org.springframework.web.method.support.InvocableHandlerMethod.invokeForRequest(InvocableHandlerMethod.java:{n})",
+    "org.springframework.aop.framework.ReflectiveMethodInvocation.proceed(ReflectiveMethodInvocation.java:{n})",
+    "org.springframework.transaction.interceptor.TransactionInterceptor.invoke(TransactionInterceptor.java:{n})",
+    "org.springframework.aop.framework.CglibAopProxy$DynamicAdvisedInterceptor.intercept(CglibAopProxy.java:{n})",
+    "com.acme.orders.OrderService$$EnhancerBySpringCGLIB$$5d3c1f2a.placeOrder(<generated>)",
+    "org.hibernate.internal.SessionImpl.fireFlush(SessionImpl.java:{n})",
+    "org.hibernate.event.internal.DefaultFlushEventListener.onFlush(DefaultFlushEventListener.java:{n})",
+    "org.hibernate.engine.jdbc.batch.internal.BatchingBatch.performExecution(BatchingBatch.java:{n})",
+    "sun.reflect.GeneratedMethodAccessor{n}.invoke(Unknown Source)",
+    "java.lang.reflect.Method.invoke(Method.java:{n})",
+    "org.apache.catalina.core.ApplicationFilterChain.doFilter(ApplicationFilterChain.java:{n})",
+    "org.apache.catalina.core.StandardWrapperValve.invoke(StandardWrapperValve.java:{n})",
+    "org.apache.tomcat.util.threads.ThreadPoolExecutor$Worker.run(ThreadPoolExecutor.java:{n})",
+]
+_JAVA_APP_FRAMES = [
+    "com.acme.orders.OrderController.create(OrderController.java:{n})",
+    "com.acme.orders.OrderService.placeOrder(OrderService.java:{n})",
+    "com.acme.orders.OrderRepository.save(OrderRepository.java:{n})",
+    "com.acme.inventory.StockClient.reserve(StockClient.java:{n})",
+]
+# The frames of a Spring Boot MVC request on Tomcat, innermost frame first
+_SPRING_MVC_REQUEST = [
+    "org.springframework.web.servlet.mvc.method.annotation.RequestMappingHandlerAdapter.invokeHandlerMethod",
+    "org.springframework.web.servlet.mvc.method.annotation.RequestMappingHandlerAdapter.handleInternal",
+    "org.springframework.web.servlet.mvc.method.AbstractHandlerMethodAdapter.handle",
+    "org.springframework.web.servlet.DispatcherServlet.doDispatch",
+    "org.springframework.web.servlet.DispatcherServlet.doService",
+    "org.springframework.web.servlet.FrameworkServlet.processRequest",
+    "org.springframework.web.servlet.FrameworkServlet.doPost",
+    "jakarta.servlet.http.HttpServlet.service",
+    "org.springframework.web.servlet.FrameworkServlet.service",
+    "jakarta.servlet.http.HttpServlet.service",
+    "org.apache.catalina.core.ApplicationFilterChain.internalDoFilter",
+    "org.apache.catalina.core.ApplicationFilterChain.doFilter",
+    "org.apache.tomcat.websocket.server.WsFilter.doFilter",
+]
+_SPRING_FILTERS = [
+    "org.springframework.security.web.FilterChainProxy$VirtualFilterChain.doFilter",
+    "org.springframework.security.web.access.ExceptionTranslationFilter.doFilter",
+    "org.springframework.security.web.session.SessionManagementFilter.doFilter",
+    "org.springframework.security.web.authentication.AnonymousAuthenticationFilter.doFilter",
+    "org.springframework.security.web.servletapi.SecurityContextHolderAwareRequestFilter.doFilter",
+    "org.springframework.security.web.savedrequest.RequestCacheAwareFilter.doFilter",
+    "org.springframework.security.oauth2.server.resource.web.BearerTokenAuthenticationFilter.doFilterInternal",
+    "org.springframework.security.web.authentication.logout.LogoutFilter.doFilter",
+    "org.springframework.security.web.header.HeaderWriterFilter.doFilterInternal",
+    "org.springframework.security.web.context.SecurityContextHolderFilter.doFilter",
+    "org.springframework.web.filter.RequestContextFilter.doFilterInternal",
+    "org.springframework.web.filter.FormContentFilter.doFilterInternal",
+    "org.springframework.web.filter.CharacterEncodingFilter.doFilterInternal",
+    "org.springframework.boot.actuate.metrics.web.servlet.WebMvcMetricsFilter.doFilterInternal",
+]
+_TOMCAT_REQUEST = [
+    "org.apache.catalina.core.StandardWrapperValve.invoke",
+    "org.apache.catalina.core.StandardContextValve.invoke",
+    "org.apache.catalina.authenticator.AuthenticatorBase.invoke",
+    "org.apache.catalina.core.StandardHostValve.invoke",
+    "org.apache.catalina.valves.ErrorReportValve.invoke",
+    "org.apache.catalina.core.StandardEngineValve.invoke",
+    "org.apache.catalina.connector.CoyoteAdapter.service",
+    "org.apache.coyote.http11.Http11Processor.service",
+    "org.apache.coyote.AbstractProcessorLight.process",
+    "org.apache.coyote.AbstractProtocol$ConnectionHandler.process",
+    "org.apache.tomcat.util.net.NioEndpoint$SocketProcessor.doRun",
+    "org.apache.tomcat.util.net.SocketProcessorBase.run",
+    "org.apache.tomcat.util.threads.ThreadPoolExecutor.runWorker",
+    "org.apache.tomcat.util.threads.ThreadPoolExecutor$Worker.run",
+    "org.apache.tomcat.util.threads.TaskThread$WrappingRunnable.run",
+    "java.base/java.lang.Thread.run",
+]
+# A call through a transactional Spring bean, innermost frame first
+_SPRING_AOP_CALL = [
+    "{cls}$$SpringCGLIB$$0.invoke",
+    "org.springframework.cglib.proxy.MethodProxy.invoke",
+    "org.springframework.aop.framework.CglibAopProxy$CglibMethodInvocation.invokeJoinpoint",
+    "org.springframework.aop.framework.ReflectiveMethodInvocation.proceed",
+    "org.springframework.aop.framework.CglibAopProxy$CglibMethodInvocation.proceed",
+    "org.springframework.transaction.interceptor.TransactionInterceptor$1.proceedWithInvocation",
+    "org.springframework.transaction.interceptor.TransactionAspectSupport.invokeWithinTransaction",
+    "org.springframework.transaction.interceptor.TransactionInterceptor.invoke",
+    "org.springframework.aop.framework.ReflectiveMethodInvocation.proceed",
+    "org.springframework.aop.framework.CglibAopProxy$CglibMethodInvocation.proceed",
+    "org.springframework.aop.framework.CglibAopProxy$DynamicAdvisedInterceptor.intercept",
+    "{cls}$$SpringCGLIB$$0.{method}",
+]
+_REFLECTIVE_CALL = [
+    "java.base/jdk.internal.reflect.DirectMethodHandleAccessor.invoke",
+    "java.base/java.lang.reflect.Method.invoke",
+    "org.springframework.web.method.support.InvocableHandlerMethod.doInvoke",
+    "org.springframework.web.method.support.InvocableHandlerMethod.invokeForRequest",
+    "org.springframework.web.servlet.mvc.method.annotation.ServletInvocableHandlerMethod.invokeAndHandle",
+]
+_REACTOR_OPERATORS = [
+    "reactor.core.publisher.FluxMapFuseable$MapFuseableSubscriber.onNext",
+    "reactor.core.publisher.FluxFilterFuseable$FilterFuseableSubscriber.onNext",
+    "reactor.core.publisher.MonoFlatMap$FlatMapMain.onNext",
+    "reactor.core.publisher.FluxOnErrorResume$ResumeSubscriber.onNext",
+    "reactor.core.publisher.Operators$MonoSubscriber.complete",
+    "reactor.core.publisher.MonoPeekTerminal$MonoTerminalPeekSubscriber.onNext",
+    "reactor.core.publisher.FluxContextWrite$ContextWriteSubscriber.onNext",
+    "reactor.core.publisher.MonoNext$NextSubscriber.onNext",
+    "reactor.netty.channel.FluxReceive.drainReceiver",
+    "reactor.netty.channel.ChannelOperations.onInboundNext",
+    "io.netty.channel.AbstractChannelHandlerContext.invokeChannelRead",
+    "io.netty.handler.codec.MessageToMessageDecoder.channelRead",
+    "io.netty.channel.nio.NioEventLoop.processSelectedKeys",
+    "io.netty.channel.nio.NioEventLoop.run",
+    "io.netty.util.concurrent.SingleThreadEventExecutor$4.run",
+]
+_PYTHON_FRAMES = [
+    ('/srv/app/venv/lib/python3.11/site-packages/starlette/routing.py', 'handle', 'await self.app(scope, receive, send)'),
+    ('/srv/app/venv/lib/python3.11/site-packages/fastapi/routing.py', 'app', 'raw_response = await run_endpoint_function('),
+    ('/srv/app/venv/lib/python3.11/site-packages/sqlalchemy/orm/session.py', 'commit', 'self._transaction.commit()'),
+    ('/srv/app/venv/lib/python3.11/site-packages/sqlalchemy/engine/base.py', '_execute_context', 'self.dialect.do_execute('),
+    ('/srv/app/orders/service.py', 'place_order', 'order = repository.save(order)'),
+    ('/srv/app/orders/repository.py', 'save', 'session.commit()'),
+]
+
+
+class Case(NamedTuple):
+    name: str
+    language: str
+    text: str
+
+
+def java_deep_recursion(rng: random.Random, depth: int = 1024) -> str:
+    cycle = [f"com.acme.tree.Node.visit(Node.java:{rng.randint(10, 300)})",
+             f"com.acme.tree.Node.accept(Node.java:{rng.randint(10, 300)})",
+             f"com.acme.tree.Visitor.visitChildren(Visitor.java:{rng.randint(10, 300)})"]
+    lines = ["java.lang.StackOverflowError"]
+    lines.extend(f"\tat {cycle[i % len(cycle)]}" for i in range(depth))
+    return '\n'.join(lines)
+
+
+def java_single_frame_recursion(rng: random.Random, depth: int = 3000) -> str:
+    # A method calling itself, every frame is the same
+    frame = f"\tat com.acme.tree.Node.depth(Node.java:{rng.randint(10, 300)})"
+    return '\n'.join(["java.lang.StackOverflowError"] + [frame] * depth)
+
+
+def java_framework(rng: random.Random, causes: int = 3, frames: int = 120) -> str:
+    lines = []
+    exceptions = ["org.springframework.dao.DataIntegrityViolationException: could not execute batch",
+                  "org.hibernate.exception.ConstraintViolationException: could not execute batch",
+                  "java.sql.BatchUpdateException: Duplicate entry 'A-1042' for key 'orders.uk_order_number'",
+                  "java.sql.SQLIntegrityConstraintViolationException: Duplicate entry 'A-1042'"]
+    for cause in range(causes + 1):
+        prefix = "Caused by: " if cause else ""
+        lines.append(prefix + exceptions[cause % len(exceptions)])
+        for i in range(frames if cause == 0 else frames // 3):
+            pool = _JAVA_APP_FRAMES if rng.random() < 0.15 else _JAVA_FRAMEWORK_FRAMES
+            lines.append("\tat " + rng.choice(pool).format(n=rng.randint(20, 2000)))
+        if cause:
+            lines.append(f"\t... {rng.randint(20, 90)} more")
+    return '\n'.join(lines)
+
+
+def _java_frame(rng: random.Random, method: str) -> str:
+    cls = method.rsplit('.', 1)[0]
+    if '$$' in method:
+        return f"\tat {method}(<generated>)"
+    return f"\tat {method}({cls.rsplit('.', 1)[-1].split('$')[0]}.java:{rng.randint(20, 2000)})"
+
+
+def java_spring_boot(rng: random.Random, filters: int = 10) -> str:
+    """
+    Exception of a Spring Boot MVC controller calling a transactional service, wrapped by the DispatcherServlet:
+    the frames of Spring, its proxies, reflection and Tomcat around a few application frames.
+    """
+    service = rng.choice(["com.acme.orders.OrderService", "com.acme.billing.InvoiceService"])
+    controller = service.replace('Service', 'Controller')
+    method = rng.choice(["cancel", "place", "refund"])
+    request = list(_SPRING_MVC_REQUEST)
+    for spring_filter in rng.sample(_SPRING_FILTERS, filters):
+        request += [spring_filter, "org.springframework.web.filter.OncePerRequestFilter.doFilter",
+                    "org.apache.catalina.core.ApplicationFilterChain.internalDoFilter",
+                    "org.apache.catalina.core.ApplicationFilterChain.doFilter"]
+    request += _TOMCAT_REQUEST
+    error = f"java.lang.IllegalStateException: {method} not allowed for A-{rng.randint(1000, 9999)}"
+    lines = [f"jakarta.servlet.ServletException: Request processing failed: {error}"]
+    lines += [_java_frame(rng, frame) for frame in request[5:]]
+    lines.append(f"Caused by: {error}")
+    cause = [f"{service}.check{method.title()}", f"{service}.{method}"]
+    cause += [frame.format(cls=service, method=method) for frame in _SPRING_AOP_CALL]
+    cause += [f"{controller}.{method}"] + _REFLECTIVE_CALL + request[:8]
+    lines += [_java_frame(rng, frame) for frame in cause]
+    lines.append(f"\t... {len(request) - 8} more")
+    return '\n'.join(lines)
+
+
+def java_spring_webflux(rng: random.Random, operators: int = 40) -> str:
+    """
+    Exception in a WebFlux handler, the stack is mostly Reactor operators and Netty.
+    """
+    lines = [f"java.lang.IllegalArgumentException: Unknown currency code XQ{rng.randint(1, 9)}",
+             "\tat com.acme.pricing.CurrencyConverter.rate(CurrencyConverter.java:41)",
+             "\tat com.acme.pricing.PriceHandler.lambda$convert$2(PriceHandler.java:77)",
+             "\tSuppressed: reactor.core.publisher.FluxOnAssembly$OnAssemblyException: ",
+             "Error has been observed at the following site(s):",
+             "\t*__checkpoint ⇢ Handler com.acme.pricing.PriceHandler#convert(ServerRequest) [DispatcherHandler]",
+             "Original Stack Trace:",
+             "\t\tat com.acme.pricing.CurrencyConverter.rate(CurrencyConverter.java:41)"]
+    for i in range(operators):
+        lines.append(_java_frame(rng, rng.choice(_REACTOR_OPERATORS[:8])))
+        if i % 13 == 12:
+            lines.append(_java_frame(rng, "com.acme.pricing.PriceHandler.lambda$convert$2"))
+    lines += [_java_frame(rng, frame) for frame in _REACTOR_OPERATORS[8:]]
+    lines.append(_java_frame(rng, "java.base/java.lang.Thread.run"))
+    return '\n'.join(lines)
+
+
+def python_chained(rng: random.Random, chain: int = 3, frames: int = 25) -> str:
+    parts = []
+    errors = ["sqlite3.IntegrityError: UNIQUE constraint failed: orders.number",
+              "sqlalchemy.exc.IntegrityError: (sqlite3.IntegrityError) UNIQUE constraint failed: orders.number",
+              "orders.errors.DuplicateOrder: order A-1042 exists",
+              "fastapi.exceptions.HTTPException: 409: Conflict"]
+    separators = ["The above exception was the direct cause of the following exception:",
+                  "During handling of the above exception, another exception occurred:"]
+    for link in range(chain + 1):
+        if link:
+            parts.append(f"\n{rng.choice(separators)}\n")
+        parts.append("Traceback (most recent call last):")
+        for _ in range(frames):
+            path, function, code = rng.choice(_PYTHON_FRAMES)
+            parts.append(f'  File "{path}", line {rng.randint(10, 3000)}, in {function}\n    {code}')
+        parts.append(errors[link % len(errors)])
+    return '\n'.join(parts)
+
+
+def python_deep_recursion(rng: random.Random, depth: int = 990) -> str:
+    lines = ["Traceback (most recent call last):"]
+    for i in range(depth):
+        lines.append(f'  File "/srv/app/tree.py", line {41 + i % 2}, in walk\n    return walk(node.children[0])')
+    lines.append("RecursionError: maximum recursion depth exceeded")
+    return '\n'.join(lines)
+
+
+def log_prefixed(rng: random.Random, text: str) -> str:
+    pid = rng.randint(1000, 99999)
+    lines = []
+    for i, line in enumerate(text.splitlines()):
+        second = i // 50
+        lines.append(f"Jun 10 16:{second // 60 % 60:02}:{second % 60:02} ip-172-31-6-210.eu-north-1.compute.internal "
+                     f"uvicorn[{pid}]: {line}")
+    return '\n'.join(lines)
+
+
+def to_size(rng: random.Random, generate: Callable[[random.Random], str], size: int) -> str:
+    """
+    :return: tracebacks of generate, joined as causes, until the text is at least size characters
+    """
+    parts = []
+    length = 0
+    while length < size:
+        part = generate(rng)
+        parts.append(part)
+        length += len(part) + 1
+    return '\n'.join(parts)
+
+
+def generate_corpus(seed: int = 42, size: int = 1024 * 1024) -> List[Case]:
+    rng = random.Random(seed)
+    return [
+        Case('java_deep_recursion', 'java', java_deep_recursion(rng)),
+        Case('java_framework', 'java', java_framework(rng)),
+        Case('python_chained', 'python', python_chained(rng)),
+        Case('python_deep_recursion', 'python', python_deep_recursion(rng)),
+        # Only the Python filter strips log prefixes
+        Case('python_chained_log_prefixed', 'python', log_prefixed(rng, python_chained(rng))),
+        Case('java_framework_1mb', 'java', to_size(rng, java_framework, size)),
+        Case('python_chained_1mb', 'python', to_size(rng, python_chained, size)),
+        Case('python_chained_1mb_log_prefixed', 'python', log_prefixed(rng, to_size(rng, python_chained, size))),
+        Case('java_spring_boot', 'java', java_spring_boot(rng)),
+        Case('java_spring_webflux', 'java', java_spring_webflux(rng)),
+        Case('java_single_frame_recursion', 'java', java_single_frame_recursion(rng)),
+    ]
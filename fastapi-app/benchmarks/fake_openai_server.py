@@ -0,0 +1,64 @@
+"""
+Local stand-in for the OpenAI chat completions API, streams a fixed answer so the LLM client can be benchmarked
+offline. Counts the TCP connections it has seen, available at GET /stats.
+Run from the fastapi-app directory:
+    python -m benchmarks.fake_openai_server --port 8081 --first-token-delay 0.05 --token-delay 0.005
+and point the app at it with OPENAI_API_BASE=http://127.0.0.1:8081/v1 (use --ssl-keyfile/--ssl-certfile and an
+https base to include TLS handshakes in the measurements).
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+app = FastAPI()
+settings = {'first_token_delay': 0.05, 'token_delay': 0.005, 'tokens': 50}
+stats = {'requests': 0, 'connections': set()}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats['requests'] += 1
+    stats['connections'].add(request.client)
+    return StreamingResponse(_stream(body), media_type='text/event-stream')
+
+
+@app.get("/stats")
+async def get_stats():
+    return {'requests': stats['requests'], 'connections': len(stats['connections'])}
+
+
+async def _stream(body: dict):
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason=None) -> str:
+        data = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created,
+                'model': body.get('model'), 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+        return f"data: {json.dumps(data)}\n\n"
+
+    await asyncio.sleep(settings['first_token_delay'])
+    yield chunk({'role': 'assistant', 'content': ''})
+    for i in range(settings['tokens']):
+        yield chunk({'content': f" token{i}"})
+        await asyncio.sleep(settings['token_delay'])
+    yield chunk({}, 'stop')
+    yield "data: [DONE]\n\n"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--first-token-delay', type=float, default=settings['first_token_delay'])
+    parser.add_argument('--token-delay', type=float, default=settings['token_delay'])
+    parser.add_argument('--tokens', type=int, default=settings['tokens'])
+    parser.add_argument('--ssl-keyfile')
+    parser.add_argument('--ssl-certfile')
+    args = parser.parse_args()
+    settings.update(first_token_delay=args.first_token_delay, token_delay=args.token_delay, tokens=args.tokens)
+    uvicorn.run(app, port=args.port, log_level='warning', ssl_keyfile=args.ssl_keyfile,
+                ssl_certfile=args.ssl_certfile)
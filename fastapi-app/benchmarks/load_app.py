@@ -0,0 +1,59 @@
+"""
+Runs the app with stand-ins for the external services, for load tests (see benchmarks/load_test.py):
+Cognito and the users table are stubs with configurable latency, JWT keys are those of the given private key,
+and the LLM is the server at OPENAI_API_BASE (e.g. benchmarks/fake_openai_server.py).
+User quotas are not enforced. The answer cache is off unless --answer-cache is given, so every session is answered
+by the LLM instead of replaying the answer of a similar traceback; the load test sends a different traceback in each
+session, so single-flight never coalesces them either. Run from the fastapi-app directory:
+    OPENAI_API_BASE=http://127.0.0.1:8081/v1 python -m benchmarks.load_app --port 9100 --private-key key.pem
+"""
+import argparse
+import os
+import resource
+
+import uvicorn
+
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def create_app(private_key_pem: bytes, cognito_latency: float, db_latency: float, answer_cache: bool = False):
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    import app as app_module
+    import auth
+    import traceback_analyser
+    from identity import IdentityResolver
+    from stubs import StubCognitoClient, StubJwks, StubJwksKeyStore, StubUsersDB
+    from traceback_analyser.answer_cache import AnswerCache
+    from traceback_analyser.quotas import UsageLedger
+
+    # The endpoints and the lifespan look these up as module globals on every call
+    auth.key_store = app_module.key_store = StubJwksKeyStore(StubJwks(private_key_pem).jwks)
+    app_module.identity_resolver = IdentityResolver(StubCognitoClient(cognito_latency),
+                                                    state=traceback_analyser.state_backend)
+    quotas = traceback_analyser.quotas
+    quotas.ledger = UsageLedger(StubUsersDB(db_latency), traceback_analyser.state_backend)
+    quotas.MAX_TOKEN_USAGE = quotas.MAX_REQUESTS = float('inf')
+    if not answer_cache:
+        # Keeps nothing and has no similarity index, every lookup is a miss
+        traceback_analyser.answer_cache = app_module.answer_cache = AnswerCache(maxsize=0)
+    return app_module.app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--private-key', required=True, help="PEM file of the key the test tokens are signed with")
+    parser.add_argument('--cognito-latency', type=float, default=0.05)
+    parser.add_argument('--db-latency', type=float, default=0.01)
+    parser.add_argument('--answer-cache', action='store_true', help="Serve answers from the answer cache")
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+    raise_open_files_limit()
+    with open(args.private_key, 'rb') as file:
+        private_key_pem = file.read()
+    uvicorn.run(create_app(private_key_pem, args.cognito_latency, args.db_latency, args.answer_cache),
+                port=args.port, log_level=args.log_level, backlog=4096)
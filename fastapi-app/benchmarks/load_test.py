@@ -0,0 +1,213 @@
+"""
+Load test of the /ws endpoint: opens many concurrent websocket sessions that each send a token, the language and a
+traceback like the web client, and read the streamed answer until 'completed'.
+By default the app is started with stubs for Cognito, JWKS and the users table (benchmarks/load_app.py) and the
+fake LLM (benchmarks/fake_openai_server.py), to find how many concurrent analyses a worker can serve.
+Reports connect latency, time to first token, tokens/s, completion time percentiles and errors.
+Run from the fastapi-app directory:
+    python -m benchmarks.load_test --sessions 2000 --concurrency 1000 --llm-first-token-delay 0.5 --llm-tokens 200
+Against an app that is already running (its LLM and stubs are up to you), with tokens signed by --private-key:
+    python -m benchmarks.load_test --url ws://127.0.0.1:9100/ws --private-key key.pem
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional
+
+import websockets
+
+from stubs import StubJwks
+
+APP_DIR = Path(__file__).parent.parent
+
+TRACEBACK = """Traceback (most recent call last):
+  File "/srv/app/orders/api.py", line {line}, in create_order
+    order = service.place_order(request)
+  File "/srv/app/orders/service.py", line 88, in place_order
+    repository.save(order)
+  File "/srv/app/orders/repository.py", line 41, in save
+    session.commit()
+sqlalchemy.exc.IntegrityError: UNIQUE constraint failed: orders.number (session {session})"""
+
+
+class SessionResult:
+    def __init__(self):
+        self.connect_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.completion_time: Optional[float] = None
+        self.tokens = 0
+        self.frames = 0
+        self.error: Optional[str] = None
+
+
+async def run_session(url: str, token: str, session: int, flush_ms: int, timeout: float) -> SessionResult:
+    result = SessionResult()
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(url, open_timeout=timeout, max_size=None) as websocket:
+            result.connect_time = time.perf_counter() - start
+            await websocket.send(json.dumps({'token': token, 'flush_ms': flush_ms, 'compact': True}))
+            await websocket.send('python')
+            sent = time.perf_counter()
+            await websocket.send(TRACEBACK.format(line=10 + session % 50, session=session))
+            while True:
+                message = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+                if isinstance(message, list):
+                    message = {'status': message[0], 'stage': message[1], 'message': message[2]}
+                if message['status'] == 'STREAMING_RESPONSE':
+                    if result.first_token_time is None:
+                        result.first_token_time = time.perf_counter() - sent
+                    result.frames += 1
+                    # The tokens of the fake LLM are words
+                    result.tokens += len(message['message'].split())
+                elif message['status'] == 'completed':
+                    result.completion_time = time.perf_counter() - sent
+                    break
+                elif message['status'] == 'error':
+                    result.error = f"error {message.get('status_code')}"
+    except asyncio.TimeoutError:
+        result.error = 'timeout'
+    except websockets.ConnectionClosed as e:
+        result.error = f"closed {e.code}" if result.error is None else result.error
+    except OSError as e:
+        result.error = f"connect {type(e).__name__}"
+    if result.error is not None:
+        result.completion_time = None
+    return result
+
+
+async def run_load(url: str, tokens: List[str], sessions: int, concurrency: int, ramp: float, flush_ms: int,
+                   timeout: float) -> List[SessionResult]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(session: int) -> SessionResult:
+        # Spread the first wave of sessions over the ramp time
+        await asyncio.sleep(ramp * min(session, concurrency) / concurrency)
+        async with semaphore:
+            return await run_session(url, tokens[session % len(tokens)], session, flush_ms, timeout)
+
+    return await asyncio.gather(*(limited(session) for session in range(sessions)))
+
+
+def percentiles(values: List[float]) -> str:
+    if not values:
+        return 'n/a'
+    values = sorted(values)
+    p50 = values[len(values) // 2]
+    p99 = values[min(int(len(values) * 0.99), len(values) - 1)]
+    return f"p50 {p50 * 1000:8.1f} ms  p99 {p99 * 1000:8.1f} ms  max {values[-1] * 1000:8.1f} ms"
+
+
+def report(results: List[SessionResult], elapsed: float):
+    completed = [result for result in results if result.error is None]
+    errors = Counter(result.error for result in results if result.error is not None)
+    tokens = sum(result.tokens for result in completed)
+    print(f"sessions: {len(results)}, completed: {len(completed)}, errors: {len(results) - len(completed)} "
+          f"({(len(results) - len(completed)) / len(results):.1%}) {dict(errors) if errors else ''}")
+    print(f"duration: {elapsed:.1f} s, {len(completed) / elapsed:.1f} analyses/s, {tokens / elapsed:.0f} tokens/s, "
+          f"frames per session: {sum(result.frames for result in completed) / max(len(completed), 1):.1f}")
+    print(f"connect:             {percentiles([r.connect_time for r in results if r.connect_time is not None])}")
+    print(f"time to first token: {percentiles([r.first_token_time for r in completed if r.first_token_time])}")
+    print(f"completion:          {percentiles([r.completion_time for r in completed])}")
+    per_session = [r.tokens / (r.completion_time - r.first_token_time) for r in completed
+                   if r.first_token_time is not None and r.completion_time > r.first_token_time]
+    if per_session:
+        per_session.sort()
+        print(f"tokens/s per session: p50 {per_session[len(per_session) // 2]:.0f}, "
+              f"p1 {per_session[int(len(per_session) * 0.01)]:.0f}")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout} s")
+
+
+def main(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.private_key:
+        jwks = StubJwks(Path(args.private_key).read_bytes())
+    else:
+        jwks = StubJwks()
+    tokens = [jwks.sign_token(f"user-{user}", f"user-{user}@example.com") for user in range(args.users)]
+    random.Random(1).shuffle(tokens)
+
+    processes = []
+    url = args.url
+    try:
+        if url is None:
+            llm_port, app_port = _free_port(), _free_port()
+            key_file = tempfile.NamedTemporaryFile(suffix='.pem', delete=False)
+            key_file.write(jwks.private_key_pem)
+            key_file.close()
+            log = open(args.app_log, 'w') if args.app_log else subprocess.DEVNULL
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'benchmarks.fake_openai_server', '--port', str(llm_port),
+                 '--first-token-delay', str(args.llm_first_token_delay), '--token-delay', str(args.llm_token_delay),
+                 '--tokens', str(args.llm_tokens)], cwd=APP_DIR))
+            env = dict(os.environ, OPENAI_API_BASE=f"http://127.0.0.1:{llm_port}/v1", OPENAI_API_KEY='sk-fake')
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'benchmarks.load_app', '--port', str(app_port), '--private-key', key_file.name,
+                 '--cognito-latency', str(args.cognito_latency), '--db-latency', str(args.db_latency)]
+                + (['--answer-cache'] if args.answer_cache else []),
+                cwd=APP_DIR, env=env, stdout=log, stderr=log))
+            _wait_for_port(llm_port, processes[0])
+            _wait_for_port(app_port, processes[1])
+            os.unlink(key_file.name)
+            url = f"ws://127.0.0.1:{app_port}/ws"
+
+        print(f"{args.sessions} sessions of {args.users} users, {args.concurrency} concurrent, against {url}")
+        start = time.perf_counter()
+        results = asyncio.run(run_load(url, tokens, args.sessions, args.concurrency, args.ramp, args.flush_ms,
+                                       args.timeout))
+        report(results, time.perf_counter() - start)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help="websocket URL of a running app, by default one is started with stubs")
+    parser.add_argument('--private-key', help="PEM file of the key the app accepts tokens of (see stubs.StubJwks)")
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--ramp', type=float, default=2.0, help="Seconds over which the first sessions are opened")
+    parser.add_argument('--flush-ms', type=int, default=30)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--llm-first-token-delay', type=float, default=0.5)
+    parser.add_argument('--llm-token-delay', type=float, default=0.02)
+    parser.add_argument('--llm-tokens', type=int, default=200)
+    parser.add_argument('--cognito-latency', type=float, default=0.05)
+    parser.add_argument('--db-latency', type=float, default=0.01)
+    parser.add_argument('--answer-cache', action='store_true',
+                        help="Let the started app serve answers from its answer cache, off to measure LLM analyses")
+    parser.add_argument('--app-log', help="File for the log of the started app")
+    main(parser.parse_args())
@@ -1,31 +1,60 @@
 import logging
 import os
-import boto3
+import threading
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 region_name = 'eu-north-1'
-dynamodb = boto3.resource('dynamodb', region_name=region_name)
+_dynamodb = None
 
 app_env = os.getenv('APP_ENV', 'dev')  # Default to 'dev' if APP_ENV is not set
 
 
+def get_dynamodb():
+    """
+    The boto3 dynamodb resource, boto3 is imported and the resource created on first use.
+    """
+    global _dynamodb
+    if _dynamodb is None:
+        import boto3
+        _dynamodb = boto3.resource('dynamodb', region_name=region_name)
+    return _dynamodb
+
+
 class UsersDB:
+    """
+    The table is looked up (and created if it does not exist) on first use, constructing a UsersDB makes no calls
+    to AWS so the app can be imported and started without DynamoDB being reachable.
+    """
     table_name = f'Stacktrace_Users_{app_env}'
 
     def __init__(self):
-        self._table = dynamodb.Table(self.table_name)
-        try:
-            self._table.load()
-        except dynamodb.meta.client.exceptions.ResourceNotFoundException:
-            self._create_db()
-        else:
-            logger.info(f"OK, Database exists {self.table_name}")
+        self._table = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Look up the table if not done yet, called by the other methods.
+        """
+        if self._table is not None:
+            return self._table
+        with self._lock:
+            if self._table is None:
+                dynamodb = get_dynamodb()
+                table = dynamodb.Table(self.table_name)
+                try:
+                    table.load()
+                except dynamodb.meta.client.exceptions.ResourceNotFoundException:
+                    table = self._create_db()
+                else:
+                    logger.info(f"OK, Database exists {self.table_name}")
+                self._table = table
+        return self._table
 
     def _create_db(self):
         logger.info(f"Creating database {self.table_name}")
-        self._table = dynamodb.create_table(
+        return get_dynamodb().create_table(
             TableName=self.table_name,
             KeySchema=[
                 {
@@ -46,7 +75,8 @@ class UsersDB:
         )
 
     def get_or_create_user(self, email: str):
-        response = self._table.get_item(
+        table = self.connect()
+        response = table.get_item(
             Key={
                 'email': email
             }
@@ -54,7 +84,7 @@ class UsersDB:
 
         if 'Item' not in response:
             logger.info(f'User with email {email} not found, creating...')
-            self._table.put_item(
+            table.put_item(
                 Item={
                     'email': email,
                     'requests_count': 0,
@@ -71,7 +101,7 @@ class UsersDB:
             return response['Item']
 
     def add_usage(self, email: str, token_usage: int, requests: int = 1):
-        response = self._table.update_item(
+        response = self.connect().update_item(
             Key={
                 'email': email
             },
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MessageFramer:
+    """
+    Coalesces the streamed response tokens into fewer websocket frames.
+
+    Consecutive STREAMING_RESPONSE messages are concatenated and sent as one frame flush_ms after the first of
+    them, or as soon as max_bytes of UTF-8 text are pending. Other messages are sent right away, after anything
+    pending, so the order of messages is kept. flush_ms 0 sends every message as its own frame.
+
+    A frame is the JSON object {"status", "stage", "message"}, or with compact the JSON array
+    [status, stage, message].
+    """
+    # Clients that don't ask for framing, like older web builds, get every message as its own frame as before
+    DEFAULT_FLUSH_MS = 0
+    MAX_FLUSH_MS = 1000
+    MAX_BYTES = 4096
+    STREAMING_STATUS = 'STREAMING_RESPONSE'
+
+    def __init__(self, send_text: Callable[[str], Awaitable], flush_ms: int = DEFAULT_FLUSH_MS,
+                 max_bytes: int = MAX_BYTES, compact: bool = False):
+        """
+        :param send_text: Sends a text frame, e.g. WebSocket.send_text
+        :param flush_ms: Asked for by the client, limited to 0..MAX_FLUSH_MS
+        """
+        self.flush_ms = min(max(int(flush_ms), 0), self.MAX_FLUSH_MS)
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self.frames = 0
+        self._send_text = send_text
+        self._pending = []
+        self._pending_size = 0
+        self._pending_stage = None
+        self._timer = None
+        self._send_lock = asyncio.Lock()
+
+    @classmethod
+    def negotiate(cls, send_text: Callable[[str], Awaitable], request: dict) -> 'MessageFramer':
+        """
+        Create a framer with the settings asked for in the first message from the client: flush_ms and compact.
+        Without flush_ms, or with an invalid one, messages are not coalesced.
+        """
+        try:
+            flush_ms = int(request.get('flush_ms', cls.DEFAULT_FLUSH_MS))
+        except (TypeError, ValueError):
+            flush_ms = cls.DEFAULT_FLUSH_MS
+        return cls(send_text, flush_ms=flush_ms, compact=request.get('compact') is True)
+
+    async def send(self, status: str, stage: str, message: str):
+        if status != self.STREAMING_STATUS or self.flush_ms == 0:
+            await self.flush()
+            await self._send_frame(status, stage, message)
+            return
+        if self._pending and stage != self._pending_stage:
+            await self.flush()
+        self._pending.append(message)
+        self._pending_size += len(message.encode())
+        self._pending_stage = stage
+        if self._pending_size >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """
+        Send the pending tokens now, call before sending anything on the websocket without the framer.
+        """
+        if self._timer is not None:
+            # The timer is only set while sleeping, so this never cancels a send in progress
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            message = ''.join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            await self._send_frame(self.STREAMING_STATUS, self._pending_stage, message)
+
+    def cancel(self):
+        """
+        Drop pending tokens, e.g. when the websocket has been disconnected.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = []
+        self._pending_size = 0
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_ms / 1000)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # The next send or flush fails the same way, in the request handler
+            logger.info(f"Failed to send frame: {e}")
+
+    async def _send_frame(self, status: str, stage: str, message: str):
+        if self.compact:
+            data = json.dumps([status, stage, message], separators=(',', ':'))
+        else:
+            data = json.dumps({'status': status, 'stage': stage, 'message': message})
+        # Frames sent by the timer and by send must not interleave
+        async with self._send_lock:
+            await self._send_text(data)
+        self.frames += 1
@@ -0,0 +1,42 @@
+"""
+Multi worker launch of the app, run from the fastapi-app directory:
+    gunicorn app:app
+
+The app is imported once in the master (preload_app) and the workers are forked from it, so the imports, the
+token encodings and the LLM libraries loaded in when_ready are shared by the workers instead of loaded by each.
+Nothing that holds a connection (AWS clients, HTTP and Redis sessions, SQLite) is created before the fork, they
+are all created by the workers on first use.
+
+With more than one worker the state (cached identities, quota counters, answers) must be shared, set
+STATE_BACKEND_URL to a Redis server, e.g. redis://127.0.0.1:6379/0. Without it a single worker is started.
+Settings can be overridden with the usual gunicorn environment variables and options, e.g. WEB_CONCURRENCY.
+"""
+import logging
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger('gunicorn.error')
+
+_shared_state = bool(os.getenv('STATE_BACKEND_URL'))
+
+bind = os.getenv('BIND', '127.0.0.1:9000')
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() if _shared_state else 1))
+preload_app = True
+# Analyses stream for up to the LLM request timeout, give them time to finish on restart
+graceful_timeout = 90
+timeout = 120
+keepalive = 75
+
+
+def when_ready(server):
+    # Runs in the master after the app has been imported and before the workers are forked
+    if workers > 1 and not _shared_state:
+        logger.warning(f"{workers} workers without STATE_BACKEND_URL, quotas and caches are not shared")
+    from traceback_analyser import load_llm_stack, preload_token_counters
+    preload_token_counters()
+    load_llm_stack()
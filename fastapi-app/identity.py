@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+
+from metrics import stage_seconds
+from state import LocalState, StateBackend
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class IdentityResolver:
+    """
+    Resolves an access token to the user attributes of the Cognito user.
+
+    Cognito is called from a bounded thread pool so the event loop never blocks on it, concurrent lookups of
+    the same token share one Cognito call, and the result is cached by a hash of the token in the state backend,
+    so with a shared backend a token resolved by one worker is known to all of them.
+    If trust_jwt_email is set and the (already verified) JWT claims contain an email, no Cognito call is made.
+    The Cognito client can be given as a factory, then it is created on first use instead of at startup.
+    """
+    CACHE_SIZE = 10000
+    CACHE_TTL = 300
+    MAX_WORKERS = 8
+
+    def __init__(self, cognito_client=None, max_workers: int = MAX_WORKERS, trust_jwt_email: bool = False,
+                 state: Optional[StateBackend] = None, cognito_client_factory: Optional[Callable[[], Any]] = None):
+        assert cognito_client is not None or cognito_client_factory is not None
+        self._cognito_client = cognito_client
+        self._cognito_client_factory = cognito_client_factory
+        self._client_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cognito')
+        self._trust_jwt_email = trust_jwt_email
+        self._state = state if state is not None else LocalState(maxsize=self.CACHE_SIZE)
+        self._inflight = {}
+
+    async def resolve(self, access_token: str, claims: Optional[dict] = None) -> dict:
+        """
+        :param access_token: Cognito access token
+        :param claims: Verified claims of the token, used instead of Cognito if trust_jwt_email is set
+        :return: dict of user attributes
+        :raises HTTPException: 403 if Cognito does not accept the token
+        """
+        if self._trust_jwt_email and claims and claims.get('email'):
+            return {'sub': claims.get('sub'), 'email': claims['email']}
+
+        key = _token_key(access_token)
+        user_info = await self._state.get(key)
+        if user_info is not None:
+            return user_info
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self._get_user, access_token)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        user_info = await asyncio.shield(future)
+        await self._state.set(key, user_info, self.CACHE_TTL)
+        return user_info
+
+    @property
+    def cognito_client(self):
+        if self._cognito_client is None:
+            with self._client_lock:
+                if self._cognito_client is None:
+                    self._cognito_client = self._cognito_client_factory()
+        return self._cognito_client
+
+    async def sign_out(self, access_token: str) -> dict:
+        await self._state.delete(_token_key(access_token))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._global_sign_out, access_token)
+
+    def _get_user(self, access_token: str) -> dict:
+        logger.info("Getting user info for token from cognito")
+        try:
+            with stage_seconds.time('cognito_lookup'):
+                response = self.cognito_client.get_user(AccessToken=access_token)
+        except ClientError as e:
+            _raise_if_not_authorized(e)
+            raise
+        logger.debug(response['UserAttributes'])
+        # covert list of Name:Value objects to dict
+        return {item['Name']: item['Value'] for item in response['UserAttributes']}
+
+    def _global_sign_out(self, access_token: str) -> dict:
+        try:
+            return self.cognito_client.global_sign_out(AccessToken=access_token)
+        except ClientError as e:
+            _raise_if_not_authorized(e)
+            raise
+
+
+def _token_key(access_token: str) -> str:
+    return f"identity:{hashlib.sha256(access_token.encode()).hexdigest()}"
+
+
+def _raise_if_not_authorized(e: ClientError):
+    if e.response.get('Error', {}).get('Code') == 'NotAuthorizedException':
+        logger.info(f"Cognito did not accept token: {e}")
+        raise HTTPException(status_code=403, detail="NotAuthorizedException - Invalid Access Token")
@@ -0,0 +1,21 @@
+import logging
+import os
+import random
+
+# Tracebacks can be megabytes, they are only logged if LOG_PAYLOADS is set, and then only a sample of them
+LOG_PAYLOADS = os.getenv('LOG_PAYLOADS') == 'true'
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0.01'))
+PAYLOAD_LOG_MAX_CHARS = 4096
+
+
+def log_payload(logger: logging.Logger, message: str, payload: str):
+    """
+    Log the message with the payload if payload logging is on and the payload is in the sample.
+    Otherwise the cost is a single check, the log line is not formatted.
+    :param payload: Logged up to PAYLOAD_LOG_MAX_CHARS characters
+    """
+    if not LOG_PAYLOADS or random.random() >= PAYLOAD_LOG_SAMPLE_RATE:
+        return
+    if len(payload) > PAYLOAD_LOG_MAX_CHARS:
+        payload = f"{payload[:PAYLOAD_LOG_MAX_CHARS]}... ({len(payload)} characters)"
+    logger.info(f"{message}: {payload}")
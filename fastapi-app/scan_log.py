@@ -0,0 +1,98 @@
+"""
+Find all tracebacks in a log file, group them by fingerprint and analyse one of each group.
+The log is streamed, memory use does not grow with its size.
+Run from the fastapi-app directory:
+    python scan_log.py /var/log/app.log --top 20 --concurrency 4
+    journalctl -u stack-ai-app.service | python scan_log.py - --no-analyse
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from dotenv import load_dotenv
+
+from traceback_analyser import prepare_trace
+from traceback_analyser.log_scan import LogScanner, TracebackGroup, read_lines
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def analyse_groups(groups: list[TracebackGroup], concurrency: int) -> dict:
+    """
+    Analyse the representative of each group, at most concurrency at a time.
+    The analyser is called directly with the OPENAI_API_KEY of the environment, there are no user quotas.
+    :return: dict of fingerprint to answer or error message
+    """
+    from traceback_analyser import llm_pool, load_llm_stack
+
+    await asyncio.to_thread(load_llm_stack)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def analyse(group: TracebackGroup):
+        async with semaphore:
+            try:
+                prepared = await asyncio.to_thread(prepare_trace, group.language, group.trace, 0.5, 2)
+                answer = []
+                async for token in prepared.analyser.send_to_openai_chat(
+                        prepared.compressed.trace, input_token_count=prepared.compressed.input_token_count):
+                    answer.append(token)
+                return group.fingerprint, ''.join(answer)
+            except Exception as e:
+                logger.warning(f"Failed to analyse traceback {group.fingerprint}: {e}")
+                return group.fingerprint, f"Analysis failed: {e}"
+
+    try:
+        return dict(await asyncio.gather(*(analyse(group) for group in groups)))
+    finally:
+        await llm_pool.close()
+
+
+def print_report(scanner: LogScanner, groups: list[TracebackGroup], answers: dict, as_json: bool):
+    for group in groups:
+        if as_json:
+            print(json.dumps({'fingerprint': group.fingerprint, 'language': group.language, 'count': group.count,
+                              'first_line': group.first_line_no, 'last_line': group.last_line_no,
+                              'trace': group.trace, 'analysis': answers.get(group.fingerprint)}))
+            continue
+        print('=' * 120)
+        print(f"{group.count} x {group.language} traceback {group.fingerprint}, "
+              f"lines {group.first_line_no}..{group.last_line_no}")
+        print('-' * 120)
+        print(group.trace)
+        if group.fingerprint in answers:
+            print('-' * 120)
+            print(answers[group.fingerprint])
+    if not as_json:
+        print('=' * 120)
+        print(f"{scanner.lines} lines, {scanner.tracebacks} tracebacks, {len(scanner.groups)} distinct"
+              + (f", {scanner.dropped} not grouped (more than {scanner.max_groups} distinct)" if scanner.dropped else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="Log file, .gz files are decompressed, - for stdin")
+    parser.add_argument('--top', type=int, default=20, help="Number of groups, most occurrences first, to report")
+    parser.add_argument('--concurrency', type=int, default=4, help="Analyses running at the same time")
+    parser.add_argument('--no-analyse', action='store_true', help="Only find and group the tracebacks")
+    parser.add_argument('--json', action='store_true', help="Print a JSON object per group")
+    parser.add_argument('--max-groups', type=int, default=LogScanner.MAX_GROUPS)
+    parser.add_argument('--max-lines', type=int, default=LogScanner.MAX_LINES, help="Lines kept per traceback")
+    args = parser.parse_args()
+    load_dotenv()
+
+    scanner = LogScanner(args.max_groups, args.max_lines)
+    start = time.perf_counter()
+    scanner.scan(read_lines(args.path))
+    logger.info(f"Scanned {scanner.lines} lines in {time.perf_counter() - start:.2f} s, "
+                f"found {scanner.tracebacks} tracebacks in {len(scanner.groups)} groups")
+
+    groups = scanner.top(args.top)
+    answers = {} if args.no_analyse or not groups else asyncio.run(analyse_groups(groups, args.concurrency))
+    print_report(scanner, groups, answers, args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+from cache import LruTtlCache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(ABC):
+    """
+    Key value store for the state that must be the same in every worker process: cached identities, usage
+    counters and answers. Values are JSON serializable, counters are dicts of ints updated atomically.
+
+    LocalState keeps the state in the process, RedisState in a Redis server shared by the workers.
+    """
+    # True if the state is seen by every worker
+    shared = False
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def get_counters(self, key: str) -> Optional[Dict[str, int]]:
+        ...
+
+    @abstractmethod
+    async def init_counters(self, key: str, values: Dict[str, int], ttl: float) -> Dict[str, int]:
+        """
+        Set the counters unless they exist already.
+        :return: the counters as they are after the call
+        """
+        ...
+
+    @abstractmethod
+    async def incr_counters(self, key: str, deltas: Dict[str, int], ttl: float) -> Optional[Dict[str, int]]:
+        """
+        Add deltas to the counters if they exist, and make them expire ttl seconds from now.
+        :return: the counters after the increment, or None if they don't exist
+        """
+        ...
+
+    async def close(self):
+        pass
+
+
+class LocalState(StateBackend):
+    """
+    State in an LRU of the process, for a single worker. Updates are atomic as they never await.
+    """
+    MAX_ENTRIES = 100000
+
+    def __init__(self, maxsize: int = MAX_ENTRIES):
+        # ttl of the cache is a default, every entry is set with its own ttl
+        self._data = LruTtlCache(maxsize=maxsize, ttl=3600)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self._data.get(key)
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self._data.set(key, value, ttl)
+
+    async def delete(self, key: str):
+        self._data.pop(key)
+
+    async def get_counters(self, key: str) -> Optional[Dict[str, int]]:
+        counters = self._data.get(key)
+        return dict(counters) if counters is not None else None
+
+    async def init_counters(self, key: str, values: Dict[str, int], ttl: float) -> Dict[str, int]:
+        counters = self._data.get(key)
+        if counters is None:
+            counters = dict(values)
+            self._data.set(key, counters, ttl)
+        return dict(counters)
+
+    async def incr_counters(self, key: str, deltas: Dict[str, int], ttl: float) -> Optional[Dict[str, int]]:
+        counters = self._data.get(key)
+        if counters is None:
+            return None
+        counters = {name: value + deltas.get(name, 0) for name, value in counters.items()}
+        self._data.set(key, counters, ttl)
+        return dict(counters)
+
+
+class RedisState(StateBackend):
+    """
+    State in a Redis server (or anything speaking its protocol), shared by all workers on all hosts using it.
+    Counters are Redis hashes, updated with Lua scripts so checking for existence and updating is atomic.
+    The connection pool is created on first use, so the backend can be created before the workers are forked.
+    """
+    shared = True
+    KEY_PREFIX = 'stackai:'
+
+    _INIT_COUNTERS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+    _INCR_COUNTERS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[1])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+    def __init__(self, url: str, key_prefix: str = KEY_PREFIX):
+        self.url = url
+        self.key_prefix = key_prefix
+        self._redis = None
+        self._init_counters = None
+        self._incr_counters = None
+
+    def _connect(self):
+        if self._redis is None:
+            # Optional dependency, only needed when the state is shared
+            import redis.asyncio
+            self._redis = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+            self._init_counters = self._redis.register_script(self._INIT_COUNTERS)
+            self._incr_counters = self._redis.register_script(self._INCR_COUNTERS)
+        return self._redis
+
+    async def get(self, key: str) -> Optional[Any]:
+        data = await self._connect().get(self.key_prefix + key)
+        return json.loads(data) if data is not None else None
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await self._connect().set(self.key_prefix + key, json.dumps(value), px=_millis(ttl))
+
+    async def delete(self, key: str):
+        await self._connect().delete(self.key_prefix + key)
+
+    async def get_counters(self, key: str) -> Optional[Dict[str, int]]:
+        counters = await self._connect().hgetall(self.key_prefix + key)
+        return {name: int(value) for name, value in counters.items()} if counters else None
+
+    async def init_counters(self, key: str, values: Dict[str, int], ttl: float) -> Dict[str, int]:
+        self._connect()
+        result = await self._init_counters(keys=[self.key_prefix + key], args=[_millis(ttl), *_flatten(values)])
+        return _counters(result)
+
+    async def incr_counters(self, key: str, deltas: Dict[str, int], ttl: float) -> Optional[Dict[str, int]]:
+        self._connect()
+        result = await self._incr_counters(keys=[self.key_prefix + key], args=[_millis(ttl), *_flatten(deltas)])
+        return _counters(result) if result else None
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+
+def create_state_backend(url: Optional[str]) -> StateBackend:
+    """
+    :param url: redis:// (or rediss://, unix://) URL of a shared store, None for state local to the process
+    """
+    if not url:
+        return LocalState()
+    logger.info(f"Using shared state backend {url.split('@')[-1]}")
+    return RedisState(url)
+
+
+def _millis(ttl: float) -> int:
+    return max(int(ttl * 1000), 1)
+
+
+def _flatten(values: Dict[str, int]) -> list:
+    return [item for name, value in values.items() for item in (name, int(value))]
+
+
+def _counters(result: list) -> Dict[str, int]:
+    return {result[i]: int(result[i + 1]) for i in range(0, len(result), 2)}
@@ -0,0 +1,128 @@
+"""
+Stand-ins for the external services, used to run and benchmark the app offline.
+"""
+import base64
+import hashlib
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from auth import JwksKeyStore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class StubCognitoClient:
+    """
+    Mimics the parts of the boto3 cognito-idp client used by the app.
+    Every token is a valid user (with an email derived from the token) unless it starts with 'invalid',
+    each call sleeps latency seconds to simulate the round trip to AWS.
+    """
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.get_user_calls = 0
+
+    def get_user(self, AccessToken: str) -> dict:
+        self.get_user_calls += 1
+        time.sleep(self.latency)
+        self._check_token(AccessToken, 'GetUser')
+        user_id = hashlib.sha256(AccessToken.encode()).hexdigest()[:12]
+        return {
+            'Username': user_id,
+            'UserAttributes': [
+                {'Name': 'sub', 'Value': user_id},
+                {'Name': 'email', 'Value': f"{user_id}@example.com"},
+            ],
+        }
+
+    def global_sign_out(self, AccessToken: str) -> dict:
+        time.sleep(self.latency)
+        self._check_token(AccessToken, 'GlobalSignOut')
+        return {}
+
+    @staticmethod
+    def _check_token(token: str, operation_name: str):
+        if token.startswith('invalid'):
+            raise ClientError({'Error': {'Code': 'NotAuthorizedException', 'Message': 'Invalid Access Token'}},
+                              operation_name)
+
+
+class StubJwks:
+    """
+    An RSA key pair with its JSON Web Key Set, to sign tokens the app accepts when its key store is a
+    StubJwksKeyStore of the same key set. The private key can be saved so the tokens can be signed by another
+    process, e.g. a load generator.
+    """
+    KID = 'stub-key'
+
+    def __init__(self, private_key_pem: bytes = None):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        if private_key_pem is None:
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            private_key_pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                        serialization.NoEncryption())
+        else:
+            private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+        self.private_key_pem = private_key_pem
+        numbers = private_key.public_key().public_numbers()
+        self.jwks = {'keys': [{'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': self.KID,
+                               'n': _base64url_uint(numbers.n), 'e': _base64url_uint(numbers.e)}]}
+
+    def sign_token(self, sub: str, email: str = None, ttl: float = 3600) -> str:
+        from jose import jwt
+
+        claims = {'sub': sub, 'token_use': 'access', 'exp': int(time.time() + ttl)}
+        if email:
+            claims['email'] = email
+        return jwt.encode(claims, self.private_key_pem.decode(), algorithm='RS256', headers={'kid': self.KID})
+
+
+class StubJwksKeyStore(JwksKeyStore):
+    """
+    Key store serving the keys of a StubJwks instead of fetching them from Cognito.
+    """
+
+    def __init__(self, jwks: dict):
+        super().__init__('stub://jwks')
+        self._jwks = jwks
+
+    def fetch_jwks(self) -> dict:
+        return self._jwks
+
+
+class StubUsersDB:
+    """
+    In memory stand-in for db.UsersDB, each call sleeps latency seconds to simulate the round trip to DynamoDB.
+    """
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def connect(self):
+        return self
+
+    def get_or_create_user(self, email: str) -> dict:
+        time.sleep(self.latency)
+        with self._lock:
+            return dict(self._users.setdefault(email, {'email': email, 'requests_count': 0, 'token_usage': 0}))
+
+    def add_usage(self, email: str, token_usage: int, requests: int = 1) -> dict:
+        time.sleep(self.latency)
+        with self._lock:
+            user = self._users.setdefault(email, {'email': email, 'requests_count': 0, 'token_usage': 0})
+            user['requests_count'] += requests
+            user['token_usage'] += token_usage
+            return {'Attributes': {'requests_count': user['requests_count'], 'token_usage': user['token_usage']}}
+
+
+def _base64url_uint(value: int) -> str:
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
@@ -0,0 +1,29 @@
+"""
+Run from the fastapi-app directory: python -m pytest tests
+"""
+import time
+
+from traceback_analyser.process_tb import FilterTracebackJava, compress_cycles
+
+
+def test_single_frame_recursion_is_collapsed_in_linear_time():
+    frames = [['at a.B.rec(B.java)']] * 100000
+    start = time.perf_counter()
+    out = compress_cycles(frames)
+    elapsed = time.perf_counter() - start
+    assert out == [['at a.B.rec(B.java)'], ['[frame repeated 100000 times]']]
+    assert elapsed < 1.0
+
+
+def test_stack_overflow_error_is_collapsed():
+    traceback = '\n'.join(['java.lang.StackOverflowError'] + ['\tat a.B.rec(B.java:12)'] * 3000)
+    start = time.perf_counter()
+    lines = FilterTracebackJava().filter(traceback).splitlines()
+    assert time.perf_counter() - start < 1.0
+    assert lines[-1] == '[frame repeated 3000 times]'
+
+
+def test_cycles_of_several_frames_and_short_runs():
+    frames = [[frame] for frame in 'ABCABCABCDAAB']
+    assert compress_cycles(frames) == [['A'], ['B'], ['C'], ['[frames 1..3 repeated 3 times]'], ['D'], ['A'], ['A'],
+                                       ['B']]
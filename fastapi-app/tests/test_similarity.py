@@ -0,0 +1,19 @@
+import random
+
+from Levenshtein import ratio
+
+from traceback_analyser.process_tb import _is_similar
+
+
+def _is_similar_baseline(a: str, b: str, similarity_threshold: float) -> bool:
+    return ratio(a, b) > similarity_threshold
+
+
+def test_is_similar_matches_plain_ratio():
+    rng = random.Random(6)
+    thresholds = [0.0, 0.3, 0.5, 0.6, 0.7, 0.9, 1.0]
+    for _ in range(20000):
+        a = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 12)))
+        b = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 12)))
+        threshold = rng.choice(thresholds)
+        assert _is_similar(a, b, threshold) == _is_similar_baseline(a, b, threshold), (a, b, threshold)
@@ -1,12 +1,25 @@
 import asyncio
 import logging
-from typing import AsyncGenerator
+import os
+from typing import AsyncGenerator, List, NamedTuple, Tuple
 
-from pydantic import BaseModel
+from metrics import registry
+from state import create_state_backend
 
-from .analyser import Analyser, AnalyserJava, AnalyserPython
+from .analyser import Analyser, AnalyserJava, AnalyserPython, load_llm_stack
+from .answer_cache import AnswerCache
+from .batch import BatchEntry, BatchItem, group_duplicates
+from .compression import CompressedTraceback, CompressionPlanner
 from .exceptions import AnalyzeException
-from .process_tb import FilterTracebackJava, FilterTracebackPython
+from .filter_pool import FilterPool
+from .llm_pool import llm_pool
+from .process_tb import (JAVA_FRAMEWORK_RULES, FilterTraceback, FilterTracebackJava, FilterTracebackPython, FoldRule,
+                         FrameFolder)
+from .scheduler import FairScheduler
+from .sessions import AnalysisSession, Message, SessionStore
+from .single_flight import SingleFlight
+from .similarity_index import NearDuplicateIndex
+from . import tokens
 
 from .quotas import Quotas
 
@@ -14,15 +27,125 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DETAILED_RESPONSES = False
+# Tokens charged to the user quota when the answer is served from the answer cache
+CACHE_HIT_TOKEN_CHARGE = 0
+# Serve the answer of a previously analysed traceback that is at least this similar, None to disable
+NEAR_DUPLICATE_THRESHOLD = 0.9
+# Maximum number of tracebacks of one batch analysed at the same time
+BATCH_MAX_PARALLEL = 4
 
 
-class Message(BaseModel):
-    status: str
-    stage: str
-    message: str
+# Shared by the workers if STATE_BACKEND_URL is set, see gunicorn.conf.py
+state_backend = create_state_backend(os.getenv('STATE_BACKEND_URL'))
+quotas = Quotas(state=state_backend)
+compression_planner = CompressionPlanner()
+llm_scheduler = FairScheduler(
+    max_concurrent=int(os.getenv('LLM_MAX_CONCURRENCY', FairScheduler.MAX_CONCURRENT)),
+    queue_timeout=float(os.getenv('LLM_QUEUE_TIMEOUT', FairScheduler.QUEUE_TIMEOUT)))
 
 
-quotas = Quotas()
+def _java_fold_rules() -> List[FoldRule]:
+    """
+    :return: the default rules and a prefix rule per package of the comma separated JAVA_FOLD_PACKAGES, or no rules
+        if JAVA_FOLD_FRAMES is not 'true'
+    """
+    if os.getenv('JAVA_FOLD_FRAMES', 'true') != 'true':
+        return []
+    packages = [package.strip() for package in os.getenv('JAVA_FOLD_PACKAGES', '').split(',')]
+    return JAVA_FRAMEWORK_RULES + [FoldRule.prefix(package) for package in packages if package]
+
+
+# Runs of framework frames in Java tracebacks are folded into a summary line
+java_frame_folder = FrameFolder(_java_fold_rules())
+
+answer_cache = AnswerCache(
+    db_path=os.getenv('ANSWER_CACHE_DB'),
+    similarity_index=NearDuplicateIndex(NEAR_DUPLICATE_THRESHOLD) if NEAR_DUPLICATE_THRESHOLD else None,
+    state=state_backend)
+registry.callback('stackai_answer_cache_lookups_total', "Answer cache lookups, by result", 'counter',
+                  lambda: {'hit': answer_cache.hits - answer_cache.near_duplicate_hits,
+                           'near_duplicate_hit': answer_cache.near_duplicate_hits,
+                           'miss': answer_cache.misses}, 'result')
+registry.callback('stackai_llm_running', "Analyses running", 'gauge', lambda: llm_scheduler.stats()['running'])
+registry.callback('stackai_llm_queued', "Analyses waiting in the queue", 'gauge', lambda: llm_scheduler.stats()['queued'])
+
+# Requests for an analysis already running follow it, see SingleFlight for the charge policies
+single_flight = SingleFlight(charge_policy=os.getenv('SHARED_ANALYSIS_CHARGE', SingleFlight.CHARGE_POLICY),
+                             follower_charge=CACHE_HIT_TOKEN_CHARGE)
+registry.callback('stackai_coalesced_analyses_total', "Analyses served by following an identical analysis in progress",
+                  'counter', lambda: single_flight.followers)
+
+# Websocket analyses run in sessions that survive a dropped connection, see SessionStore
+analysis_sessions = SessionStore(
+    ttl=float(os.getenv('ANALYSIS_SESSION_TTL', SessionStore.TTL)),
+    max_sessions=int(os.getenv('ANALYSIS_SESSION_MAX', SessionStore.MAX_SESSIONS)),
+    max_session_chars=int(os.getenv('ANALYSIS_SESSION_MAX_CHARS', SessionStore.MAX_SESSION_CHARS)),
+    state=state_backend)
+registry.callback('stackai_analysis_sessions', "Analysis sessions, by state", 'gauge',
+                  lambda: {state: count for state, count in analysis_sessions.stats().items()
+                           if state in ('running', 'detached')}, 'state')
+
+
+def preload_token_counters():
+    """
+    Load the token encodings of the analysers, meant to be called at startup
+    """
+    tokens.preload(analyser.MODEL_NAME for analyser in (Analyser, AnalyserJava, AnalyserPython))
+
+
+def warm_up():
+    """
+    Load everything that is otherwise loaded by the first request: token encodings, langchain, the users
+    database table and the chat models. Meant to be run in a thread once the app has started.
+    """
+    preload_token_counters()
+    filter_pool.start()
+    load_llm_stack()
+    quotas.ledger.connect()
+    for analyser in (Analyser, AnalyserJava, AnalyserPython):
+        llm_pool.chat(analyser.MODEL_NAME, analyser.REQUEST_TIMEOUT, analyser.OUTPUT_MAX_TOKENS)
+
+
+class PreparedTrace(NamedTuple):
+    language: str
+    tb_filter: FilterTracebackJava
+    analyser: Analyser
+    compressed: CompressedTraceback
+
+
+def traceback_filter(language: str) -> FilterTraceback:
+    """
+    :return: the filter of the language, the Java one for other languages
+    """
+    if language.lower() == 'python':
+        return FilterTracebackPython()
+    return FilterTracebackJava(java_frame_folder)
+
+
+def prepare_trace(language: str, trace: str, threshold: float, max_similar_lines: int) -> PreparedTrace:
+    """
+    Filter the traceback with the filter of the language, with stronger reductions if needed to fit the input token
+    limit of the analyser.
+    """
+    tb_filter = traceback_filter(language)
+    if language.lower() == 'java':
+        analyser = AnalyserJava()
+    elif language.lower() == 'python':
+        analyser = AnalyserPython()
+    else:
+        # Generic
+        analyser = Analyser()
+    compressed = compression_planner.fit(tb_filter, analyser, trace, threshold, max_similar_lines)
+    return PreparedTrace(language, tb_filter, analyser, compressed)
+
+
+# Large tracebacks are filtered in other processes, see FilterPool
+filter_pool = FilterPool(
+    prepare_trace,
+    workers=int(os.getenv('FILTER_WORKERS', FilterPool.WORKERS)),
+    inline_max_chars=int(os.getenv('FILTER_INLINE_MAX_CHARS', FilterPool.INLINE_MAX_CHARS)),
+    max_input_chars=int(os.getenv('FILTER_MAX_INPUT_CHARS', FilterPool.MAX_INPUT_CHARS)),
+    cpu_time_limit=float(os.getenv('FILTER_CPU_TIME_LIMIT', FilterPool.CPU_TIME_LIMIT)))
 
 
 async def analyze(
@@ -38,39 +161,175 @@ async def analyze(
     This is to reduce the amount sent to for analysis.
     """
     logger.debug("analyze...")
-    quotas.check(user_info)
+    await quotas.check(user_info)
 
     status = "RUNNING"
     if DETAILED_RESPONSES:
         yield Message(status=status, stage="STACKTRACE_FILTERING", message="Filtering traceback...")
         await asyncio.sleep(0)
-    if language.lower() == 'java':
-        tb_filter = FilterTracebackJava()
-        analyser = AnalyserJava()
-    elif language.lower() == 'python':
-        tb_filter = FilterTracebackPython()
-        analyser = AnalyserPython()
-    else:
-        tb_filter = FilterTracebackJava()
-        # Generic
-        analyser = Analyser()
-
 
-    processed_trace = tb_filter.filter(trace, similarity_threshold=threshold,
-                                                   max_similar_lines=max_similar_lines)
+    prepared = await filter_pool.prepare(language, trace, threshold, max_similar_lines)
+    compressed = prepared.compressed
+    if compressed.reductions:
+        yield Message(status=status, stage="STACKTRACE_COMPRESSED",
+                      message=f"The traceback was too large and has been compressed: {', '.join(compressed.reductions)}")
+        await asyncio.sleep(0)
 
     if DETAILED_RESPONSES:
-        yield Message(status=status, stage="STACKTRACE_FILTRED", message=processed_trace)
+        yield Message(status=status, stage="STACKTRACE_FILTRED", message=compressed.trace)
         await asyncio.sleep(0)
         yield Message(status=status, stage="ANAYLSIS_RUNNING", message="Analyzing...")
         await asyncio.sleep(0)
 
-    logger.debug("Sending chat prompt and streaming response...")
+    async for message in analyze_prepared(user_info, prepared, temprature):
+        yield message
 
-    async for response in analyser.send_to_openai_chat(processed_trace, temprature=temprature):
-        yield Message(status="STREAMING_RESPONSE", stage="ANAYLSIS_RUNNING", message=response)
 
-    await asyncio.sleep(0)
+def answer_key(prepared: PreparedTrace, temprature: float) -> Tuple[str, str]:
+    """
+    :return: scope and key of the answer to the prepared traceback in the answer cache
+    """
+    scope = AnswerCache.scope(prepared.language, prepared.analyser, temprature)
+    return scope, AnswerCache.key(scope, prepared.compressed.trace)
+
+
+async def analyze_prepared(user_info: dict, prepared: PreparedTrace,
+                           temprature: float) -> AsyncGenerator[Message, None]:
+    """
+    Stream the answer to a prepared traceback, from the answer cache or the LLM, and charge the usage to the user.
+    The quota is checked by the caller.
+    """
+    tb_filter, analyser, processed_trace = prepared.tb_filter, prepared.analyser, prepared.compressed.trace
+    cache_scope, cache_key = answer_key(prepared, temprature)
+    cached_answer = await answer_cache.get(cache_key, cache_scope, processed_trace, tb_filter.innermost_frame_last)
+    if cached_answer is not None:
+        logger.info(f"Answer served from cache, cache stats: {answer_cache.stats()}")
+        for response in cached_answer:
+            yield Message(status="STREAMING_RESPONSE", stage="ANAYLSIS_RUNNING", message=response)
+        await asyncio.sleep(0)
+        await quotas.add_usage(user_info, CACHE_HIT_TOKEN_CHARGE)
+        return
+
+    # Identical analyses running at the same time share one LLM call
+    flight, leader = single_flight.join(
+        cache_key, analyser, lambda: _llm_answer(user_info, prepared, temprature, cache_scope, cache_key))
+    queue_messages = flight.follow_queue()
+    messages = flight.follow()
+    try:
+        if leader:
+            async for message in queue_messages:
+                yield message
+        async for message in messages:
+            yield message
+    finally:
+        await queue_messages.aclose()
+        await messages.aclose()
+        single_flight.leave(flight)
 
     # update token usage
-    quotas.add_usage(user_info, analyser)
+    await quotas.add_usage(user_info, single_flight.charge(flight, leader))
+
+
+async def _llm_answer(user_info: dict, prepared: PreparedTrace, temprature: float, cache_scope: str,
+                      cache_key: str) -> AsyncGenerator[Message, None]:
+    """
+    Stream the answer of the LLM to a prepared traceback and cache it, run in a flight of single_flight.
+    """
+    tb_filter, analyser, processed_trace = prepared.tb_filter, prepared.analyser, prepared.compressed.trace
+    # Wait for a free slot, requests of different users are admitted in turns
+    ticket = llm_scheduler.enqueue(user_info['email'])
+    try:
+        async for position in ticket.wait():
+            yield Message(status="QUEUED", stage="WAITING_FOR_ANALYSIS",
+                          message=f"Many requests right now, your position in the queue: {position}")
+
+        logger.debug("Sending chat prompt and streaming response...")
+
+        answer = []
+        async for response in analyser.send_to_openai_chat(processed_trace, temprature=temprature,
+                                                           input_token_count=prepared.compressed.input_token_count):
+            answer.append(response)
+            yield Message(status="STREAMING_RESPONSE", stage="ANAYLSIS_RUNNING", message=response)
+    finally:
+        ticket.release()
+
+    await asyncio.sleep(0)
+    await answer_cache.set(cache_key, answer, cache_scope, processed_trace, tb_filter.innermost_frame_last)
+
+
+async def analyze_batch(
+        user_info: dict,
+        items: List[BatchItem],
+        threshold: float,
+        max_similar_lines: int,
+        temprature: float,
+        max_parallel: int = BATCH_MAX_PARALLEL) -> AsyncGenerator[dict, None]:
+    """
+    Analyze many tracebacks, e.g. of the failed tests of a CI run.
+    The tracebacks are filtered concurrently, identical or near identical filtered tracebacks are analysed once,
+    at most max_parallel at a time, and the quota is checked before each analysis.
+    Yields a result per item in the order the analyses complete: dict with index (in items), id, status
+    ('completed' with the answer or 'error' with status_code and message), and duplicate_of, the index of the
+    item whose analysis was used.
+    """
+    async def prepare(item: BatchItem):
+        try:
+            return await filter_pool.prepare(item.language, item.trace, threshold, max_similar_lines)
+        except AnalyzeException as e:
+            return e
+        except Exception as e:
+            logger.warning(f"Failed to filter traceback: {e}")
+            return e
+
+    prepared = await asyncio.gather(*(prepare(item) for item in items))
+    entries = []
+    for i, prepared_trace in enumerate(prepared):
+        if isinstance(prepared_trace, AnalyzeException):
+            entries.append(None)
+            yield _batch_result(items, i, error=prepared_trace)
+        elif isinstance(prepared_trace, Exception):
+            entries.append(None)
+            yield _batch_result(items, i, error=AnalyzeException(f"Failed to filter traceback: {prepared_trace}", 500))
+        else:
+            scope, key = answer_key(prepared_trace, temprature)
+            entries.append(BatchEntry(scope, key, prepared_trace.compressed.trace,
+                                      prepared_trace.tb_filter.innermost_frame_last))
+    groups = group_duplicates(entries, NEAR_DUPLICATE_THRESHOLD)
+    logger.info(f"Batch of {len(items)} tracebacks, {len(groups)} distinct")
+
+    semaphore = asyncio.Semaphore(max_parallel)
+
+    async def run(group: List[int]):
+        async with semaphore:
+            try:
+                await quotas.check(user_info)
+                answer = []
+                async for message in analyze_prepared(user_info, prepared[group[0]], temprature):
+                    if message.status == "STREAMING_RESPONSE":
+                        answer.append(message.message)
+                return group, ''.join(answer), None
+            except AnalyzeException as e:
+                return group, None, e
+            except Exception as e:
+                logger.exception(f"Failed to analyse traceback of batch: {e}")
+                return group, None, AnalyzeException(f"Failed to analyse traceback: {e}", 500)
+
+    tasks = [asyncio.create_task(run(group)) for group in groups]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            group, answer, error = await next_done
+            for i in group:
+                yield _batch_result(items, i, answer, error, duplicate_of=group[0] if i != group[0] else None)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _batch_result(items: List[BatchItem], i: int, answer: str = None, error: AnalyzeException = None,
+                  duplicate_of: int = None) -> dict:
+    result = {'index': i, 'id': items[i].id}
+    if error is None:
+        result.update(status='completed', answer=answer, duplicate_of=duplicate_of)
+    else:
+        result.update(status='error', status_code=error.status_code, message=f"{error}", duplicate_of=duplicate_of)
+    return result
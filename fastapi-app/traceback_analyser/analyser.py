@@ -1,15 +1,12 @@
 import asyncio
 import logging
-from typing import AsyncIterable
-
-from langchain import PromptTemplate
-from langchain.callbacks import AsyncIteratorCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import SystemMessage, HumanMessage
+import time
+from typing import AsyncIterable, List, Optional, Tuple
 
+from metrics import rejections_total, stage_seconds, tokens_total
 from .exceptions import AnalyzeException
-
-VERBOSE_CHAT_LOGGING = False
+from .llm_pool import llm_pool
+from .tokens import TokenCounter, get_token_counter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,56 +28,106 @@ class Analyser:
     REQUEST_TIMEOUT = 30
     MODEL_NAME = "gpt-3.5-turbo"
 
-    async def send_to_openai_chat(self, traceback: str, temprature=0.0) -> AsyncIterable[str]:
+    async def send_to_openai_chat(self, traceback: str, temprature=0.0,
+                                  input_token_count: Optional[int] = None) -> AsyncIterable[str]:
+        """
+        :param input_token_count: Token count of the prompt if already known, otherwise it is counted, after the
+            answer has been streamed if the prompt is obviously within the limit
+        """
         # async streaming inspiration from:
         # https://gist.github.com/ninely/88485b2e265d852d3feb8bd115065b1a
-        prompt = PromptTemplate(
-            input_variables=["traceback"],
-            template=self.template,
-        )
+        # langchain takes seconds to import, it is imported on first use (or by load_llm_stack at startup)
+        from langchain.callbacks import AsyncIteratorCallbackHandler
+        from langchain.schema import SystemMessage, HumanMessage
 
-        input = {
-            "traceback": traceback
-        }
-        text = prompt.format(**input)
+        messages = self.prompt_messages(traceback)
 
         logger.debug("=== Prompt ===")
-        logger.debug(text)
+        logger.debug(messages[-1][1])
         logger.debug("==============")
 
-        callback = AsyncIteratorCallbackHandler()
-
-        chat = ChatOpenAI(
-            streaming=True,
-            verbose=VERBOSE_CHAT_LOGGING,
-            callbacks=[callback],
-            temperature=temprature,
-            model_name=self.MODEL_NAME,
-            request_timeout=self.REQUEST_TIMEOUT,
-            max_tokens=self.OUTPUT_MAX_TOKENS)
-
-        messages = [
-            SystemMessage(content=self.instruction),
-            HumanMessage(content=text)
-        ]
-        self.input_token_count = chat.get_num_tokens_from_messages(messages)
-        if self.input_token_count > self.INPUT_MAX_TOKENS:
+        if input_token_count is None and not self.prompt_fits(traceback):
+            input_token_count = self.count_prompt_tokens(traceback)
+        if input_token_count is not None and input_token_count > self.INPUT_MAX_TOKENS:
+            rejections_total.inc('input_too_large')
             raise AnalyzeException("Input text to large", 413)
 
+        callback = AsyncIteratorCallbackHandler()
+        # The chat model and connections are shared, the callback and temperature are per request
+        chat = llm_pool.chat(self.MODEL_NAME, self.REQUEST_TIMEOUT, self.OUTPUT_MAX_TOKENS)
+        llm_pool.use_session()
+
+        message_types = {'system': SystemMessage, 'user': HumanMessage}
+        chat_messages = [message_types[role](content=content) for role, content in messages]
         # Begin a task that runs in the background.
-        task = asyncio.create_task(chat.agenerate(messages=[messages]))
+        start = time.perf_counter()
+        first_token_time = None
+        task = asyncio.create_task(chat.agenerate(messages=[chat_messages], callbacks=[callback],
+                                                  temperature=temprature))
         self.generated_token_count = 0
 
         async for token in callback.aiter():
-            logger.debug(f"data: {token}")
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                stage_seconds.observe(first_token_time - start, 'llm_first_token')
             self.generated_token_count += 1
             yield token
 
         await task
+        if first_token_time is not None:
+            stage_seconds.observe(time.perf_counter() - first_token_time, 'llm_stream')
+        self.input_token_count = input_token_count if input_token_count is not None else \
+            self.count_prompt_tokens(traceback)
         token_usage = self.input_token_count + self.generated_token_count
+        tokens_total.inc('input', amount=self.input_token_count)
+        tokens_total.inc('output', amount=self.generated_token_count)
         logger.info(
             f"Token count: input: {self.input_token_count} generated: {self.generated_token_count} total: {token_usage}")
 
+    @property
+    def token_counter(self) -> TokenCounter:
+        return get_token_counter(self.MODEL_NAME)
+
+    def prompt_messages(self, traceback: str) -> List[Tuple[str, str]]:
+        """
+        :return: (role, content) of the chat messages of the prompt
+        """
+        return [
+            ('system', self.instruction),
+            ('user', self.template.format(traceback=traceback))
+        ]
+
+    def count_prompt_tokens(self, traceback: str) -> int:
+        """
+        :return: Number of input tokens of the prompt with the traceback
+        """
+        return self.token_counter.count_messages(self.prompt_messages(traceback))
+
+    def estimate_prompt_tokens(self, traceback_lines: List[str]) -> int:
+        """
+        Number of input tokens of the prompt with the traceback lines, from cached counts of the prompt without
+        a traceback and of each line.
+        """
+        return self.count_prompt_tokens('') + self.token_counter.count_lines(traceback_lines)
+
+    def prompt_fits(self, traceback: str) -> bool:
+        """
+        :return: True if the prompt is within INPUT_MAX_TOKENS by the upper bound of the token count, False if
+            it may not be
+        """
+        return self.count_prompt_tokens('') + self.token_counter.bounds(traceback)[1] <= self.INPUT_MAX_TOKENS
+
+
+def load_llm_stack():
+    """
+    Import langchain and openai, meant to be called in the background after startup so the first request
+    does not pay for it.
+    """
+    import langchain.callbacks
+    import langchain.chat_models
+    import langchain.schema
+    logger.info(f"Loaded langchain {langchain.__version__}")
+
 
 class AnalyserJava(Analyser):
     instruction = """You are a helpful java expert. Here follows a java error traceback where similar lines has been removed for brevity, please provide a helpful summarization in one paragraph and a solution.
@@ -95,6 +142,7 @@ class AnalyserJava(Analyser):
 
 class AnalyserPython(Analyser):
     instruction = """You are a helpful python expert. Here follows a python error traceback where similar lines has been removed for brevity, please provide a helpful summarization in one paragraph and a solution. 
+    Long directories in paths may be replaced by aliases like <site> that are listed on the first line.
     The solution should be presented to the point and as compact as possible."""
 
     template = """This is the python traceback:
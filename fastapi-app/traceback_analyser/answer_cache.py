@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from typing import List, Optional
+
+from cache import LruTtlCache
+from state import StateBackend
+from .analyser import Analyser
+from .similarity_index import NearDuplicateIndex
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SqliteAnswerStore:
+    """
+    On disk store of answers so cached answers survive restarts.
+    The database can be shared by the worker processes, each opens its own connection on first use.
+    """
+    BUSY_TIMEOUT = 5
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # Called with the lock held. Not opened in __init__, a connection must not be inherited by forked workers
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, tokens TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT tokens FROM answers WHERE key = ? AND created > ?", (key, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, tokens: List[str]):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO answers (key, tokens, created) VALUES (?, ?, ?)",
+                                     (key, json.dumps(tokens), time.time()))
+            self._connection.execute("DELETE FROM answers WHERE created <= ?", (time.time() - self.ttl,))
+            self._connection.commit()
+
+
+class AnswerCache:
+    """
+    Cache of generated answers, keyed by a hash of everything that goes into the prompt.
+    Answers are stored as the list of streamed tokens so a hit can be replayed as the same stream.
+
+    The memory tier is an LRU bounded by number of answers and their total size. If the state backend is shared
+    by the workers answers are also stored there, and if db_path is given in an SQLite database.
+    If a similarity index is given, a miss falls back to the answer of the most similar traceback in the index.
+    """
+    MAX_ANSWERS = 2000
+    MAX_BYTES = 50 * 1024 * 1024
+    TTL = 7 * 24 * 3600
+
+    def __init__(self, db_path: Optional[str] = None, maxsize: int = MAX_ANSWERS, max_bytes: int = MAX_BYTES,
+                 ttl: float = TTL, similarity_index: Optional[NearDuplicateIndex] = None,
+                 state: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self._memory = LruTtlCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes, sizeof=_answer_size)
+        # A state backend local to the process would only duplicate the memory tier
+        self._state = state if state is not None and state.shared else None
+        self._store = SqliteAnswerStore(db_path, ttl) if db_path else None
+        self.similarity_index = similarity_index
+        self.hits = 0
+        self.near_duplicate_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def scope(language: str, analyser: Analyser, temprature: float) -> str:
+        """
+        :return: hash of everything except the traceback that goes into the prompt
+        """
+        data = json.dumps([language.lower(), type(analyser).__name__, analyser.MODEL_NAME, temprature,
+                           analyser.instruction])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def key(scope: str, trace: str) -> str:
+        return hashlib.sha256(f"{scope}\n{trace}".encode()).hexdigest()
+
+    async def get(self, key: str, scope: str = None, trace: str = None,
+                  innermost_last: bool = False) -> Optional[List[str]]:
+        """
+        :param scope, trace: Needed to look up similar tracebacks when there is a similarity index
+        :return: the cached answer tokens or None
+        """
+        tokens = await self._get(key)
+        if tokens is None and self.similarity_index is not None and trace is not None:
+            similar = self.similarity_index.find(scope, trace, innermost_last)
+            if similar is not None:
+                tokens = await self._get(similar[0])
+                if tokens is not None:
+                    logger.info(f"Found answer of similar traceback, similarity: {similar[1]:.2f}")
+                    self.near_duplicate_hits += 1
+        if tokens is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return tokens
+
+    async def set(self, key: str, tokens: List[str], scope: str = None, trace: str = None,
+                  innermost_last: bool = False):
+        self._memory.set(key, tokens)
+        if self._state is not None:
+            await self._state.set(_state_key(key), tokens, self.ttl)
+        if self.similarity_index is not None and trace is not None:
+            self.similarity_index.add(scope, trace, key, innermost_last)
+        if self._store is not None:
+            await asyncio.to_thread(self._store.set, key, tokens)
+
+    async def _get(self, key: str) -> Optional[List[str]]:
+        tokens = self._memory.get(key)
+        if tokens is None and self._state is not None:
+            tokens = await self._state.get(_state_key(key))
+            if tokens is not None:
+                self._memory.set(key, tokens)
+        if tokens is None and self._store is not None:
+            tokens = await asyncio.to_thread(self._store.get, key)
+            if tokens is not None:
+                self._memory.set(key, tokens)
+        return tokens
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'near_duplicate_hits': self.near_duplicate_hits,
+            'misses': self.misses,
+            'entries': len(self._memory),
+            'bytes': self._memory.current_bytes,
+            'indexed_tracebacks': len(self.similarity_index) if self.similarity_index is not None else 0,
+        }
+
+
+def _answer_size(tokens: List[str]) -> int:
+    return sys.getsizeof(tokens) + sum(sys.getsizeof(token) for token in tokens)
+
+
+def _state_key(key: str) -> str:
+    return f"answer:{key}"
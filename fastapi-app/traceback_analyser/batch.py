@@ -0,0 +1,50 @@
+import logging
+from typing import List, NamedTuple, Optional
+
+from pydantic import BaseModel
+
+from .similarity_index import NearDuplicateIndex
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BatchItem(BaseModel):
+    language: str
+    trace: str
+    # Returned with the result, e.g. the name of the failed test
+    id: Optional[str] = None
+
+
+class BatchEntry(NamedTuple):
+    scope: str
+    key: str
+    trace: str
+    innermost_last: bool
+
+
+def group_duplicates(entries: List[Optional[BatchEntry]], threshold: Optional[float]) -> List[List[int]]:
+    """
+    Group the entries of a batch that get the same answer: entries with the same key, and if threshold is given
+    entries at least that similar to the first entry of a group.
+    :param entries: None for entries that failed to be prepared, they are left out
+    :return: groups of indexes into entries, the first index of a group is the one to analyse
+    """
+    groups = []
+    group_by_key = {}
+    index = NearDuplicateIndex(threshold) if threshold else None
+    for i, entry in enumerate(entries):
+        if entry is None:
+            continue
+        group = group_by_key.get(entry.key)
+        if group is None and index is not None:
+            similar = index.find(entry.scope, entry.trace, entry.innermost_last)
+            if similar is not None:
+                group = group_by_key[entry.key] = group_by_key[similar[0]]
+        if group is None:
+            group = group_by_key[entry.key] = []
+            groups.append(group)
+            if index is not None:
+                index.add(entry.scope, entry.trace, entry.key, entry.innermost_last)
+        group.append(i)
+    return groups
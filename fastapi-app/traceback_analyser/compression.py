@@ -0,0 +1,153 @@
+import logging
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from metrics import stage_seconds
+from .analyser import Analyser
+from .process_tb import FilterTraceback
+from .tokens import TokenCounter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CompressedTraceback(NamedTuple):
+    trace: str
+    # Descriptions of the reductions applied to make the traceback fit, empty if it fitted after normal filtering
+    reductions: List[str]
+    # Token count of the prompt with the traceback, None if it was obviously within the limit without counting
+    input_token_count: Optional[int]
+
+
+class CompressionPlanner:
+    """
+    Makes a traceback fit in the token budget of the prompt instead of rejecting it.
+
+    The traceback is filtered with the requested parameters first, if the prompt is too large stronger reductions
+    are applied in order until it fits:
+      - lower similarity thresholds (THRESHOLDS)
+      - fewer similar lines (MAX_SIMILAR_LINES)
+        (lines starting an exception in the chain are never filtered out by these)
+      - dropping frames in the middle, keeping the head, the tail and every exception in the chain ('Caused by')
+        with the frames closest to where it was raised.
+    The traceback is prepared once and re-filtered for each attempt. Token counts are per line and cached, so an
+    attempt only sums the counts of its lines, the whole prompt is tokenized before dropping frames to know the
+    excess and once more to verify the result. As the sum of the line counts is an estimate, frames are dropped
+    again (at most MAX_DROP_ATTEMPTS times in all) in the rare case the result still does not fit.
+    A traceback that fits by the byte length upper bound of the token count is not tokenized at all.
+    """
+    THRESHOLDS = (0.4, 0.3)
+    MAX_SIMILAR_LINES = 1
+    # Attempts to drop frames, more than one only when the per line estimate turns out lower than the exact count
+    MAX_DROP_ATTEMPTS = 3
+
+    def fit(self, tb_filter: FilterTraceback, analyser: Analyser, trace: str, threshold: float,
+            max_similar_lines: int) -> CompressedTraceback:
+        with stage_seconds.time('filter'):
+            lines = tb_filter.prepare(trace)
+            filtered = tb_filter.filter_lines(lines, threshold, max_similar_lines)
+            compressed = '\n'.join(filtered)
+        with stage_seconds.time('token_count'):
+            fits = analyser.prompt_fits(compressed)
+        if fits:
+            return CompressedTraceback(compressed, [], None)
+
+        start = time.perf_counter()
+
+        token_counter = analyser.token_counter
+        budget = analyser.INPUT_MAX_TOKENS - analyser.estimate_prompt_tokens([])
+        reductions = []
+        attempts = [(t, max_similar_lines) for t in self.THRESHOLDS if t < threshold]
+        if max_similar_lines > self.MAX_SIMILAR_LINES:
+            attempts.append((min((threshold,) + self.THRESHOLDS), self.MAX_SIMILAR_LINES))
+        for attempt_threshold, attempt_max_similar_lines in attempts:
+            if token_counter.count_lines(filtered) <= budget:
+                break
+            filtered = tb_filter.filter_lines(lines, attempt_threshold, attempt_max_similar_lines,
+                                              keep_cause_lines=True)
+            if attempt_threshold != threshold:
+                reductions.append(f"similarity threshold {threshold} -> {attempt_threshold}")
+                threshold = attempt_threshold
+            if attempt_max_similar_lines != max_similar_lines:
+                reductions.append(f"max similar lines {max_similar_lines} -> {attempt_max_similar_lines}")
+                max_similar_lines = attempt_max_similar_lines
+
+        compressed = '\n'.join(filtered)
+        input_token_count = analyser.count_prompt_tokens(compressed)
+        frames = tb_filter.group_frames(filtered)
+        kept_lines = filtered
+        drop_budget = budget
+        dropped = 0
+        for _ in range(self.MAX_DROP_ATTEMPTS):
+            excess = input_token_count - analyser.INPUT_MAX_TOKENS
+            if excess <= 0 or len(frames) < 3:
+                break
+            # Drop frames whose cached per line counts add up to the excess, the prompt is only tokenized again
+            # to verify the result
+            drop_budget = min(drop_budget, token_counter.count_lines(kept_lines) - excess)
+            kept_lines, dropped = _drop_middle_frames(frames, tb_filter, drop_budget, token_counter)
+            compressed = '\n'.join(kept_lines)
+            input_token_count = analyser.count_prompt_tokens(compressed)
+        if dropped:
+            reductions.append(f"dropped {dropped} of {len(frames)} frames")
+        if reductions:
+            logger.info(f"Compressed traceback to fit {analyser.INPUT_MAX_TOKENS} input tokens: {', '.join(reductions)}")
+        stage_seconds.observe(time.perf_counter() - start, 'compress')
+        return CompressedTraceback(compressed, reductions, input_token_count)
+
+
+def _drop_middle_frames(frames: List[List[str]], tb_filter: FilterTraceback, budget: int,
+                        token_counter: TokenCounter) -> Tuple[List[str], int]:
+    """
+    Keep as many frames as fit in the budget: the first and last frame and every frame starting an exception
+    in the chain are kept, then frames are added one at a time round robin from each kept exception in the
+    direction of the innermost frames, and from the end of the traceback holding the outermost frames.
+    Each run of dropped frames is replaced with a line telling how many frames were dropped.
+    :return: kept lines and number of dropped frames
+    """
+    n = len(frames)
+    costs = [token_counter.count_lines(frame) for frame in frames]
+    # Every gap between kept frames may need an omitted line
+    omitted_cost = token_counter.count_lines([f"[{n} frames omitted]"])
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    # In order of priority when adding frames, the end of the chain is closest to the root cause
+    anchors = [n - 1]
+    remaining = budget - costs[0] - costs[-1] - 2 * omitted_cost
+    # If not all exceptions of the chain fit, keep the ones closest to the root cause at the end
+    for i in range(n - 2, 0, -1):
+        if tb_filter.is_cause_line(frames[i][0]):
+            if costs[i] + omitted_cost > remaining:
+                break
+            keep[i] = True
+            anchors.append(i)
+            remaining -= costs[i] + omitted_cost
+    anchors.append(0)
+
+    step = -1 if tb_filter.innermost_frame_last else 1
+    cursors = [i + step for i in anchors] + [1 if tb_filter.innermost_frame_last else n - 2]
+    steps = [step] * len(anchors) + [-step]
+    while cursors:
+        active = []
+        for cursor, cursor_step in zip(cursors, steps):
+            if 0 <= cursor < n and not keep[cursor] and costs[cursor] <= remaining:
+                keep[cursor] = True
+                remaining -= costs[cursor]
+                active.append((cursor + cursor_step, cursor_step))
+        cursors = [cursor for cursor, _ in active]
+        steps = [cursor_step for _, cursor_step in active]
+
+    lines = []
+    dropped = 0
+    omitted = 0
+    for kept, frame in zip(keep, frames):
+        if kept:
+            if omitted:
+                lines.append(f"[{omitted} frames omitted]")
+                omitted = 0
+            lines.extend(frame)
+        else:
+            omitted += 1
+            dropped += 1
+    return lines, dropped
+
@@ -1,7 +1,16 @@
+import logging
 import re
+from collections import Counter
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-def extract_stacktrace(log_data: str) -> str:
+_re_number = re.compile(r'\b\d+\b')
+# Numbers in the lines are replaced with this placeholder when looking for the prefix
+_NUM = '\0'
+
+
+def extract_stacktrace(log_data: str, min_share: float = 0.5, sample_size: int = 2000) -> str:
     """
     If a stacktrace is copied from a log file, this method can be used to remove the structured logline prefixes
     in order to only get the stacktrace.
@@ -16,44 +25,65 @@ def extract_stacktrace(log_data: str) -> str:
             sys.exit(main())
           File "/home/ec2-user/projects/ai-stacktrace/fastapi-app/venv/lib64/python3.9/site-packages/click/core.py", line 1130, in __call__
 
+    The prefix only has to be shared by most of the lines, lines without it (wrapped or blank lines) are left as is.
 
-    :param log_lines:
+    :param log_data:
+    :param min_share: Share of the lines that must have the prefix
+    :param sample_size: Number of lines the prefix is inferred from
     :return:
     """
-    log_lines = log_data.strip().splitlines()
-    # Replace all numbers with a placeholder
-    lines_with_placeholders = []
-    for line in log_lines:
-        new_line = re.sub(r'\b\d+\b', '<NUM>', line)
-        lines_with_placeholders.append(new_line)
+    log_data = '\n'.join(log_data.strip().splitlines())
+    prefix = infer_log_prefix(log_data, min_share, sample_size)
+    logger.debug(f"log prefix: {prefix!r}")
+    if not prefix:
+        return log_data
 
-    # Find the common prefix
-    common_prefix = _get_common_prefix(lines_with_placeholders)
-    print(f"common_prefix: {common_prefix}")
-
-    # Escape special characters in the prefix
-    prefix = re.escape(common_prefix)
+    # Escape special characters in the prefix and replace the number placeholders with regex patterns
+    prefix_regex = r'\b\d+\b'.join(re.escape(part) for part in prefix.split(_NUM))
+    # Remove the prefix from each line in the original logs
+    return re.sub('^' + prefix_regex, '', log_data, flags=re.MULTILINE)
 
-    # Replace placeholders with regex patterns
-    prefix = prefix.replace('<NUM>', r'\b\d+\b')
 
-    # Create a compiled regex object
-    prefix_regex = re.compile('^' + prefix)
+def infer_log_prefix(log_data: str, min_share: float = 0.5, sample_size: int = 2000) -> str:
+    """
+    Find the log line prefix shared by most of the (first sample_size) lines, numbers in the prefix are returned
+    as _NUM placeholders.
 
-    # Remove the prefix from each line in the original logs
-    original_logs_without_prefix = [prefix_regex.sub('', line) for line in log_lines]
-    return '\n'.join(original_logs_without_prefix)
+    The prefix is built column by column from the character most lines have in that column, narrowing down to
+    the lines that have the prefix so far. Whitespace must be shared by all those lines, so the prefix doesn't
+    eat into the indentation of the stacktrace, and the prefix ends at a word boundary.
+    A prefix not shared by all lines must contain a number (e.g. a timestamp) to be considered a log prefix.
+    """
+    lines = []
+    for line in log_data.split('\n', sample_size)[:sample_size]:
+        if line.strip():
+            lines.append(_re_number.sub(_NUM, line))
+    if len(lines) < 2:
+        return ''
 
+    total = len(lines)
+    min_count = total * min_share
+    prefix = []
+    column = 0
+    while True:
+        counts = Counter(line[column] for line in lines if len(line) > column)
+        if not counts:
+            break
+        char, count = counts.most_common(1)[0]
+        if count != len(lines) and (char.isspace() or count <= min_count):
+            break
+        prefix.append(char)
+        lines = [line for line in lines if len(line) > column and line[column] == char]
+        column += 1
 
-def _get_common_prefix(strs: list[str]) -> str:
-    prefix = strs[0]
-    for s in strs[1:]:
-        while not s.startswith(prefix):
-            prefix = prefix[:-1]
-            if not prefix:
-                return ''
+    while prefix and (prefix[-1].isalnum() or prefix[-1] == '_'):
+        prefix.pop()
+    prefix = ''.join(prefix)
+    if _NUM not in prefix and len(lines) != total:
+        return ''
     return prefix
 
+
 EXAMPLE_TB = """Jun 10 16:28:46 ip-172-31-6-210.eu-north-1.compute.internal uvicorn[930113]: Traceback (most recent call last):
 Jun 10 16:28:46 ip-172-31-6-210.eu-north-1.compute.internal uvicorn[930113]:   File "/home/ec2-user/projects/ai-stacktrace/fastapi-app/venv/bin/uvicorn", line 8, in <module>
 Jun 10 16:28:46 ip-172-31-6-210.eu-north-1.compute.internal uvicorn[930113]:     sys.exit(main())
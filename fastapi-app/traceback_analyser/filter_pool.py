@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from metrics import rejections_total, stage_seconds
+from .exceptions import AnalyzeException
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CpuTimeExceeded(Exception):
+    pass
+
+
+class FilterPool:
+    """
+    Runs the filtering of large tracebacks in worker processes, so a large paste does not block the event loop
+    and with it the answers streamed to every other user of the worker.
+    Tracebacks up to inline_max_chars are filtered inline, that takes a few milliseconds, larger ones are sent
+    to the pool. Filtering in the pool is limited to cpu_time_limit seconds of CPU time per traceback, and
+    tracebacks longer than max_input_chars are rejected.
+    The processes are forked from a server process that has the traceback_analyser package imported, they load the
+    token encodings when started, see start.
+    """
+    WORKERS = 2
+    INLINE_MAX_CHARS = 16 * 1024
+    MAX_INPUT_CHARS = 4 * 1024 * 1024
+    CPU_TIME_LIMIT = 5.0
+
+    def __init__(self, prepare: Callable, workers: int = WORKERS, inline_max_chars: int = INLINE_MAX_CHARS,
+                 max_input_chars: int = MAX_INPUT_CHARS, cpu_time_limit: float = CPU_TIME_LIMIT):
+        """
+        :param prepare: Module level function filtering a traceback, called with the arguments of prepare
+        :param workers: Number of processes, 0 to filter everything inline
+        """
+        self.prepare_function = prepare
+        self.workers = workers
+        self.inline_max_chars = inline_max_chars
+        self.max_input_chars = max_input_chars
+        self.cpu_time_limit = cpu_time_limit
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        """
+        Start the processes, meant to be called once the app has started. Otherwise they are started by the first
+        large traceback.
+        """
+        if self.workers:
+            executor = self._get_executor()
+            for _ in range(self.workers):
+                executor.submit(_ping)
+
+    async def prepare(self, language: str, trace: str, threshold: float, max_similar_lines: int):
+        """
+        :return: the result of the prepare function
+        :raises AnalyzeException: 413 if the traceback is too large or takes too long to filter
+        """
+        if len(trace) > self.max_input_chars:
+            rejections_total.inc('input_too_large')
+            raise AnalyzeException(f"Sorry, the traceback is too large, max {self.max_input_chars} characters", 413)
+        if not self.workers or len(trace) <= self.inline_max_chars:
+            return self.prepare_function(language, trace, threshold, max_similar_lines)
+
+        executor = self._get_executor()
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, _run_with_cpu_time_limit, self.cpu_time_limit, self.prepare_function,
+                language, trace, threshold, max_similar_lines)
+        except CpuTimeExceeded:
+            logger.warning(f"Filtering a traceback of {len(trace)} characters took more than {self.cpu_time_limit} s")
+            rejections_total.inc('filter_cpu_limit')
+            raise AnalyzeException("Sorry, the traceback is too complex to filter", 413)
+        except BrokenProcessPool as e:
+            logger.error(f"Filter process died, restarting the pool: {e}")
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False)
+            raise AnalyzeException("Failed to filter traceback", 500)
+        finally:
+            stage_seconds.observe(time.perf_counter() - start, 'filter_process')
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Forking the app, with its threads and connections, is not safe, the processes are forked from a clean
+            # server process instead where available
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['traceback_analyser'])
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker)
+        return self._executor
+
+
+def _init_worker():
+    from traceback_analyser import preload_token_counters
+    if hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGPROF, _raise_cpu_time_exceeded)
+    preload_token_counters()
+
+
+def _ping():
+    pass
+
+
+def _raise_cpu_time_exceeded(signum, frame):
+    raise CpuTimeExceeded()
+
+
+def _run_with_cpu_time_limit(cpu_time_limit: float, function: Callable, *args):
+    """
+    Runs in a pool process, SIGPROF interrupts the function after cpu_time_limit seconds of CPU time of the process.
+    There is no limit where setitimer is not available (Windows).
+    """
+    if not hasattr(signal, 'setitimer'):
+        return function(*args)
+    signal.setitimer(signal.ITIMER_PROF, cpu_time_limit)
+    try:
+        return function(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
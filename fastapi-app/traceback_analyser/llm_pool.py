@@ -0,0 +1,63 @@
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VERBOSE_CHAT_LOGGING = False
+
+
+class LlmPool:
+    """
+    Long lived chat models and HTTP connections shared by all requests.
+
+    One ChatOpenAI is kept per (model, timeout, max tokens), per request settings (streaming callbacks and
+    temperature) are passed to agenerate instead. Without a session set openai creates a new aiohttp session,
+    and a new connection with a TLS handshake, for every request, here all requests go through one session that
+    keeps connections alive and limits the number of concurrent connections to the API.
+    """
+    MAX_CONNECTIONS = 20
+    KEEPALIVE_TIMEOUT = 60
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._chats = {}
+        self._session = None
+
+    def chat(self, model_name: str, request_timeout: float, max_tokens: int):
+        """
+        :return: The shared langchain ChatOpenAI for the settings
+        """
+        key = (model_name, request_timeout, max_tokens)
+        chat = self._chats.get(key)
+        if chat is None:
+            from langchain.chat_models import ChatOpenAI
+            chat = ChatOpenAI(
+                streaming=True,
+                verbose=VERBOSE_CHAT_LOGGING,
+                model_name=model_name,
+                request_timeout=request_timeout,
+                max_tokens=max_tokens)
+            self._chats[key] = chat
+        return chat
+
+    def use_session(self):
+        """
+        Make openai requests from the current task, and tasks created by it, use the shared session.
+        Must be called from within the event loop.
+        """
+        import openai
+        if self._session is None or self._session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector)
+            logger.info(f"Created openai session, max connections: {self.max_connections}")
+        openai.aiosession.set(self._session)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+llm_pool = LlmPool(max_connections=int(os.getenv('OPENAI_MAX_CONNECTIONS', LlmPool.MAX_CONNECTIONS)))
@@ -0,0 +1,213 @@
+import gzip
+import hashlib
+import logging
+import re
+import sys
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from .similarity_index import extract_signature
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_re_python_start = re.compile(r'Traceback \(most recent call last\):\s*$')
+_re_java_thread_start = re.compile(r'Exception in thread "[^"]*" ')
+# A java frame line, the log prefix (if any) is what comes before the indentation
+_re_java_frame = re.compile(r'\s+at [\w$.<>/-]+\(.*\)\s*$')
+_re_java_continuation = re.compile(
+    r'\s+at |\s*\.\.\. \d+ (?:more|common frames omitted)|\s*Caused by: |\s*Suppressed: ')
+_re_number = re.compile(r'\d+')
+
+
+class TracebackBlock(NamedTuple):
+    language: str
+    # 1 based line number in the log where the traceback starts
+    line_no: int
+    lines: List[str]
+    # Lines dropped because the traceback had more than max_lines
+    truncated: int
+
+
+class TracebackGroup:
+    """
+    Occurrences of tracebacks with the same fingerprint, the first occurrence is kept as the representative.
+    """
+
+    def __init__(self, fingerprint: str, block: TracebackBlock):
+        self.fingerprint = fingerprint
+        self.language = block.language
+        self.trace = '\n'.join(block.lines)
+        self.count = 1
+        self.first_line_no = block.line_no
+        self.last_line_no = block.line_no
+
+    def add(self, block: TracebackBlock):
+        self.count += 1
+        self.last_line_no = block.line_no
+
+
+def read_lines(path: str, max_line_bytes: int = 64 * 1024) -> Iterator[str]:
+    """
+    Stream the lines of a log file (gzip compressed if the name ends with .gz, stdin for '-') without loading it.
+    Longer lines are split at max_line_bytes so a file without line breaks can't exhaust memory.
+    """
+    if path == '-':
+        yield from _read_lines(sys.stdin.buffer, max_line_bytes)
+        return
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as file:
+        yield from _read_lines(file, max_line_bytes)
+
+
+def _read_lines(file: BinaryIO, max_line_bytes: int) -> Iterator[str]:
+    readline = file.readline
+    while True:
+        line = readline(max_line_bytes)
+        if not line:
+            return
+        yield line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+
+def scan_tracebacks(lines: Iterable[str], max_lines: int = 1000) -> Iterator[TracebackBlock]:
+    """
+    Find the Python and Java tracebacks in the lines of a log, with the log prefix (the part of the line before
+    the traceback starts, e.g. a timestamp) removed from their lines.
+
+    A Python traceback starts with 'Traceback (most recent call last):' and ends with its first unindented line,
+    the exception. A Java traceback starts with 'Exception in thread' or a line followed by an 'at' frame line, and
+    continues with frame, 'Caused by:', 'Suppressed:' and '... n more' lines.
+    Lines of a traceback with the same prefix as its first line (numbers in it may differ) have it removed, lines
+    without are taken as they are, like the traceback lines of Python's logging.exception.
+
+    :param max_lines: Lines of a traceback beyond this are dropped
+    """
+    block = None
+    block_truncated = 0
+    block_prefix = None
+    previous = None
+    for line_no, line in enumerate(lines, 1):
+        if block is not None:
+            text = _strip_prefix(block_prefix, line)
+            ends = False
+            if block.language == 'python':
+                if _re_python_start.search(line):
+                    continues = False
+                else:
+                    continues = True
+                    # The first unindented line is the exception, the last line of the traceback
+                    ends = not text[:1].isspace()
+                    if not text.strip():
+                        continues = False
+            else:
+                continues = _re_java_continuation.match(text) is not None
+            if continues:
+                if len(block.lines) < max_lines or ends:
+                    block.lines.append(text)
+                else:
+                    block_truncated += 1
+            if not continues or ends:
+                yield block._replace(truncated=block_truncated)
+                block = None
+            if continues:
+                previous = (line_no, line)
+                continue
+
+        # Most lines of a log are not in a traceback, look for the markers before running the regexes
+        match = _re_python_start.search(line) if 'Traceback (' in line else None
+        if match:
+            block_prefix = _prefix_regex(line[:match.start()])
+            block = TracebackBlock('python', line_no, [line[match.start():]], 0)
+            block_truncated = 0
+        else:
+            match = _re_java_thread_start.search(line) if 'Exception in thread' in line else None
+            if match:
+                block_prefix = _prefix_regex(line[:match.start()])
+                block = TracebackBlock('java', line_no, [line[match.start():]], 0)
+                block_truncated = 0
+            else:
+                match = _re_java_frame.search(line) if 'at ' in line else None
+                if match and previous is not None:
+                    # The previous line is the exception, unless it is a frame itself (a block that was cut short)
+                    block_prefix = _prefix_regex(line[:match.start()])
+                    header = _strip_prefix(block_prefix, previous[1]).strip()
+                    if not header:
+                        block = TracebackBlock('java', line_no, [line[match.start():]], 0)
+                    elif not _re_java_continuation.match(header):
+                        block = TracebackBlock('java', previous[0], [header, line[match.start():]], 0)
+                    block_truncated = 0
+        previous = (line_no, line)
+    if block is not None:
+        yield block._replace(truncated=block_truncated)
+
+
+def _prefix_regex(prefix: str) -> Optional[re.Pattern]:
+    if not prefix:
+        return None
+    return re.compile(r'\d+'.join(re.escape(part) for part in _re_number.split(prefix)))
+
+
+def _strip_prefix(prefix: Optional[re.Pattern], line: str) -> str:
+    if prefix is not None:
+        match = prefix.match(line)
+        if match:
+            return line[match.end():]
+    return line
+
+
+def fingerprint(block: TracebackBlock) -> str:
+    """
+    Hash of the exception types and frames of the traceback, with line numbers, ids and generated names masked,
+    so all occurrences of an error get the same fingerprint.
+    """
+    signature = extract_signature('\n'.join(block.lines), max_frames=50, innermost_last=block.language == 'python')
+    if not signature.exception_types and not signature.frames:
+        # Nothing recognised, fall back to the text with numbers masked
+        data = _re_number.sub('#', '\n'.join(block.lines))
+    else:
+        data = '\n'.join(signature.exception_types + ('',) + signature.frames)
+    return hashlib.blake2b(f"{block.language}\n{data}".encode(), digest_size=8).hexdigest()
+
+
+class LogScanner:
+    """
+    Groups the tracebacks of a log by fingerprint.
+    Memory is bounded by max_groups representatives of at most max_lines lines, however large the log is.
+    Tracebacks of new fingerprints once there are max_groups groups are only counted, in dropped.
+    """
+    MAX_GROUPS = 1000
+    MAX_LINES = 1000
+
+    def __init__(self, max_groups: int = MAX_GROUPS, max_lines: int = MAX_LINES):
+        self.max_groups = max_groups
+        self.max_lines = max_lines
+        self.groups: Dict[str, TracebackGroup] = {}
+        self.lines = 0
+        self.tracebacks = 0
+        self.dropped = 0
+
+    def scan(self, lines: Iterable[str]):
+        for block in scan_tracebacks(self._count_lines(lines), self.max_lines):
+            self.add(block)
+
+    def add(self, block: TracebackBlock):
+        self.tracebacks += 1
+        key = fingerprint(block)
+        group = self.groups.get(key)
+        if group is not None:
+            group.add(block)
+        elif len(self.groups) < self.max_groups:
+            self.groups[key] = TracebackGroup(key, block)
+        else:
+            self.dropped += 1
+
+    def top(self, limit: Optional[int] = None) -> List[TracebackGroup]:
+        """
+        :return: the groups, most occurrences first
+        """
+        groups = sorted(self.groups.values(), key=lambda group: (-group.count, group.first_line_no))
+        return groups[:limit] if limit is not None else groups
+
+    def _count_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        for line in lines:
+            self.lines += 1
+            yield line
@@ -1,10 +1,12 @@
 import logging
+import os
 import re
-import textwrap
 from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence, Tuple
 
 from Levenshtein import ratio
 
+from payload_log import log_payload
 from traceback_analyser.extract_tb import extract_stacktrace
 
 logging.basicConfig(level=logging.INFO)
@@ -12,12 +14,35 @@ logger = logging.getLogger(__name__)
 
 
 class FilterTraceback:
-    def filter(self, traceback: str, similarity_threshold=0.6, max_similar_lines=3, runs=2) -> str:
-        pass
+    """
+    Filters out lines similar to the previous lines to make a traceback more compact.
 
+    Each line is normalized once (line numbers removed) and compared to the previous line, lines are
+    considered similar if the Levenshtein ratio of the normalized lines is above the similarity threshold.
+    Identical lines are similar without computing the ratio, and pairs that differ too much in length to be
+    similar are rejected before it.
+    Before that, sequences of frames repeating over and over (e.g. recursion) are collapsed, see compress_cycles,
+    and runs of framework frames are folded if the filter has a frame_folder, see FrameFolder.
+    """
+    innermost_frame_last = False
+    frame_folder: Optional['FrameFolder'] = None
+    # Collapse sequences of up to max_cycle_frames frames that repeat at least min_cycle_repeats times
+    max_cycle_frames = 20
+    min_cycle_repeats = 3
+    # Line numbers are removed from the output using _line_nr_replacement and ignored when comparing lines
+    # using _similarity_replacement
+    _re_remove_line_nr = re.compile(r'(?!)')
+    _line_nr_replacement = ''
+    _similarity_replacement = ''
+    # Lines starting an exception in a chain, always kept when frames are dropped to make a traceback fit
+    _re_cause_line = re.compile(r'\s*Caused by:')
 
-class FilterTracebackJava(FilterTraceback):
-    _re_remove_line_nr = re.compile(r':\d+\)$')
+    def __init__(self, frame_folder: Optional['FrameFolder'] = None):
+        """
+        :param frame_folder: Folds framework frames instead of the default of the class, FrameFolder([]) folds none
+        """
+        if frame_folder is not None:
+            self.frame_folder = frame_folder
 
     def filter(self, traceback: str, similarity_threshold=0.6, max_similar_lines=3, runs=2) -> str:
         """
@@ -25,120 +50,487 @@ class FilterTracebackJava(FilterTraceback):
         :param traceback:
         :param similarity_threshold:
         :param max_similar_lines:
-        :param runs: Run multiple times to remove any new duplicate lines after a cleanup
+        :param runs: Filter the output again to remove any new duplicate lines after a cleanup, None to filter
+            until no more lines are removed. All runs are done in a single pass over the lines.
         :return: filtred traceback
         """
         logger.info(f"filtering traceback of length {len(traceback)}")
-        traceback = textwrap.dedent(traceback)
-        traceback = self._remove_file_line_numbers(traceback)
-        # remove empty lines
-        traceback = '\n'.join(l for l in traceback.splitlines() if l.strip())
+        lines = self.filter_lines(self.prepare(traceback), similarity_threshold, max_similar_lines, runs)
+        traceback = '\n'.join(lines)
+        logger.info(f"filter traceback length {len(traceback)}")
+        return traceback
 
-        for run in range(runs):
-            logger.info(f"run: {run}")
-            traceback = self._filter_traceback(traceback, similarity_threshold=similarity_threshold,
-                                               max_similar_lines=max_similar_lines)
-            logger.info(f"filter traceback length {len(traceback)}")
+    def prepare(self, traceback: str) -> list[str]:
+        """
+        The part of filtering that does not depend on the filter parameters: normalize the lines, collapse
+        repeating frames and fold framework frames. The result can be filtered with filter_lines with different
+        parameters.
+        """
+        lines = self._prepare_lines(traceback)
+        frames = compress_cycles(self.group_frames(lines), self.max_cycle_frames, self.min_cycle_repeats)
+        lines = [line for frame in frames for line in frame]
+        if self.frame_folder is not None:
+            lines = self.frame_folder.fold(lines)
+        return lines
 
-        return traceback
+    def is_cause_line(self, line: str) -> bool:
+        """
+        :return: True for lines that start an exception in a chain of exceptions, e.g. 'Caused by: ...'
+        """
+        return self._re_cause_line.match(line) is not None
 
-    def _remove_file_line_numbers(self, traceback: str):
-        return '\n'.join(self._re_remove_line_nr.sub(")", line) for line in traceback.splitlines(keepends=False))
+    def _prepare_lines(self, traceback: str) -> list[str]:
+        remove_line_nr = self._re_remove_line_nr.sub
+        # remove line numbers and empty lines
+        lines = (remove_line_nr(self._line_nr_replacement, line) for line in _dedent_lines(traceback))
+        return [line for line in lines if line.strip()]
 
-    def _filter_traceback(self, traceback: str, similarity_threshold, max_similar_lines) -> str:
-        def _similarity(a, b):
-            a = self._re_remove_line_nr.sub(")", a)
-            b = self._re_remove_line_nr.sub(")", b)
-            sim = ratio(a, b)
-            logger.debug("--")
-            logger.debug(a)
-            logger.debug(b)
-            logger.debug(sim)
-            return sim
+    def group_frames(self, lines: list[str]) -> list[list[str]]:
+        """
+        Group lines into frames, by default every line is a frame.
+        """
+        return [[line] for line in lines]
 
+    def filter_lines(self, lines: list[str], similarity_threshold, max_similar_lines, runs=2,
+                     keep_cause_lines=False) -> list[str]:
+        """
+        :param keep_cause_lines: Never filter out lines starting an exception in a chain, see is_cause_line
+        """
+        remove_line_nr = self._re_remove_line_nr.sub
+        similarity_replacement = self._similarity_replacement
+        is_cause_line = self._re_cause_line.match
+        stages = [_FilterStage()]
         out_lines = []
-        last_line = ''
-        similar_lines_count = 0
-        for line in traceback.splitlines(keepends=False):
-            # Check if line contains valuable information, similar to the previous line or '... XXX more'
-            # Check if we have already included the max number of similar lines
-            if last_line and _similarity(last_line, line) > similarity_threshold:
-                similar_lines_count += 1
+        for line in lines:
+            key = remove_line_nr(similarity_replacement, line)
+            always_keep = keep_cause_lines and is_cause_line(line) is not None
+            known_similar = None
+            for stage in stages:
+                if stage.last_key is None:
+                    similar = False
+                elif known_similar is not None:
+                    similar = known_similar
+                else:
+                    similar = _is_similar(stage.last_key, key, similarity_threshold)
+                similar_lines_count = stage.similar_lines_count + 1 if similar else 1
+                keep = similar_lines_count <= max_similar_lines or always_keep
+                if not keep and stage is stages[-1] and (runs is None or len(stages) < runs):
+                    # Up to now the next run would have seen the same lines as this one, start it from here
+                    stages.append(stage.copy())
+                # If this stage kept the previous line, the next stage compares the same two lines
+                known_similar = similar if stage.last_kept and stage.last_key is not None else None
+                stage.last_key = key
+                stage.last_kept = keep
+                stage.similar_lines_count = similar_lines_count
+                if not keep:
+                    break
             else:
-                similar_lines_count = 1
-
-            if similar_lines_count <= max_similar_lines:
                 out_lines.append(line)
+        return out_lines
 
-            last_line = line
-        filtred_traceback = '\n'.join(out_lines)
-        logger.debug(f"filter traceback length {len(filtred_traceback)}")
 
-        return filtred_traceback
+def compress_cycles(frames: list[list[str]], max_period: int = 20, min_repeats: int = 3) -> list[list[str]]:
+    """
+    Collapse sequences of frames that repeat consecutively,
+    e.g. A,B,C,A,B,C,A,B,C -> A,B,C,[frames 1..3 repeated 3 times].
+    A single frame repeating, a method calling itself, is collapsed into A,[frame repeated 3 times]. Otherwise at each
+    position the shortest period (2 up to max_period frames) repeating at least min_repeats times is collapsed.
+    Runs in O(frames * max_period^2) at worst: at each position up to max_period periods are tried, each by comparing
+    blocks of up to max_period frames. Frames are compared as integer ids, only periods where the first frame
+    reappears are tried and collapsed frames are skipped, so typical tracebacks take close to O(frames).
+    :return: frames with each collapsed sequence replaced by its first occurrence and a summary line
+    """
+    frame_ids = {}
+    ids = [frame_ids.setdefault('\n'.join(frame), len(frame_ids)) for frame in frames]
+    n = len(ids)
+    if len(frame_ids) == n:
+        return frames
+    # next_same[i] is the next position of the same frame as at position i
+    next_same = [n] * n
+    last_seen = {}
+    for i in range(n - 1, -1, -1):
+        next_same[i] = last_seen.get(ids[i], n)
+        last_seen[ids[i]] = i
 
+    out = []
+    i = 0
+    while i < n:
+        end = i + 1
+        while end < n and ids[end] == ids[i]:
+            end += 1
+        if end - i >= min_repeats:
+            out.append(frames[i])
+            out.append([f"[frame repeated {end - i} times]"])
+            i = end
+            continue
+        j = next_same[i]
+        while j - i <= max_period and i + (j - i) * min_repeats <= n:
+            period = j - i
+            block = ids[i:j]
+            repeats = 1
+            end = j
+            while ids[end:end + period] == block:
+                repeats += 1
+                end += period
+            if repeats >= min_repeats:
+                out.extend(frames[i:j])
+                out.append([f"[frames {i + 1}..{j} repeated {repeats} times]"])
+                i = end
+                break
+            j = next_same[j]
+        else:
+            out.append(frames[i])
+            i += 1
+    return out
 
-class FilterTracebackPython(FilterTraceback):
-    # TODO: remove/simplifiy paths in tracebacks.
-    _re_remove_line_nr = re.compile(r', line \d+, ')
 
-    def filter(self, traceback: str, similarity_threshold=0.6, max_similar_lines=3, runs=2) -> str:
+class FoldRule(NamedTuple):
+    """
+    Frames of the classes matching the pattern are folded, the label names them in the summary line.
+    """
+    label: str
+    # Regular expression matched at the start of the class name of the frame
+    pattern: str
+    # Set if the pattern is this literal prefix
+    literal_prefix: Optional[str] = None
+
+    @classmethod
+    def prefix(cls, prefix: str, label: str = None) -> 'FoldRule':
         """
-        Filter out similar lines to make traceback more compact.
-        :param traceback:
-        :param similarity_threshold:
-        :param max_similar_lines:
-        :param runs: Run multiple times to remove any new duplicate lines after a cleanup
-        :return: filtred traceback
+        :param prefix: Package or class name prefix, e.g. 'org.springframework.'
+        :param label: Defaults to the prefix without a trailing dot
         """
-        logger.info(f"filtering traceback of length {len(traceback)}")
-        traceback = extract_stacktrace(traceback)
-        traceback = textwrap.dedent(traceback)
-        traceback = self._remove_file_line_numbers(traceback)
-        # remove empty lines
-        traceback = '\n'.join(l for l in traceback.splitlines() if l.strip())
-
-        for run in range(runs):
-            logger.info(f"run: {run}")
-            traceback = self._filter_traceback(traceback, similarity_threshold=similarity_threshold,
-                                               max_similar_lines=max_similar_lines)
-            logger.info(f"filter traceback length {len(traceback)}")
-        logger.info(traceback)
+        return cls(label or prefix.rstrip('.'), re.escape(prefix), prefix)
 
-        return traceback
 
-    def _remove_file_line_numbers(self, traceback: str):
-        return '\n'.join(self._re_remove_line_nr.sub(", ", line) for line in traceback.splitlines(keepends=False))
+class FrameFolder:
+    """
+    Replaces runs of framework frames of a Java traceback with a summary line like '[23 org.springframework frames]'.
+    Only 'at ...' frame lines matching a rule are folded, application frames, exception lines and '... n more'
+    lines are always kept, as is the first frame after an exception line: where the exception was thrown.
+    The rules are compiled into a single regular expression with a named group per rule, a line is matched once.
+    The literal prefixes are merged into a trie so a frame is not compared with each of them in turn, they are
+    tried before the rules with patterns.
+    """
+    MIN_FRAMES = 2
 
-    def _filter_traceback(self, traceback: str, similarity_threshold, max_similar_lines) -> str:
-        def _similarity(a, b):
-            a = self._re_remove_line_nr.sub("", a)
-            b = self._re_remove_line_nr.sub("", b)
-            sim = ratio(a, b)
-            logger.debug("--")
-            logger.debug(a)
-            logger.debug(b)
-            logger.debug(sim)
-            return sim
+    def __init__(self, rules: Sequence[FoldRule], min_frames: int = MIN_FRAMES):
+        """
+        :param min_frames: Shortest run of framework frames that is folded
+        """
+        self.rules = list(rules)
+        self.min_frames = min_frames
+        self._labels = [rule.label for rule in self.rules]
+        prefixes = [(rule.literal_prefix, f"r{i}") for i, rule in enumerate(self.rules) if rule.literal_prefix]
+        alternatives = [_prefix_trie_pattern(prefixes)] if prefixes else []
+        alternatives += [f"(?P<r{i}>{rule.pattern})" for i, rule in enumerate(self.rules) if not rule.literal_prefix]
+        # The empty group matches the frames no rule matches
+        alternatives.append('(?P<other>)')
+        # The class name may be preceded by the module of the JDK class, e.g. 'java.base/', or the class loader
+        module = r'(?:(?:java|jdk)\.[\w.]*(?:@[\w.-]*)?/|app//)?'
+        self._re_frame = re.compile(rf'\s*at\s+{module}(?:{"|".join(alternatives)})')
 
-        out_lines = []
-        last_line = ''
-        similar_lines_count = 0
-        for line in traceback.splitlines(keepends=False):
-            # Check if line contains valuable information, similar to the previous line or '... XXX more'
-            # Check if we have already included the max number of similar lines
-            if last_line and _similarity(last_line, line) > similarity_threshold:
-                similar_lines_count += 1
+    def fold(self, lines: List[str]) -> List[str]:
+        match_frame = self._re_frame.match
+        labels = self._labels
+        out = []
+        # (line, label) of the framework frames since the last kept line
+        run = []
+        previous_is_frame = False
+        for line in lines:
+            match = match_frame(line)
+            if match is not None and previous_is_frame and match.lastgroup != 'other':
+                run.append((line, labels[int(match.lastgroup[1:])]))
             else:
-                similar_lines_count = 1
+                if run:
+                    self._end_run(out, run)
+                out.append(line)
+            previous_is_frame = match is not None
+        if run:
+            self._end_run(out, run)
+        return out
+
+    def _end_run(self, out: List[str], run: list):
+        """
+        Append the run of framework frames to out, folded into a summary line if it is long enough, and clear it.
+        """
+        if len(run) < self.min_frames:
+            out.extend(line for line, _ in run)
+        else:
+            labels = list(dict.fromkeys(label for _, label in run))
+            first_line = run[0][0]
+            indent = first_line[:len(first_line) - len(first_line.lstrip())]
+            if len(labels) == 1:
+                out.append(f"{indent}[{len(run)} {labels[0]} frames]")
+            else:
+                out.append(f"{indent}[{len(run)} framework frames: {', '.join(labels)}]")
+        run.clear()
 
-            if similar_lines_count <= max_similar_lines:
-                out_lines.append(line)
 
-            last_line = line
-        filtred_traceback = '\n'.join(out_lines)
-        logger.debug(f"filter traceback length {len(filtred_traceback)}")
+class PathAliaser:
+    """
+    Shortens the paths of the frames of a Python traceback: the site-packages, standard library, virtualenv and project
+    directories are replaced with an alias, e.g. '<site>/click/core.py', and the aliases are listed once in a line
+    before the traceback: '[paths: <site>=/srv/app/venv/lib/python3.11/site-packages, <project>=/srv/app]'.
+    The project is the directory of the virtualenv, or the common directory of the other files.
+    A directory is only aliased if that makes the traceback shorter.
+    """
+    _re_file = re.compile(r'\s*File "(?P<path>[^"<]+)"')
+    # Tried in this order at the start of a path, the lazy .*? finds the innermost site-packages of a nested venv
+    _re_root = re.compile(r'(?P<site>.*?[/\\](?:site|dist)-packages)[/\\]'
+                          r'|(?P<stdlib>.*?[/\\]lib(?:64)?[/\\]python\d+(?:\.\d+)?)[/\\]', re.IGNORECASE)
+    _re_venv_site = re.compile(r'[/\\]lib(?:64)?(?:[/\\]python\d+(?:\.\d+)?)?[/\\](?:site|dist)-packages$',
+                               re.IGNORECASE)
+    # Names of virtualenv directories, e.g. venv, .venv, env, or app-Xk2L-py3.11 (poetry)
+    _re_venv_name = re.compile(r'\.?v?env[\w.-]*|virtualenv|[\w.-]*-py\d+(?:\.\d+)?', re.IGNORECASE)
+    # Directories holding virtualenvs of any name: of virtualenvwrapper and poetry, conda and tox
+    _venv_parents = ('virtualenvs', 'envs', '.tox')
+
+    def alias(self, lines: List[str]) -> List[str]:
+        """
+        :return: the lines with the paths shortened and the line listing the aliases first, or the lines unchanged
+            if no directory is worth an alias
+        """
+        match_file = self._re_file.match
+        match_root = self._re_root.match
+        # Index of the line and span of the path of each frame
+        files = []
+        # Number of frames of each path, paths repeat a lot and are only looked at once
+        path_counts = {}
+        # Root directory -> kind, in the order they are found
+        roots = {}
+        others = []
+        for i, line in enumerate(lines):
+            match = match_file(line)
+            if match is None:
+                continue
+            path = match.group('path')
+            files.append((i, match.start('path'), match.end('path')))
+            if path in path_counts:
+                path_counts[path] += 1
+                continue
+            path_counts[path] = 1
+            root_match = match_root(path)
+            if root_match is None:
+                others.append(path)
+            else:
+                roots.setdefault(root_match.group(root_match.lastgroup), root_match.lastgroup)
+        if not files:
+            return lines
 
-        return filtred_traceback
+        aliases = self._name_roots(roots, others)
+        kept = sorted(aliases, key=len, reverse=True)
+        while True:
+            # The longest root of each path: the site-packages of a venv before the venv and the project
+            path_roots = {path: next((root for root in kept if _in_directory(path, root)), None) for path in path_counts}
+            uses = dict.fromkeys(kept, 0)
+            for path, root in path_roots.items():
+                if root is not None:
+                    uses[root] += path_counts[path]
+            # An alias pays off if the characters saved are more than those of listing it
+            unprofitable = [root for root in kept
+                            if uses[root] * (len(root) - len(aliases[root])) <= len(root) + len(aliases[root]) + 3]
+            if not unprofitable:
+                break
+            kept = [root for root in kept if root not in unprofitable]
+        if not kept:
+            return lines
+
+        shortened = {path: aliases[root] + path[len(root):] for path, root in path_roots.items() if root is not None}
+        out = list(lines)
+        for i, start, end in files:
+            line = lines[i]
+            path = shortened.get(line[start:end])
+            if path is not None:
+                out[i] = f"{line[:start]}{path}{line[end:]}"
+        legend = ', '.join(f"{alias}={root}" for root, alias in aliases.items() if root in kept)
+        return [f"[paths: {legend}]"] + out
+
+    def _name_roots(self, roots: dict, others: List[str]) -> dict:
+        """
+        :param roots: site-packages and standard library directories -> 'site' or 'stdlib'
+        :param others: the other paths
+        :return: directory -> alias
+        """
+        aliases = {}
+        counts = {}
+        venv = None
+        for root, kind in roots.items():
+            counts[kind] = counts.get(kind, 0) + 1
+            aliases[root] = f"<{kind}{counts[kind] if counts[kind] > 1 else ''}>"
+            if kind == 'site' and venv is None:
+                venv_match = self._re_venv_site.search(root)
+                if venv_match is not None:
+                    candidate = root[:venv_match.start()]
+                    parent, name = _split_path(candidate)
+                    if self._re_venv_name.fullmatch(name) or _split_path(parent)[1] in self._venv_parents:
+                        venv = candidate
+        if venv is not None:
+            aliases[venv] = '<venv>'
+            project = _split_path(venv)[0]
+        else:
+            directories = [_split_path(path)[0] for path in others]
+            project = _common_directory(directories) if len(directories) > 1 else None
+        if project:
+            aliases.setdefault(project, '<project>')
+        return aliases
+
+
+def _split_path(path: str) -> Tuple[str, str]:
+    """
+    :return: directory and name of the path, with / or \\ separators
+    """
+    separator = max(path.rfind('/'), path.rfind('\\'))
+    return path[:max(separator, 0)], path[separator + 1:]
+
+
+def _in_directory(path: str, directory: str) -> bool:
+    return path.startswith(directory) and path[len(directory):len(directory) + 1] in ('/', '\\')
+
+
+def _common_directory(directories: List[str]) -> Optional[str]:
+    """
+    :return: the longest directory all directories are in, None if there is none but the root
+    """
+    prefix = os.path.commonprefix(directories)
+    if not all(len(directory) == len(prefix) or directory[len(prefix)] in '/\\' for directory in directories):
+        prefix = _split_path(prefix)[0]
+    return prefix if prefix.strip('/\\') else None
+
+
+def _prefix_trie_pattern(prefixes: List[Tuple[str, str]]) -> str:
+    """
+    :param prefixes: (literal prefix, name of the group matched with it)
+    :return: Regular expression matching the prefixes, the named group of the longest matching prefix is matched
+    """
+    trie = {}
+    for prefix, group in prefixes:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # The first rule with a prefix wins
+        node.setdefault('', group)
+    return _trie_node_pattern(trie)
+
+
+def _trie_node_pattern(node: dict) -> str:
+    alternatives = [re.escape(char) + _trie_node_pattern(child) for char, child in node.items() if char]
+    if '' in node:
+        # Tried after the longer prefixes
+        alternatives.append(f"(?P<{node['']}>)")
+    return alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+
+
+def _dedent_lines(text: str) -> list[str]:
+    """
+    Same as textwrap.dedent(text).splitlines() but faster on large texts.
+    """
+    lines = text.split('\n')
+    indents = []
+    for line in lines:
+        content = line.lstrip(' \t')
+        if content:
+            indents.append(line[:len(line) - len(content)])
+    margin = os.path.commonprefix(indents) if indents else ''
+    if margin:
+        lines = [line[len(margin):] if line.startswith(margin) else line.lstrip(' \t') for line in lines]
+    return [part for line in lines for part in line.splitlines()]
+
+
+class _FilterStage:
+    __slots__ = ('last_key', 'last_kept', 'similar_lines_count')
+
+    def __init__(self):
+        self.last_key = None
+        self.last_kept = False
+        self.similar_lines_count = 0
+
+    def copy(self) -> '_FilterStage':
+        stage = _FilterStage()
+        stage.last_key = self.last_key
+        stage.last_kept = self.last_kept
+        stage.similar_lines_count = self.similar_lines_count
+        return stage
+
+
+def _is_similar(a: str, b: str, similarity_threshold: float) -> bool:
+    """
+    Same as ratio(a, b) > similarity_threshold, without computing the ratio where the result is known.
+    """
+    if a == b:
+        return 1.0 > similarity_threshold
+    # The ratio can't be higher than when the shorter line is a substring of the longer
+    len_a, len_b = len(a), len(b)
+    if 2 * min(len_a, len_b) / (len_a + len_b) < similarity_threshold - 1e-9:
+        return False
+    # Not ratio with score_cutoff, it returns 0.0 for ratios just above the cutoff
+    return ratio(a, b) > similarity_threshold
+
+
+JAVA_FRAMEWORK_RULES = [
+    FoldRule.prefix('org.springframework.'),
+    # Classes generated by CGLIB, ByteBuddy and JDK dynamic proxies
+    FoldRule('generated proxy',
+             r'[\w.$]*\$(?:\$EnhancerBySpringCGLIB|\$FastClassBySpringCGLIB|\$SpringCGLIB|ByteBuddy|HibernateProxy)\$'),
+    FoldRule.prefix('net.bytebuddy.', 'generated proxy'),
+    FoldRule.prefix('com.sun.proxy.$Proxy', 'generated proxy'),
+    FoldRule('generated proxy', r'jdk\.proxy\d+\.\$Proxy'),
+    FoldRule.prefix('sun.reflect.', 'reflection'),
+    FoldRule.prefix('jdk.internal.reflect.', 'reflection'),
+    FoldRule.prefix('java.lang.reflect.', 'reflection'),
+    FoldRule.prefix('org.apache.catalina.', 'tomcat'),
+    FoldRule.prefix('org.apache.coyote.', 'tomcat'),
+    FoldRule.prefix('org.apache.tomcat.', 'tomcat'),
+    FoldRule.prefix('javax.servlet.', 'servlet'),
+    FoldRule.prefix('jakarta.servlet.', 'servlet'),
+    FoldRule.prefix('reactor.core.', 'reactor'),
+    FoldRule.prefix('reactor.netty.', 'reactor'),
+    FoldRule.prefix('io.reactivex.', 'rxjava'),
+    FoldRule.prefix('io.netty.', 'netty'),
+    FoldRule.prefix('java.util.concurrent.'),
+]
+
+
+class FilterTracebackJava(FilterTraceback):
+    frame_folder = FrameFolder(JAVA_FRAMEWORK_RULES)
+    _re_remove_line_nr = re.compile(r':\d+\)$')
+    _line_nr_replacement = ')'
+    _similarity_replacement = ')'
+
+
+class FilterTracebackPython(FilterTraceback):
+    innermost_frame_last = True
+    path_aliaser: Optional[PathAliaser] = PathAliaser()
+    _re_remove_line_nr = re.compile(r', line \d+, ')
+    _line_nr_replacement = ', '
+    _similarity_replacement = ''
+    _re_frame_start = re.compile(r'\s*File "')
+    # Unindented lines: the 'Traceback' header, exception lines and the texts between chained exceptions
+    _re_cause_line = re.compile(r'\S')
+
+    def filter(self, traceback: str, similarity_threshold=0.6, max_similar_lines=3, runs=2) -> str:
+        traceback = super().filter(traceback, similarity_threshold, max_similar_lines, runs)
+        log_payload(logger, "Filtered traceback", traceback)
+        return traceback
+
+    def _prepare_lines(self, traceback: str) -> list[str]:
+        lines = super()._prepare_lines(extract_stacktrace(traceback))
+        return self.path_aliaser.alias(lines) if self.path_aliaser is not None else lines
+
+    def group_frames(self, lines: list[str]) -> list[list[str]]:
+        # A frame is the 'File ...' line and the indented source lines that follow it
+        frames = []
+        in_frame = False
+        for line in lines:
+            if self._re_frame_start.match(line):
+                frames.append([line])
+                in_frame = True
+            elif in_frame and line[:1].isspace() and line.lstrip()[:1] != '[':
+                frames[-1].append(line)
+            else:
+                frames.append([line])
+                in_frame = False
+        return frames
 
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
+import asyncio
 import logging
 
 from db import UsersDB
-from .analyser import Analyser
+from metrics import rejections_total, stage_seconds
+from state import LocalState, StateBackend
 from .exceptions import AnalyzeException
 
 logging.basicConfig(level=logging.INFO)
@@ -9,25 +11,131 @@ logger = logging.getLogger(__name__)
 
 _user_db = UsersDB()
 
+
+class UsageLedger:
+    """
+    Write behind ledger of the users token usage and request count.
+
+    The usage of a user is kept as counters in the state backend, loaded from the database on first use and
+    incremented by every request, so with a shared backend all workers enforce the quotas on the same numbers.
+    The counters expire STALENESS seconds after the last usage was added, by then the usage has been written to
+    the database and the next request loads it from there again.
+    Usage added by requests is also accumulated per worker and written to the database in batches by flush
+    (see run_flush), so the database is not accessed on every request.
+    """
+    STALENESS = 30
+    FLUSH_INTERVAL = 10
+
+    def __init__(self, user_db: UsersDB, state: StateBackend = None):
+        self._user_db = user_db
+        self._state = state or LocalState()
+        self._pending = {}
+        self._flushing = {}
+        self._flush_lock = None
+
+    def connect(self):
+        self._user_db.connect()
+
+    async def get_usage(self, email: str) -> dict:
+        """
+        :return: dict with the users token_usage and requests_count, including usage not yet flushed
+        """
+        key = _usage_key(email)
+        usage = await self._state.get_counters(key)
+        if usage is None:
+            if email in self._flushing:
+                # Wait for the write, otherwise the usage being written may be counted twice or not at all
+                async with self._get_flush_lock():
+                    pass
+            item = await asyncio.to_thread(self._user_db.get_or_create_user, email)
+            usage = {'token_usage': int(item['token_usage']), 'requests_count': int(item['requests_count'])}
+            for deltas in (self._flushing, self._pending):
+                token_usage, requests = deltas.get(email, (0, 0))
+                usage['token_usage'] += token_usage
+                usage['requests_count'] += requests
+            usage = await self._state.init_counters(key, usage, self.STALENESS)
+        return usage
+
+    async def add(self, email: str, token_usage: int, requests: int = 1):
+        self._add_pending(email, token_usage, requests)
+        # If the counters have expired they are loaded again including the pending usage
+        await self._state.incr_counters(_usage_key(email), {'token_usage': token_usage, 'requests_count': requests},
+                                        self.STALENESS)
+
+    def _add_pending(self, email: str, token_usage: int, requests: int):
+        pending_token_usage, pending_requests = self._pending.get(email, (0, 0))
+        self._pending[email] = (pending_token_usage + token_usage, pending_requests + requests)
+
+    def _get_flush_lock(self) -> asyncio.Lock:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def flush(self):
+        """
+        Write the accumulated usage to the database, one update per user.
+        Usage that fails to be written is kept and retried on the next flush.
+        """
+        async with self._get_flush_lock():
+            await self._flush()
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for i, (email, (token_usage, requests)) in enumerate(items):
+            self._flushing[email] = (token_usage, requests)
+            try:
+                await asyncio.to_thread(self._user_db.add_usage, email, token_usage, requests)
+            except Exception as e:
+                logger.warning(f"Failed to flush usage for {email}, will retry: {e}")
+                self._add_pending(email, token_usage, requests)
+            except BaseException:
+                # Cancelled, the write in progress goes on in its thread, the users after it are written next flush
+                for unwritten_email, (unwritten_token_usage, unwritten_requests) in items[i + 1:]:
+                    self._add_pending(unwritten_email, unwritten_token_usage, unwritten_requests)
+                raise
+            finally:
+                del self._flushing[email]
+        if pending:
+            logger.info(f"Flushed usage for {len(pending)} users")
+
+    async def run_flush(self, interval: float = None):
+        """
+        Flush periodically, meant to be run as a background task.
+        """
+        interval = interval or self.FLUSH_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
 class Quotas:
     MAX_TOKEN_USAGE = 40000
     MAX_REQUESTS = 200
 
-    def check(self, user_info):
-        user_item = _user_db.get_or_create_user(user_info['email'])
+    def __init__(self, ledger: UsageLedger = None, state: StateBackend = None):
+        self.ledger = ledger or UsageLedger(_user_db, state)
+
+    async def check(self, user_info):
+        with stage_seconds.time('quota_check'):
+            user_item = await self.ledger.get_usage(user_info['email'])
         logger.info(f"user_item: {user_item}")
         if self.MAX_TOKEN_USAGE <= user_item['token_usage']:
+            rejections_total.inc('token_quota')
             raise AnalyzeException(
                 f"Sorry, Token usage quota for user {user_info['email']} reached. Used: {user_item['token_usage']} Limt: {Quotas.MAX_TOKEN_USAGE}",
                 413)
         elif self.MAX_REQUESTS <= user_item['requests_count']:
+            rejections_total.inc('request_quota')
             raise AnalyzeException(
                 f"Sorry, Max requests quota for user {user_info['email']} reached. Used: {user_item['requests_count']} Limt: {Quotas.MAX_REQUESTS}",
                 413)
 
-    def add_usage(self, user_info, analyser: "Analyser"):
-        # update token usage
-        add_usage_response = _user_db.add_usage(
-            user_info['email'],
-            analyser.input_token_count + analyser.generated_token_count)
-        logger.info(f"add_usage_response: {add_usage_response}")
+    async def add_usage(self, user_info, token_usage: int):
+        # update token usage, written to the database by the next flush
+        with stage_seconds.time('usage_update'):
+            await self.ledger.add(user_info['email'], token_usage)
+
+
+def _usage_key(email: str) -> str:
+    return f"usage:{email}"
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator
+
+from metrics import rejections_total, stage_seconds
+from .exceptions import AnalyzeException
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """
+    Admission control for requests to the LLM.
+
+    At most max_concurrent requests run at a time. Waiting requests are queued per user and admitted round robin
+    over the users, so a user with many requests waits for their own requests but does not delay other users by
+    more than one request each. A request that has waited queue_timeout seconds is rejected.
+
+    Usage:
+        ticket = scheduler.enqueue(email)
+        try:
+            async for position in ticket.wait():
+                ...  # tell the user the position in the queue
+            ...  # call the LLM
+        finally:
+            ticket.release()
+    """
+    MAX_CONCURRENT = 10
+    QUEUE_TIMEOUT = 60
+    # Seconds between checks of the queue position while waiting
+    POSITION_INTERVAL = 1.0
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT, queue_timeout: float = QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self._running = 0
+        # Queues of waiting tickets per user, the first user is the next to be admitted
+        self._queues = OrderedDict()
+        self._queued = 0
+        self.admitted = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def enqueue(self, user: str) -> 'Ticket':
+        ticket = Ticket(self, user)
+        if self._running < self.max_concurrent and not self._queues:
+            self._admit(ticket)
+        else:
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._queued += 1
+        return ticket
+
+    def position(self, ticket: 'Ticket') -> int:
+        """
+        :return: 1 based position of a waiting ticket, the number of requests admitted before it plus one
+        """
+        queue = self._queues.get(ticket.user)
+        if ticket.admitted.done() or not queue:
+            return 0
+        index = queue.index(ticket)
+        position = index + 1
+        before = True
+        for user, user_queue in self._queues.items():
+            if user == ticket.user:
+                before = False
+            else:
+                # Users before this one in the round get a turn in every round up to and including this one's
+                position += min(len(user_queue), index + 1 if before else index)
+        return position
+
+    def stats(self) -> dict:
+        return {
+            'running': self._running,
+            'queued': self._queued,
+            'queued_users': len(self._queues),
+            'admitted': self.admitted,
+            'timed_out': self.timed_out,
+            'wait_avg_ms': round(self.total_wait / self.admitted * 1000, 1) if self.admitted else 0.0,
+            'wait_max_ms': round(self.max_wait * 1000, 1),
+        }
+
+    def _admit(self, ticket: 'Ticket'):
+        self._running += 1
+        ticket.admitted.set_result(None)
+        wait = time.monotonic() - ticket.created
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        stage_seconds.observe(wait, 'queue_wait')
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent and self._queues:
+            user, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self._admit(ticket)
+
+    def _remove(self, ticket: 'Ticket'):
+        queue = self._queues.get(ticket.user)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self._queued -= 1
+            if not queue:
+                del self._queues[ticket.user]
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+
+class Ticket:
+    def __init__(self, scheduler: FairScheduler, user: str):
+        self.user = user
+        self.created = time.monotonic()
+        self.admitted = asyncio.get_running_loop().create_future()
+        self._scheduler = scheduler
+        self._released = False
+
+    async def wait(self) -> AsyncIterator[int]:
+        """
+        Wait until admitted, yields the position in the queue whenever it changes.
+        :raises AnalyzeException: 503 if not admitted within the queue timeout
+        """
+        scheduler = self._scheduler
+        last_position = None
+        while not self.admitted.done():
+            position = scheduler.position(self)
+            if position != last_position:
+                last_position = position
+                yield position
+            remaining = self.created + scheduler.queue_timeout - time.monotonic()
+            try:
+                await asyncio.wait_for(asyncio.shield(self.admitted), min(scheduler.POSITION_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                if not self.admitted.done() and time.monotonic() - self.created >= scheduler.queue_timeout:
+                    scheduler._remove(self)
+                    scheduler.timed_out += 1
+                    rejections_total.inc('queue_timeout')
+                    self._released = True
+                    logger.info(f"Request of {self.user} timed out in queue at position {position}")
+                    raise AnalyzeException("Sorry, too many requests right now, please try again later", 503)
+
+    def release(self):
+        """
+        Give back the slot when done, or leave the queue if not admitted yet. Safe to call more than once.
+        """
+        if self._released:
+            return
+        self._released = True
+        if self.admitted.done():
+            self._scheduler._release()
+        else:
+            self._scheduler._remove(self)
+            self.admitted.cancel()
@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, List, Optional
+
+from pydantic import BaseModel
+
+from metrics import rejections_total
+from state import StateBackend
+from .exceptions import AnalyzeException
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STREAMING_STATUS = 'STREAMING_RESPONSE'
+
+
+class Message(BaseModel):
+    status: str
+    stage: str
+    message: str
+
+
+class AnalysisSession:
+    """
+    An analysis running in its own task, independent of the websocket that started it. The messages of the
+    analysis are kept in a buffer of at most max_chars characters, clients follow the session from an offset in
+    the answer, so a client that lost its connection can reconnect and get the rest of the answer.
+    A session can also be a mirror of a session running in another worker, built from its snapshots.
+    """
+
+    def __init__(self, session_id: str, owner: str, max_chars: int):
+        self.session_id = session_id
+        self.owner = owner
+        self.max_chars = max_chars
+        # (position, message), position is the number of answer characters streamed before the message
+        self._entries = deque()
+        # Number of entries dropped from the start of the buffer
+        self._dropped = 0
+        # Answer characters that can no longer be replayed
+        self._dropped_chars = 0
+        self.buffered_chars = 0
+        self.answer_chars = 0
+        self.done = False
+        self.error: Optional[AnalyzeException] = None
+        self.attached = 0
+        self.idle_since = time.monotonic()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_snapshot(cls, session_id: str, snapshot: dict, max_chars: int) -> 'AnalysisSession':
+        """
+        :return: a session with the buffer and state of the snapshot, started separately if it is not done
+        """
+        session = cls(session_id, snapshot['owner'], max_chars)
+        # The answer starts where the buffer of the snapshot does
+        session._dropped_chars = session.answer_chars = snapshot['dropped_chars']
+        for entry in snapshot['entries']:
+            session._append(_message(entry))
+        session.done = snapshot['done']
+        if snapshot['error'] is not None:
+            session.error = AnalyzeException(*snapshot['error'])
+        return session
+
+    def snapshot(self) -> dict:
+        """
+        :return: the buffer and state of the session, JSON serializable
+        """
+        return {
+            'owner': self.owner,
+            # Number of entries dropped before the first one, entries are numbered from the start of the session
+            'first_entry': self._dropped,
+            'dropped_chars': self._dropped_chars,
+            'entries': [[position, message.status, message.stage, message.message]
+                        for position, message in self._entries],
+            'done': self.done,
+            'error': [str(self.error), self.error.status_code] if self.error is not None else None,
+        }
+
+    def start(self, messages: AsyncIterator):
+        self._task = asyncio.create_task(self._run(messages))
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def follow(self, offset: int = 0) -> AsyncIterator:
+        """
+        Yield the messages of the analysis, from offset characters into the answer, then as they come until the
+        analysis is done. Status messages that came before the offset are not replayed, except for offset 0.
+        Close the generator when done with it, so the session knows when no client follows it.
+        :raises AnalyzeException: error of the analysis, or 410 if the answer from offset is no longer buffered
+        """
+        if offset < 0 or offset > self.answer_chars:
+            raise AnalyzeException(
+                f"Sorry, invalid offset {offset}, the answer has {self.answer_chars} characters", 400)
+        if offset < self._dropped_chars:
+            raise AnalyzeException("Sorry, the start of the answer is no longer available", 410)
+        self.attached += 1
+        try:
+            index = self._dropped
+            replay_end = self._dropped + len(self._entries)
+            while True:
+                changed = self._changed
+                while index < self._dropped + len(self._entries):
+                    if index < self._dropped:
+                        raise AnalyzeException("Sorry, the answer was not read fast enough", 410)
+                    position, message = self._entries[index - self._dropped]
+                    index += 1
+                    if index <= replay_end:
+                        message = self._replayed(message, position, offset)
+                        if message is None:
+                            continue
+                    yield message
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.attached -= 1
+            self.idle_since = time.monotonic()
+
+    @staticmethod
+    def _replayed(message, position: int, offset: int):
+        """
+        :return: the part of a buffered message after offset, None if the client already has it
+        """
+        if message.status != STREAMING_STATUS:
+            return message if offset == 0 or position > offset else None
+        if position + len(message.message) <= offset:
+            return None
+        if position >= offset:
+            return message
+        return type(message)(status=message.status, stage=message.stage, message=message.message[offset - position:])
+
+    async def _run(self, messages: AsyncIterator):
+        try:
+            async for message in messages:
+                self._append(message)
+        except AnalyzeException as e:
+            self.error = e
+        except asyncio.CancelledError:
+            self.error = AnalyzeException("Sorry, the analysis was stopped", 503)
+            raise
+        except Exception as e:
+            logger.exception(f"Failed to analyse traceback of session {self.session_id}: {e}")
+            self.error = AnalyzeException(f"Failed to analyse traceback: {e}", 500)
+        finally:
+            await messages.aclose()
+            self.done = True
+            self.idle_since = time.monotonic()
+            self._notify()
+
+    def _append(self, message):
+        self._entries.append((self.answer_chars, message))
+        self.buffered_chars += len(message.message)
+        if message.status == STREAMING_STATUS:
+            self.answer_chars += len(message.message)
+        while self.buffered_chars > self.max_chars and len(self._entries) > 1:
+            position, dropped = self._entries.popleft()
+            self._dropped += 1
+            self.buffered_chars -= len(dropped.message)
+            self._dropped_chars = self._entries[0][0]
+        self._notify()
+
+    def _notify(self):
+        changed = self._changed
+        self._changed = asyncio.Event()
+        changed.set()
+
+
+class SessionStore:
+    """
+    The analysis sessions of the worker, so an analysis survives a dropped websocket: the LLM stream goes on into
+    the buffer of the session and a client reconnecting with the session id resumes the answer instead of paying
+    for a new analysis.
+    A session expires ttl seconds after it is done or its last client left, whichever is later, a running session
+    is then cancelled, see run_expiry. Memory is bounded by max_sessions of at most max_session_chars buffered
+    characters each, when full the session idle the longest is dropped, new sessions are rejected if every session
+    has a client.
+
+    If the state backend is shared by the workers a client can reconnect to any of them: the worker running a
+    session publishes a snapshot of it at most every PUBLISH_INTERVAL seconds, another worker resumes it from a
+    mirror polling the snapshots every POLL_INTERVAL seconds. The session still expires ttl seconds after its
+    last client on the worker running it left.
+    """
+    TTL = 300
+    MAX_SESSIONS = 1000
+    MAX_SESSION_CHARS = 64 * 1024
+    # Seconds between checks for expired sessions, see run_expiry
+    EXPIRY_INTERVAL = 10
+    PUBLISH_INTERVAL = 0.2
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, ttl: float = TTL, max_sessions: int = MAX_SESSIONS, max_session_chars: int = MAX_SESSION_CHARS,
+                 state: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_session_chars = max_session_chars
+        # A state backend local to the process has nothing to share
+        self._state = state if state is not None and state.shared else None
+        self._sessions = OrderedDict()
+        self._publishers = set()
+        self.started = 0
+        self.resumed = 0
+        self.mirrored = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def start(self, owner: str, messages: AsyncIterator) -> AnalysisSession:
+        """
+        Run the analysis yielding messages in a new session of the owner.
+        :raises AnalyzeException: 503 if there is no room for another session
+        """
+        self._make_room()
+        session = AnalysisSession(secrets.token_urlsafe(16), owner, self.max_session_chars)
+        self._sessions[session.session_id] = session
+        session.start(messages)
+        if self._state is not None:
+            publisher = asyncio.create_task(self._publish(session))
+            self._publishers.add(publisher)
+            publisher.add_done_callback(self._publishers.discard)
+        self.started += 1
+        return session
+
+    async def get(self, session_id: str, owner: str) -> AnalysisSession:
+        """
+        :return: the session, or a mirror of it if it runs in another worker
+        :raises AnalyzeException: 404 if there is no such session of the owner, 503 if there is no room for a mirror
+        """
+        self._purge()
+        session = self._sessions.get(session_id)
+        if session is None and self._state is not None:
+            snapshot = await self._state.get(_state_key(session_id))
+            # Another client may have resumed the session meanwhile
+            session = self._sessions.get(session_id)
+            if session is None and snapshot is not None and snapshot['owner'] == owner:
+                session = self._mirror(session_id, snapshot)
+        if session is None or session.owner != owner:
+            rejections_total.inc('session_not_found')
+            raise AnalyzeException("Sorry, the analysis session has expired", 404)
+        self.resumed += 1
+        return session
+
+    def stats(self) -> dict:
+        sessions = list(self._sessions.values())
+        return {
+            'sessions': len(sessions),
+            'running': sum(not session.done for session in sessions),
+            'detached': sum(not session.attached for session in sessions),
+            'started': self.started,
+            'resumed': self.resumed,
+            'mirrored': self.mirrored,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+    async def run_expiry(self, interval: float = None):
+        """
+        Drop the expired sessions periodically, cancelling the ones still running, meant to be run as a background
+        task. Sessions are also checked for expiry when one is started or resumed.
+        """
+        interval = interval or self.EXPIRY_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            self._purge()
+
+    def close(self):
+        for session in self._sessions.values():
+            session.cancel()
+        self._sessions.clear()
+        for publisher in self._publishers:
+            publisher.cancel()
+
+    def _make_room(self):
+        """
+        :raises AnalyzeException: 503 if there is no room for another session
+        """
+        self._purge()
+        if len(self._sessions) >= self.max_sessions and not self._evict():
+            rejections_total.inc('sessions_full')
+            raise AnalyzeException("Sorry, too many analyses running, try again in a moment", 503)
+
+    def _mirror(self, session_id: str, snapshot: dict) -> AnalysisSession:
+        """
+        :return: a session following the snapshots of a session running in another worker
+        """
+        self._make_room()
+        session = AnalysisSession.from_snapshot(session_id, snapshot, self.max_session_chars)
+        if not session.done:
+            session.start(self._follow_shared(session_id, snapshot['first_entry'] + len(snapshot['entries'])))
+        self._sessions[session_id] = session
+        self.mirrored += 1
+        return session
+
+    async def _publish(self, session: AnalysisSession):
+        """
+        Publish snapshots of a session to the shared state until it is done.
+        """
+        while True:
+            changed, snapshot = session._changed, session.snapshot()
+            try:
+                await self._state.set(_state_key(session.session_id), snapshot, self.ttl)
+            except Exception as e:
+                logger.warning(f"Failed to share session {session.session_id}: {e}")
+            if snapshot['done']:
+                return
+            await changed.wait()
+            await asyncio.sleep(self.PUBLISH_INTERVAL)
+
+    async def _follow_shared(self, session_id: str, entry: int) -> AsyncIterator[Message]:
+        """
+        Yield the messages of a session running in another worker from its snapshots, from the entry number.
+        """
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            snapshot = await self._state.get(_state_key(session_id))
+            if snapshot is None:
+                raise AnalyzeException("Sorry, the analysis session has expired", 404)
+            if entry < snapshot['first_entry']:
+                raise AnalyzeException("Sorry, the answer was not read fast enough", 410)
+            for item in snapshot['entries'][entry - snapshot['first_entry']:]:
+                yield _message(item)
+            entry = snapshot['first_entry'] + len(snapshot['entries'])
+            if snapshot['done']:
+                if snapshot['error'] is not None:
+                    raise AnalyzeException(*snapshot['error'])
+                return
+
+    def _purge(self):
+        expires = time.monotonic() - self.ttl
+        for session in [session for session in self._sessions.values()
+                        if not session.attached and session.idle_since < expires]:
+            self._remove(session)
+            self.expired += 1
+
+    def _evict(self) -> bool:
+        """
+        Drop the session without a client that has been idle the longest, preferring the ones that are done.
+        :return: False if every session has a client
+        """
+        idle = [session for session in self._sessions.values() if not session.attached]
+        if not idle:
+            return False
+        session = min(idle, key=lambda session: (not session.done, session.idle_since))
+        logger.info(f"Too many analysis sessions, dropping session {session.session_id}")
+        self._remove(session)
+        self.evicted += 1
+        return True
+
+    def _remove(self, session: AnalysisSession):
+        session.cancel()
+        del self._sessions[session.session_id]
+
+
+def _state_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+def _message(entry: List) -> Message:
+    _, status, stage, message = entry
+    return Message(status=status, stage=stage, message=message)
@@ -0,0 +1,216 @@
+import bisect
+import hashlib
+import logging
+import random
+import re
+import zlib
+from array import array
+from typing import List, NamedTuple, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_re_exception = re.compile(
+    r'^\s*(?:Caused by:\s*|Exception in thread "[^"]*"\s*)?'
+    r'([A-Za-z_][\w$]*(?:\.[A-Za-z_][\w$]*)*(?:Error|Exception|Throwable|Warning|Exit|Interrupt|Fault))'
+    r'(?::\s*(.*))?$')
+_re_java_frame = re.compile(r'^\s*at\s+([^\s(]+)\(')
+_re_python_frame = re.compile(r'^\s*File "([^"]*)",(?: line \d+,)? in (\S+)')
+_re_generated_name = re.compile(r'\$\$[\w$]*|\$\d+|/0x[0-9a-fA-F]+|\d+')
+
+_MESSAGE_LITERALS = [
+    (re.compile(r'"[^"]*"|\'[^\']*\''), '<STR>'),
+    (re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'), '<UUID>'),
+    (re.compile(r'(?:[A-Za-z]:)?(?:[\\/][\w.$~-]+){2,}[\\/]?'), '<PATH>'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b|@[0-9a-fA-F]{4,}\b'), '<ID>'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '<NUM>'),
+]
+
+
+class TracebackSignature(NamedTuple):
+    exception_types: Tuple[str, ...]
+    message: str
+    frames: Tuple[str, ...]
+
+
+def extract_signature(trace: str, max_frames: int = 20, innermost_last: bool = False) -> TracebackSignature:
+    """
+    Extract the parts of a (filtered) traceback that identify the error, with everything that differs between
+    occurrences of the same error (object ids, temp paths, line numbers, thread names...) masked.
+    :param max_frames: Number of frames closest to where the exception was raised to include
+    :param innermost_last: True for python tracebacks where the innermost frame comes last
+    """
+    exception_types = []
+    message = ''
+    frames = []
+    for line in trace.splitlines():
+        match = _re_java_frame.match(line)
+        if match:
+            frames.append(_re_generated_name.sub('#', match.group(1)))
+            continue
+        match = _re_python_frame.match(line)
+        if match:
+            path = match.group(1).replace('\\', '/').rsplit('/', 2)[-2:]
+            frames.append(f"{'/'.join(path)}:{match.group(2)}")
+            continue
+        match = _re_exception.match(line)
+        if match:
+            exception_types.append(match.group(1))
+            if not message or innermost_last:
+                message = _mask_literals(match.group(2) or '')
+    frames = frames[-max_frames:] if innermost_last else frames[:max_frames]
+    return TracebackSignature(tuple(exception_types), message, tuple(frames))
+
+
+def _mask_literals(message: str) -> str:
+    for regexp, replacement in _MESSAGE_LITERALS:
+        message = regexp.sub(replacement, message)
+    return message
+
+
+class NearDuplicateIndex:
+    """
+    Index of tracebacks for finding a previously seen traceback that is similar to a new one.
+
+    Each traceback is reduced to a signature and a MinHash of the signature shingles (exception types, message
+    words and frame uni/bigrams). MinHashes are indexed with LSH, the hash is split in bands and tracebacks
+    sharing any band are candidates, candidates must have the same scope and exception types and an estimated
+    Jaccard similarity above the threshold.
+
+    Storage is array backed to stay compact with hundreds of thousands of entries: per entry the MinHash,
+    a hash of scope and exception types and the value (a 32 byte digest, e.g. an answer cache key).
+    Band postings are kept as sorted arrays of (band hash << ID_BITS | id) that new postings are merged into
+    in batches. When max_entries is reached the oldest entries are overwritten.
+    """
+    NUM_HASHES = 32
+    BANDS = 8
+    ID_BITS = 20
+    MERGE_SIZE = 4096
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = 0.9, max_entries: int = 1 << ID_BITS, max_frames: int = 20):
+        assert max_entries <= 1 << self.ID_BITS
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_frames = max_frames
+        self._rows = self.NUM_HASHES // self.BANDS
+        rnd = random.Random(4711)
+        self._permutations = [(rnd.randrange(1, self._PRIME), rnd.randrange(0, self._PRIME))
+                              for _ in range(self.NUM_HASHES)]
+        self._minhashes = array('I')
+        self._type_hashes = array('Q')
+        self._values = bytearray()
+        self._next_id = 0
+        self._wrapped = False
+        self._postings = [array('Q') for _ in range(self.BANDS)]
+        self._new_postings = [{} for _ in range(self.BANDS)]
+        self._new_postings_count = 0
+
+    def __len__(self):
+        return self.max_entries if self._wrapped else self._next_id
+
+    def add(self, scope: str, trace: str, value: str, innermost_last: bool = False):
+        """
+        :param scope: Only tracebacks with the same scope are considered similar, e.g. language and model
+        :param value: Hex digest (64 characters) returned by find for similar tracebacks
+        """
+        signature = extract_signature(trace, self.max_frames, innermost_last)
+        minhash = self._minhash(signature)
+        if minhash is None:
+            return
+        entry_id = self._next_id
+        value = bytes.fromhex(value)
+        if self._wrapped:
+            offset = entry_id * self.NUM_HASHES
+            self._minhashes[offset:offset + self.NUM_HASHES] = minhash
+            self._type_hashes[entry_id] = self._type_hash(scope, signature)
+            self._values[entry_id * 32:entry_id * 32 + 32] = value
+        else:
+            self._minhashes.extend(minhash)
+            self._type_hashes.append(self._type_hash(scope, signature))
+            self._values.extend(value)
+        for band, band_hash in enumerate(self._band_hashes(minhash)):
+            self._new_postings[band].setdefault(band_hash, []).append(entry_id)
+        self._new_postings_count += 1
+        self._next_id += 1
+        if self._next_id == self.max_entries:
+            self._next_id = 0
+            self._wrapped = True
+        if self._new_postings_count >= self.MERGE_SIZE:
+            self._merge()
+
+    def find(self, scope: str, trace: str, innermost_last: bool = False) -> Optional[Tuple[str, float]]:
+        """
+        :return: (value, estimated similarity) of the most similar traceback above threshold, or None
+        """
+        signature = extract_signature(trace, self.max_frames, innermost_last)
+        minhash = self._minhash(signature)
+        if minhash is None:
+            return None
+        type_hash = self._type_hash(scope, signature)
+        candidates = set()
+        for band, band_hash in enumerate(self._band_hashes(minhash)):
+            candidates.update(self._new_postings[band].get(band_hash, ()))
+            postings = self._postings[band]
+            start = band_hash << self.ID_BITS
+            i = bisect.bisect_left(postings, start)
+            while i < len(postings) and postings[i] >> self.ID_BITS == band_hash:
+                candidates.add(postings[i] & ((1 << self.ID_BITS) - 1))
+                i += 1
+
+        best = None
+        for entry_id in candidates:
+            if self._type_hashes[entry_id] != type_hash:
+                continue
+            offset = entry_id * self.NUM_HASHES
+            stored = self._minhashes[offset:offset + self.NUM_HASHES]
+            similarity = sum(1 for a, b in zip(minhash, stored) if a == b) / self.NUM_HASHES
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (self._values[entry_id * 32:entry_id * 32 + 32].hex(), similarity)
+        return best
+
+    def _minhash(self, signature: TracebackSignature) -> Optional[List[int]]:
+        shingles = [f"T:{t}" for t in signature.exception_types]
+        shingles.extend(f"M:{word}" for word in signature.message.split())
+        shingles.extend(f"F:{frame}" for frame in signature.frames)
+        shingles.extend(f"B:{a}>{b}" for a, b in zip(signature.frames, signature.frames[1:]))
+        if not shingles:
+            return None
+        hashes = {zlib.crc32(shingle.encode()) for shingle in shingles}
+        prime = self._PRIME
+        return [min((a * x + b) % prime for x in hashes) & 0xFFFFFFFF for a, b in self._permutations]
+
+    def _band_hashes(self, minhash: List[int]) -> List[int]:
+        rows = self._rows
+        mask = (1 << (64 - self.ID_BITS)) - 1
+        return [hash(tuple(minhash[band * rows:(band + 1) * rows])) & mask for band in range(self.BANDS)]
+
+    @staticmethod
+    def _type_hash(scope: str, signature: TracebackSignature) -> int:
+        data = '\n'.join((scope,) + signature.exception_types).encode()
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+    def _merge(self):
+        id_mask = (1 << self.ID_BITS) - 1
+        for band in range(self.BANDS):
+            postings = self._postings[band]
+            if self._wrapped:
+                # Drop postings of entries that have been overwritten since they were added
+                rows = self._rows
+                valid = []
+                for posting in postings:
+                    entry_id = posting & id_mask
+                    offset = entry_id * self.NUM_HASHES + band * rows
+                    band_hash = hash(tuple(self._minhashes[offset:offset + rows])) & (
+                            (1 << (64 - self.ID_BITS)) - 1)
+                    if band_hash == posting >> self.ID_BITS:
+                        valid.append(posting)
+                postings = valid
+            merged = list(postings)
+            for band_hash, entry_ids in self._new_postings[band].items():
+                merged.extend((band_hash << self.ID_BITS) | entry_id for entry_id in entry_ids)
+            merged.sort()
+            self._postings[band] = array('Q', merged)
+            self._new_postings[band] = {}
+        self._new_postings_count = 0
+        logger.debug(f"Merged similarity index postings, entries: {len(self)}")
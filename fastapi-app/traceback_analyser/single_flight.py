@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import math
+from typing import AsyncIterator, Callable, Dict, Tuple
+
+from .analyser import Analyser
+from .sessions import AnalysisSession
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUEUED_STATUS = 'QUEUED'
+
+
+class Flight:
+    """
+    An LLM analysis followed by every request for the same prompt while it runs. The answer is streamed into an
+    AnalysisSession, each subscriber follows it at its own pace from the start: a slow subscriber only delays itself,
+    never the LLM stream or the other subscribers.
+    """
+
+    def __init__(self, key: str, analyser: Analyser, max_chars: int):
+        self.key = key
+        # The analyser of the first request, it counts the tokens of the call
+        self.analyser = analyser
+        self.session = AnalysisSession(key, '', max_chars)
+        self.subscribers = 0
+        self.joined = 0
+        # Subscribers following the flight when it was done, the ones sharing the cost
+        self.charged_subscribers = 0
+        # Queue position messages of the call, they are about the first request and only sent to it, None once the
+        # call has been admitted
+        self.queue_messages = asyncio.Queue()
+        self.admitted = False
+
+    def follow(self) -> AsyncIterator:
+        return self.session.follow(0)
+
+    async def follow_queue(self) -> AsyncIterator:
+        """
+        Yield the queue position messages until the call is admitted, for the request that started the flight.
+        """
+        while True:
+            message = await self.queue_messages.get()
+            if message is None:
+                return
+            yield message
+
+    def admit(self):
+        if not self.admitted:
+            self.admitted = True
+            self.queue_messages.put_nowait(None)
+
+    @property
+    def token_usage(self) -> int:
+        return self.analyser.input_token_count + self.analyser.generated_token_count
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent analyses: the first request for a prompt starts the LLM call, requests for the
+    same prompt (same answer cache key) made while it runs follow its stream instead of making their own call.
+    When an incident makes many users paste the same traceback they get one LLM call between them.
+
+    The queue position messages of the call are only sent to the first request, the LLM stream to all subscribers.
+    The usage of the call is charged according to charge_policy:
+    - 'full': every subscriber is charged the full usage, as if it had made the call
+    - 'split': the usage is split evenly between the subscribers still following the flight when it is done, the
+      ones that are charged
+    - 'first': the first request is charged the full usage, the others follower_charge like a cache hit
+    The call is cancelled if every subscriber leaves before it is done.
+    """
+    CHARGE_POLICIES = ('full', 'split', 'first')
+    CHARGE_POLICY = 'full'
+    # The answer is at most OUTPUT_MAX_TOKENS, the buffer never drops anything a late subscriber needs
+    MAX_CHARS = 1024 * 1024
+
+    def __init__(self, charge_policy: str = CHARGE_POLICY, follower_charge: int = 0, max_chars: int = MAX_CHARS):
+        if charge_policy not in self.CHARGE_POLICIES:
+            raise ValueError(f"Unknown charge policy {charge_policy}, one of {', '.join(self.CHARGE_POLICIES)}")
+        self.charge_policy = charge_policy
+        self.follower_charge = follower_charge
+        self.max_chars = max_chars
+        self._flights: Dict[str, Flight] = {}
+        self.flights = 0
+        self.followers = 0
+
+    def join(self, key: str, analyser: Analyser, start: Callable[[], AsyncIterator]) -> Tuple[Flight, bool]:
+        """
+        Follow the flight of the key, or start one streaming the messages of start().
+        Call leave when done with the flight.
+        :param analyser: Analyser start() calls the LLM with, used to charge the usage
+        :return: the flight and whether this request started it
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight(key, analyser, self.max_chars)
+            self._flights[key] = flight
+            flight.session.start(self._run(flight, start()))
+            self.flights += 1
+        else:
+            self.followers += 1
+            logger.info(f"Following the analysis in progress of an identical traceback, {flight.joined} before")
+        flight.subscribers += 1
+        flight.joined += 1
+        return flight, leader
+
+    def leave(self, flight: Flight):
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.session.done:
+            logger.info("Every request left, cancelling the analysis")
+            flight.session.cancel()
+            self._remove(flight)
+
+    def charge(self, flight: Flight, leader: bool) -> int:
+        """
+        :return: tokens to charge a subscriber of a flight that is done
+        """
+        if self.charge_policy == 'split':
+            return math.ceil(flight.token_usage / max(flight.charged_subscribers, 1))
+        if self.charge_policy == 'first' and not leader:
+            return self.follower_charge
+        return flight.token_usage
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._flights),
+            'flights': self.flights,
+            'followers': self.followers,
+        }
+
+    async def _run(self, flight: Flight, messages: AsyncIterator) -> AsyncIterator:
+        try:
+            async for message in messages:
+                if message.status == QUEUED_STATUS and not flight.admitted:
+                    flight.queue_messages.put_nowait(message)
+                    continue
+                flight.admit()
+                yield message
+            flight.charged_subscribers = flight.subscribers
+        finally:
+            flight.admit()
+            # Later requests are served by the answer cache
+            self._remove(flight)
+            await messages.aclose()
+
+    def _remove(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
@@ -0,0 +1,116 @@
+import logging
+import math
+import threading
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+import tiktoken
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    """
+    Counts tokens of the tiktoken encoding of a model.
+
+    The encoding is loaded by preload (at startup) instead of by the first request. Counts of texts that are seen
+    over and over (instructions, templates, traceback lines) are cached. Filtering counts tokens per line and sums
+    them for any subset of lines, the sum is an estimate of the count of the joined lines: the tokenizer can
+    merge a line end with the whitespace around it (e.g. blank lines, the indentation of the next line), so the
+    sum can be off in either direction. Decisions on the token limit are verified with count.
+
+    bounds gives a lower and upper bound of the count from the UTF-8 length alone, every token is at least one
+    and at most max_token_bytes bytes, so obvious cases are decided without tokenizing.
+    """
+    CACHE_SIZE = 100000
+    # Longer texts are not cached
+    CACHE_MAX_LENGTH = 2000
+    # Chat format, same as ChatOpenAI.get_num_tokens_from_messages for gpt-3.5-turbo: tokens per message and
+    # tokens priming the reply
+    TOKENS_PER_MESSAGE = 4
+    REPLY_TOKENS = 3
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._encoding = None
+        self._max_token_bytes = None
+        self._lock = threading.Lock()
+        self._count_cached = lru_cache(maxsize=self.CACHE_SIZE)(self.count)
+
+    def preload(self):
+        with self._lock:
+            if self._encoding is None:
+                encoding = tiktoken.encoding_for_model(self.model_name)
+                self._max_token_bytes = max(len(token) for token in encoding.token_byte_values())
+                self._encoding = encoding
+                logger.info(f"Loaded encoding {encoding.name} for {self.model_name}")
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        if self._encoding is None:
+            self.preload()
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        # Special tokens in a pasted text are counted as the ordinary text they are
+        return len(self.encoding.encode_ordinary(text))
+
+    def count_cached(self, text: str) -> int:
+        if len(text) > self.CACHE_MAX_LENGTH:
+            return self.count(text)
+        return self._count_cached(text)
+
+    def count_lines(self, lines: Iterable[str]) -> int:
+        """
+        :return: Estimate of the number of tokens of the lines joined by newlines (plus a trailing newline), the sum
+            of the cached counts of the lines, see TokenCounter
+        """
+        count_cached = self.count_cached
+        return sum(count_cached(line + '\n') for line in lines)
+
+    def count_messages(self, messages: List[Tuple[str, str]]) -> int:
+        """
+        :param messages: (role, content) of the chat messages
+        """
+        count_cached = self.count_cached
+        return self.REPLY_TOKENS + sum(self.TOKENS_PER_MESSAGE + count_cached(role) + count_cached(content)
+                                       for role, content in messages)
+
+    def bounds(self, text: str) -> Tuple[int, int]:
+        """
+        :return: lower and upper bound of the number of tokens of text, without tokenizing
+        """
+        size = len(text.encode())
+        if self._max_token_bytes is None:
+            self.preload()
+        return math.ceil(size / self._max_token_bytes), size
+
+    def fits(self, text: str, max_tokens: int) -> bool:
+        lower, upper = self.bounds(text)
+        if upper <= max_tokens:
+            return True
+        if lower > max_tokens:
+            return False
+        return self.count(text) <= max_tokens
+
+
+_counters = {}
+
+
+def get_token_counter(model_name: str) -> TokenCounter:
+    counter = _counters.get(model_name)
+    if counter is None:
+        counter = _counters.setdefault(model_name, TokenCounter(model_name))
+    return counter
+
+
+def preload(model_names: Iterable[str]):
+    """
+    Load the encodings of the models, failing to load is logged and retried on first use.
+    """
+    for model_name in set(model_names):
+        try:
+            get_token_counter(model_name).preload()
+        except Exception as e:
+            logger.warning(f"Failed to preload encoding for {model_name}, will load on first use: {e}")